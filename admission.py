@@ -0,0 +1,242 @@
+"""
+Admission Control Module
+
+Bounded concurrency with a short wait queue plus per-client token-bucket
+rate limits, so overload is shed quickly instead of queueing without bound.
+Each AdmissionController is an independent execution lane: separate
+controllers for chat, admin uploads and reads keep one kind of traffic
+from occupying every worker thread.
+"""
+import asyncio
+import math
+import threading
+import time
+
+
+class AdmissionRejected(Exception):
+    """The request was shed; `retry_after` is a hint in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets refilled at `rate` tokens/second up to `burst`."""
+
+    def __init__(self, rate, burst, idle_ttl=600):
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = idle_ttl
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def acquire(self, key):
+        """Take one token for `key`. Returns 0 if allowed, else seconds to wait."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.rate if self.rate > 0 else float(self.idle_ttl)
+            if now - self._last_sweep > self.idle_ttl:
+                self._sweep(now)
+        return wait
+
+    def _sweep(self, now):
+        # Drop buckets that have been idle long enough to be full again
+        self._buckets = {
+            key: value for key, value in self._buckets.items()
+            if now - value[1] < self.idle_ttl
+        }
+        self._last_sweep = now
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+
+class ConcurrencyLimiter:
+    """
+    Allows `max_concurrent` holders at once and up to `max_queue` waiters,
+    each waiting at most `queue_timeout` seconds for a slot.
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting_seen = 0
+        # Exponentially weighted average time a slot is held, for Retry-After
+        self.avg_hold = 1.0
+
+    def acquire(self):
+        """Take a slot, waiting briefly if needed. Returns False if shed."""
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            self.max_waiting_seen = max(self.max_waiting_seen, self.waiting)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return True
+
+    def try_acquire(self):
+        """Take a slot only if one is free right now."""
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            return False
+
+    async def acquire_async(self, poll_interval=0.01):
+        """
+        Async variant of acquire(). Waiters poll rather than block on the
+        condition so that slots can be shared with threaded holders.
+        """
+        if self.try_acquire():
+            return True
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            self.max_waiting_seen = max(self.max_waiting_seen, self.waiting)
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(poll_interval)
+                if self.try_acquire():
+                    return True
+            return False
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def release(self, held_for=None):
+        with self._cond:
+            self.active -= 1
+            if held_for is not None:
+                self.avg_hold = 0.9 * self.avg_hold + 0.1 * held_for
+            self._cond.notify()
+
+    def retry_after(self):
+        """Rough time until a queue slot frees up."""
+        with self._cond:
+            backlog = (self.waiting + 1) / max(1, self.max_concurrent)
+            return max(1, math.ceil(self.avg_hold * backlog))
+
+
+class AdmissionController:
+    """
+    A named lane combining an optional per-client rate limit with a
+    concurrency limit. Pass rate_per_client=0 to disable rate limiting.
+    """
+
+    def __init__(self, name="default", max_concurrent=16, max_queue=32, queue_timeout=2.0,
+                 rate_per_client=1.0, burst_per_client=10):
+        self.name = name
+        self.limiter = ConcurrencyLimiter(max_concurrent, max_queue, queue_timeout)
+        self.rate_limiter = TokenBucketLimiter(rate_per_client, burst_per_client) if rate_per_client > 0 else None
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected_rate_limited = 0
+        self.rejected_overloaded = 0
+        self.busy_seconds = 0.0
+        self._created = time.monotonic()
+
+    def admit(self, client_key):
+        """
+        Admit a request or raise AdmissionRejected. On success returns a
+        release callable that must be called exactly once.
+        """
+        self._check_rate(client_key)
+        if not self.limiter.acquire():
+            self._reject_overloaded()
+        return self._admitted()
+
+    async def admit_async(self, client_key):
+        """Like admit(), but waits for a slot without blocking the event loop."""
+        self._check_rate(client_key)
+        if not await self.limiter.acquire_async():
+            self._reject_overloaded()
+        return self._admitted()
+
+    def admit_slot(self):
+        """
+        Like admit(), but without the per-client rate limit: for work that a
+        request admitted through another lane fans out into this one.
+        """
+        if not self.limiter.acquire():
+            self._reject_overloaded()
+        return self._admitted()
+
+    def _check_rate(self, client_key):
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.acquire(client_key)
+            if wait > 0:
+                with self._lock:
+                    self.rejected_rate_limited += 1
+                raise AdmissionRejected("Rate limit exceeded", max(1, math.ceil(wait)))
+
+    def _reject_overloaded(self):
+        with self._lock:
+            self.rejected_overloaded += 1
+        raise AdmissionRejected("Server is busy", self.limiter.retry_after())
+
+    def _admitted(self):
+        with self._lock:
+            self.admitted += 1
+        started = time.monotonic()
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                held_for = time.monotonic() - started
+                self.limiter.release(held_for)
+                with self._lock:
+                    self.busy_seconds += held_for
+        return release
+
+    def stats(self):
+        with self._lock:
+            rejected = self.rejected_rate_limited + self.rejected_overloaded
+            total = self.admitted + rejected
+            uptime = max(1e-9, time.monotonic() - self._created)
+            capacity = self.limiter.max_concurrent
+            return {
+                "lane": self.name,
+                "max_concurrent": capacity,
+                "max_queue": self.limiter.max_queue,
+                "in_flight": self.limiter.active,
+                "saturation": self.limiter.active / capacity if capacity else 1.0,
+                "average_utilization": min(1.0, self.busy_seconds / (uptime * capacity)) if capacity else 1.0,
+                "queue_depth": self.limiter.waiting,
+                "max_queue_depth_seen": self.limiter.max_waiting_seen,
+                "avg_hold_seconds": round(self.limiter.avg_hold, 3),
+                "admitted": self.admitted,
+                "rejected_rate_limited": self.rejected_rate_limited,
+                "rejected_overloaded": self.rejected_overloaded,
+                "rejection_rate": rejected / total if total else 0.0,
+                "tracked_clients": len(self.rate_limiter) if self.rate_limiter else 0,
+            }
@@ -5,29 +5,70 @@ import shutil
 import mimetypes
 import re
 import json
-from bisect import bisect_right
-from flask import Flask, request, jsonify, send_from_directory
+import hashlib
+import base64
+import copy
+import itertools
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
+import httpx
 from dotenv import load_dotenv
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; conversation locks are then per process
+    fcntl = None
 import tempfile
 import traceback
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
+from functools import wraps
+from werkzeug.security import safe_join
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from citation_renderer import CitationRenderer
+from response_cache import ResponseCache
+from similarity_index import SimilarityIndex
+from single_flight import SingleFlight
+from hedging import HedgePolicy
+from latency_stats import LatencyTracker
+from token_usage import TokenBudgetExceeded, TokenLedger, usage_from_metadata
+from cache_warmer import CacheWarmer
+from document_catalog import DocumentCatalog
+from ingest_jobs import FINISHED as JOB_FINISHED, JobQueue, JobQueueFull
+from line_locator import LineLocator
+from local_search import LocalSearchIndex
+from snippet_store import SnippetStore
+from http_compression import MIN_SIZE, SUFFIXES, compress, is_compressible, negotiate, precompressed_path
+from document_metadata import (
+    METADATA_KEYS, derive_metadata, parse_metadata, custom_metadata, parse_filters, metadata_filter,
+)
+from conversation_context import (
+    conversation_turns, recent_turns_start, build_contents, summary_prompt,
+    extractive_summary, clip_to_tokens, estimate_tokens,
+)
+from admission import AdmissionController, AdmissionRejected
+from resilience import ResilientCaller, RetryBudget, Deadline, UpstreamUnavailable, CircuitOpenError, DeadlineExceeded
 
 load_dotenv()
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
 
-# Initialize Gemini Client
 API_KEY = os.getenv("GEMINI_API_KEY")
-if not API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in environment variables")
-
-client = genai.Client(api_key=API_KEY)
 STORE_DISPLAY_NAME = "Raspberry Pi Knowledge Base"
+# Named knowledge bases, each its own FileSearchStore (e.g. one per product
+# line) so they can be indexed and cleared independently. The first is the
+# default for file management; chat searches all of them unless told otherwise.
+KNOWLEDGE_BASES = [
+    key.strip().lower() for key in os.getenv("KNOWLEDGE_BASES", "default").split(',')
+    if re.fullmatch(r'[a-z0-9_-]+', key.strip().lower())
+] or ["default"]
+DEFAULT_STORE = KNOWLEDGE_BASES[0]
 SYSTEM_INSTRUCTION = "You are a helpful and expert Raspberry Pi assistant. "
 SYSTEM_INSTRUCTION += "Your goal is to provide accurate, clear, and safe instructions about Raspberry Pi hardware and software. "
 SYSTEM_INSTRUCTION += "Use the provided knowledge base to ground your answers. If the information is not in the knowledge base, state that you don't know rather than making up information. Be concise but thorough. "
@@ -35,6 +76,161 @@ UPLOAD_FOLDER = 'uploads'
 SYSTEM_INSTRUCTIONS_FILE = 'system_instructions.json'
 FIXTURES_FOLDER = 'fixtures'
 CHAT_HISTORY_FOLDER = 'chat_history'
+# Text of cited chunks, content-addressed and served from /api/citations/<id>
+CITATION_SNIPPETS_FOLDER = os.getenv("CITATION_SNIPPETS_DIR", "snippets")
+CHAT_MODEL = 'gemini-2.5-flash'
+# Generation settings used unless an instruction profile overrides them
+DEFAULT_GENERATION = {"model": CHAT_MODEL}
+GENERATION_SETTINGS = ('model', 'temperature', 'max_output_tokens', 'thinking_budget')
+# Optional router sending short factual questions to a faster model tier
+CHAT_ROUTER_ENABLED = os.getenv("CHAT_ROUTER_ENABLED", "false").lower() in ("1", "true", "yes")
+CHAT_FAST_MODEL = os.getenv("CHAT_FAST_MODEL", "gemini-2.5-flash-lite")
+CHAT_ROUTER_MAX_WORDS = int(os.getenv("CHAT_ROUTER_MAX_WORDS", "12"))
+# Upstream generation latency per instruction profile and model
+profile_latency = LatencyTracker()
+# Token budgets per instruction profile over the last TOKEN_BUDGET_WINDOW_HOURS
+# (0 = unlimited; a profile's own "token_budget" overrides these). Over the
+# soft budget requests are downgraded to CHAT_FAST_MODEL without thinking,
+# over the hard budget they are rejected with 429.
+TOKEN_BUDGET_SOFT = int(os.getenv("TOKEN_BUDGET_SOFT", "0"))
+TOKEN_BUDGET_HARD = int(os.getenv("TOKEN_BUDGET_HARD", "0"))
+TOKEN_BUDGET_WINDOW_HOURS = int(os.getenv("TOKEN_BUDGET_WINDOW_HOURS", "24"))
+# Token usage per instruction profile and hour, and per conversation
+token_ledger = TokenLedger(hours=max(48, TOKEN_BUDGET_WINDOW_HOURS))
+# Batch questions: default and maximum worker pool size, and batch size limit
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+CHAT_BATCH_MAX_CONCURRENCY = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", "32"))
+CHAT_BATCH_MAX_QUESTIONS = int(os.getenv("CHAT_BATCH_MAX_QUESTIONS", "1000"))
+# Multi-turn context: token budget for earlier turns of a conversation, of
+# which up to CHAT_SUMMARY_TOKENS go to the rolling summary of older turns
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "3000"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "400"))
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", CHAT_FAST_MODEL)
+
+# Answer cache in front of generate_content. Set CHAT_CACHE_DIR to persist
+# entries across restarts; CHAT_CACHE_STALE_SECONDS enables stale-while-revalidate.
+# The knowledge-base revision is always kept on disk (CHAT_CACHE_REVISION_FILE),
+# so a change handled by one worker process invalidates every worker's answers.
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1000")),
+    ttl=int(os.getenv("CHAT_CACHE_TTL_SECONDS", "86400")),
+    stale_ttl=int(os.getenv("CHAT_CACHE_STALE_SECONDS", "3600")),
+    persist_dir=os.getenv("CHAT_CACHE_DIR") or None,
+    revision_path=os.getenv("CHAT_CACHE_REVISION_FILE") or (
+        None if os.getenv("CHAT_CACHE_DIR") else "cache_revision.json"
+    ),
+    max_disk_entries=int(os.getenv("CHAT_CACHE_MAX_DISK_ENTRIES", "0")) or None,
+)
+# Offline BM25 search over the local document copies, also used to answer
+# with the best matching passages when Gemini is unavailable and nothing
+# usable is cached (disable with LOCAL_FALLBACK_ENABLED=false)
+local_index = LocalSearchIndex()
+LOCAL_FALLBACK_ENABLED = os.getenv("LOCAL_FALLBACK_ENABLED", "true").lower() in ("1", "true", "yes")
+LOCAL_ANSWER_PASSAGES = int(os.getenv("LOCAL_ANSWER_PASSAGES", "3"))
+# Per-file shingle indexes over the same copies, used to anchor each
+# citation to the line range its chunk came from
+line_locator = LineLocator()
+# Local catalog of every store's documents (resource names, source URLs,
+# content hashes), so citation URLs and save replacements are resolved
+# without listing the stores; each store is reconciled against its remote
+# listing every CATALOG_RECONCILE_SECONDS (0 disables)
+document_catalog = DocumentCatalog(os.getenv("DOCUMENT_CATALOG_PATH", "catalog.sqlite3"))
+CATALOG_RECONCILE_SECONDS = int(os.getenv("CATALOG_RECONCILE_SECONDS", "600"))
+# /api/files pages through a per-store snapshot of the catalog, rebuilt
+# after FILE_LIST_CACHE_SECONDS and on every knowledge base change
+FILE_LIST_CACHE_SECONDS = float(os.getenv("FILE_LIST_CACHE_SECONDS", "15"))
+FILE_LIST_PAGE_SIZE = int(os.getenv("FILE_LIST_PAGE_SIZE", "50"))
+FILE_LIST_MAX_PAGE_SIZE = 500
+FILE_SORT_FIELDS = ('display_name', 'create_time', 'size_bytes', 'mime_type', 'state')
+# Uploads, archive uploads and saves are queued as ingest jobs and run on
+# INGEST_WORKERS threads per process; jobs are journaled in INGEST_JOURNAL_DIR
+# so unfinished ones resume after a restart
+INGEST_JOURNAL_FOLDER = os.getenv("INGEST_JOURNAL_DIR", "jobs")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PENDING_JOBS = int(os.getenv("INGEST_MAX_PENDING_JOBS", "100"))
+# Near-duplicate matching on top of the exact cache; set the threshold above 1 to disable
+similarity_index = SimilarityIndex(
+    threshold=float(os.getenv("CHAT_SIMILARITY_THRESHOLD", "0.8")),
+)
+# Concurrent identical questions share one upstream generate_content call
+chat_inflight = SingleFlight()
+# Opt-in cache pre-warming: after startup and after every knowledge base
+# change, re-ask the most frequent opening questions from chat_history/
+# (asked at least CACHE_PREWARM_MIN_ASKED times) and every fixture question
+CACHE_PREWARM_ENABLED = os.getenv("CACHE_PREWARM_ENABLED", "false").lower() in ("1", "true", "yes")
+CACHE_PREWARM_QUESTIONS = int(os.getenv("CACHE_PREWARM_QUESTIONS", "50"))
+CACHE_PREWARM_MIN_ASKED = int(os.getenv("CACHE_PREWARM_MIN_ASKED", "2"))
+
+# Upstream resilience: per-request deadlines, retries and circuit breakers.
+# Clients may shorten the deadline with an X-Request-Timeout header (seconds).
+UPSTREAM_DEADLINE_SECONDS = float(os.getenv("UPSTREAM_DEADLINE_SECONDS", "60"))
+UPLOAD_DEADLINE_SECONDS = float(os.getenv("UPLOAD_DEADLINE_SECONDS", "900"))
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def _is_retryable_error(e):
+    """Errors that indicate an unhealthy or overloaded upstream."""
+    if isinstance(e, genai_errors.APIError):
+        return e.code in RETRYABLE_STATUS_CODES
+    return isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError))
+
+upstream = ResilientCaller(
+    _is_retryable_error,
+    max_attempts=int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3")),
+    retry_budget=RetryBudget(ratio=float(os.getenv("UPSTREAM_RETRY_RATIO", "0.1"))),
+    failure_threshold=int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", "30")),
+)
+
+# Admission control for chat: a bounded number of concurrent upstream calls,
+# a short wait queue and a per-client token bucket. Excess load gets a 429.
+chat_admission = AdmissionController(
+    name="chat",
+    max_concurrent=int(os.getenv("CHAT_MAX_CONCURRENT", "16")),
+    max_queue=int(os.getenv("CHAT_MAX_QUEUE", "32")),
+    queue_timeout=float(os.getenv("CHAT_QUEUE_TIMEOUT_SECONDS", "2")),
+    rate_per_client=float(os.getenv("CHAT_RATE_PER_CLIENT", "1")),
+    burst_per_client=int(os.getenv("CHAT_BURST_PER_CLIENT", "10")),
+)
+# Opt-in hedging: re-issue generate_content when it is slower than the
+# CHAT_HEDGE_PERCENTILE of recent calls, for at most CHAT_HEDGE_MAX_RATIO of traffic.
+# Every admitted chat and pre-warm call may need a primary and a hedge thread.
+chat_hedge = HedgePolicy(
+    enabled=os.getenv("CHAT_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes"),
+    percentile=float(os.getenv("CHAT_HEDGE_PERCENTILE", "95")),
+    max_hedge_ratio=float(os.getenv("CHAT_HEDGE_MAX_RATIO", "0.05")),
+    max_workers=2 * (chat_admission.limiter.max_concurrent + int(os.getenv("CACHE_PREWARM_CONCURRENCY", "2"))),
+)
+# Separate lanes so long-running admin document operations and history/listing
+# reads can never take the worker threads chat needs. Size the server's thread
+# pool to at least the sum of the lane limits (gunicorn.conf.py does by default).
+admin_lane = AdmissionController(
+    name="admin",
+    max_concurrent=int(os.getenv("ADMIN_MAX_CONCURRENT", "2")),
+    max_queue=int(os.getenv("ADMIN_MAX_QUEUE", "4")),
+    queue_timeout=float(os.getenv("ADMIN_QUEUE_TIMEOUT_SECONDS", "5")),
+    rate_per_client=0,
+)
+read_lane = AdmissionController(
+    name="read",
+    max_concurrent=int(os.getenv("READ_MAX_CONCURRENT", "8")),
+    max_queue=int(os.getenv("READ_MAX_QUEUE", "16")),
+    queue_timeout=float(os.getenv("READ_QUEUE_TIMEOUT_SECONDS", "2")),
+    rate_per_client=0,
+)
+# A batch holds its slot for as long as it streams; its questions also take
+# chat lane slots, so this only bounds how many batches run at once
+batch_lane = AdmissionController(
+    name="batch",
+    max_concurrent=int(os.getenv("BATCH_MAX_CONCURRENT", "2")),
+    max_queue=int(os.getenv("BATCH_MAX_QUEUE", "2")),
+    queue_timeout=float(os.getenv("BATCH_QUEUE_TIMEOUT_SECONDS", "2")),
+    rate_per_client=0,
+)
+LANES = [chat_admission, admin_lane, read_lane, batch_lane]
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").lower() in ("1", "true", "yes")
+# gzip/brotli for JSON and text responses; larger bodies are sent as-is
+HTTP_COMPRESSION_ENABLED = os.getenv("HTTP_COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+HTTP_COMPRESSION_MAX_BYTES = int(os.getenv("HTTP_COMPRESSION_MAX_BYTES", str(16 * 1024 * 1024)))
 
 def extract_url_from_file(file_path):
     """Scans the file for a line starting with 'URL: ' and returns the URL."""
@@ -53,14 +249,26 @@ def extract_url_from_file(file_path):
         print(f"Error extracting URL from {file_path}: {e}")
     return None
 
-# Ensure upload folder exists
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+def _read_text_head(file_path, limit=65536):
+    """The start of a file as text, for metadata detection."""
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read(limit)
+    except Exception:
+        return ""
+
+def _document_custom_metadata(local_path, display_name, explicit=None):
+    """custom_metadata for an upload: derived tags, overridden by explicit ones, plus source_url."""
+    metadata = derive_metadata(display_name, _read_text_head(local_path))
+    metadata.update(explicit or {})
+    return custom_metadata(metadata, extract_url_from_file(local_path)) or None
 
 # Ensure fixtures folder exists
 if not os.path.exists(FIXTURES_FOLDER):
     os.makedirs(FIXTURES_FOLDER)
 
+snippet_store = SnippetStore(CITATION_SNIPPETS_FOLDER)
+
 # Ensure chat history folder exists
 if not os.path.exists(CHAT_HISTORY_FOLDER):
     os.makedirs(CHAT_HISTORY_FOLDER)
@@ -86,14 +294,131 @@ def save_custom_instructions(instructions):
         print(f"Error saving custom instructions: {e}")
         return False
 
-def _serialize_grounding_metadata(gm):
-    """Serialize grounding metadata to a JSON-serializable format."""
+def _parse_generation_settings(data):
+    """Validate the generation settings of an instruction profile.
+
+    Accepts model, temperature (0-2), max_output_tokens (> 0) and
+    thinking_budget (-1 for dynamic, 0 to disable thinking).
+    Returns (settings, error); error is None when valid.
+    """
+    if data is None:
+        return {}, None
+    if not isinstance(data, dict):
+        return None, "generation must be an object"
+    unknown = sorted(set(data) - set(GENERATION_SETTINGS))
+    if unknown:
+        return None, f"Unknown generation settings: {', '.join(unknown)}"
+    settings = {}
+    model = data.get('model')
+    if model is not None:
+        if not isinstance(model, str) or not model.strip():
+            return None, "model must be a non-empty string"
+        settings['model'] = model.strip()
+    try:
+        if data.get('temperature') is not None:
+            settings['temperature'] = float(data['temperature'])
+            if not 0 <= settings['temperature'] <= 2:
+                return None, "temperature must be between 0 and 2"
+        if data.get('max_output_tokens') is not None:
+            settings['max_output_tokens'] = int(data['max_output_tokens'])
+            if settings['max_output_tokens'] <= 0:
+                return None, "max_output_tokens must be positive"
+        if data.get('thinking_budget') is not None:
+            settings['thinking_budget'] = int(data['thinking_budget'])
+            if settings['thinking_budget'] < -1:
+                return None, "thinking_budget must be -1 (dynamic) or greater"
+    except (TypeError, ValueError):
+        return None, "temperature, max_output_tokens and thinking_budget must be numbers"
+    return settings, None
+
+def _parse_token_budget(data):
+    """Validate a profile's token budget: {"soft", "hard"} token counts (0 or absent = none).
+
+    Returns (budget, error); error is None when valid.
+    """
+    if data is None:
+        return {}, None
+    if not isinstance(data, dict) or set(data) - {'soft', 'hard'}:
+        return None, "token_budget must be an object with soft and/or hard"
+    budget = {}
+    for key in ('soft', 'hard'):
+        if data.get(key) is None:
+            continue
+        try:
+            budget[key] = int(data[key])
+        except (TypeError, ValueError):
+            return None, "token_budget values must be numbers"
+        if budget[key] < 0:
+            return None, "token_budget values must not be negative"
+    if budget.get('soft') and budget.get('hard') and budget['soft'] > budget['hard']:
+        return None, "The soft token budget must not exceed the hard one"
+    return budget, None
+
+def _default_profile():
+    return {
+        "id": "default",
+        "name": "Default",
+        "instruction": SYSTEM_INSTRUCTION,
+        "generation": {},
+    }
+
+def _resolve_profile(instruction_id, custom_instruction):
+    """Find the instruction profile for a chat request.
+
+    Profiles are selected by id; requests that only send instruction text
+    are matched to a profile with the same text, so its generation settings
+    still apply. Returns (profile_id, instruction, overrides, error) where
+    overrides are the profile's own generation settings.
+    """
+    profiles = [_default_profile()] + load_custom_instructions()
+    profile = None
+    if instruction_id:
+        profile = next((p for p in profiles if p.get("id") == instruction_id), None)
+        if profile is None:
+            return None, None, None, f"Instruction '{instruction_id}' not found"
+    instruction = custom_instruction or (profile["instruction"] if profile else SYSTEM_INSTRUCTION)
+    if profile is None:
+        profile = next((p for p in profiles if (p.get("instruction") or "").strip() == instruction.strip()), None)
+    if profile is None:
+        return "custom", instruction, {}, None
+    return profile["id"], instruction, profile.get("generation") or {}, None
+
+_FACTUAL_QUESTION = re.compile(r"^(what|which|when|where|who|is|are|does|do|can|how (many|much|long|big|fast))\b", re.IGNORECASE)
+_COMPLEX_QUESTION = re.compile(r"\b(why|explain|compare|difference|troubleshoot|steps?|configure|set ?up|install)\b", re.IGNORECASE)
+
+def _is_short_factual(message):
+    """Heuristic for questions a faster model tier answers as well as the default."""
+    text = message.strip()
+    if '\n' in text or '`' in text:
+        return False
+    return (len(text.split()) <= CHAT_ROUTER_MAX_WORDS
+            and bool(_FACTUAL_QUESTION.match(text))
+            and not _COMPLEX_QUESTION.search(text))
+
+def _route_generation(message, generation, pinned_model):
+    """Route short factual questions to CHAT_FAST_MODEL unless the profile pins a model.
+
+    Returns (generation, routed).
+    """
+    if CHAT_ROUTER_ENABLED and not pinned_model and _is_short_factual(message):
+        return dict(generation, model=CHAT_FAST_MODEL), True
+    return generation, False
+
+def _generation_fingerprint(generation):
+    return json.dumps(generation, sort_keys=True)
+
+def _serialize_grounding_metadata(gm, snippets=None):
+    """Serialize grounding metadata to a JSON-serializable format.
+
+    Chunk text is not included; `snippets` (from _capture_snippets) adds
+    each chunk's snippet store id instead.
+    """
     if not gm:
         return None
     result = {}
     if hasattr(gm, 'grounding_chunks') and gm.grounding_chunks:
         chunks = []
-        for chunk in gm.grounding_chunks:
+        for chunk_idx, chunk in enumerate(gm.grounding_chunks):
             chunk_data = {}
             if hasattr(chunk, 'web') and chunk.web:
                 chunk_data['web'] = {
@@ -106,6 +431,8 @@ def _serialize_grounding_metadata(gm):
                     'title': getattr(rc, 'title', None),
                     'uri': getattr(rc, 'uri', None),
                 }
+            if snippets and snippets[chunk_idx]:
+                chunk_data['snippet'] = snippets[chunk_idx]
             chunks.append(chunk_data)
         result['grounding_chunks'] = chunks
     if hasattr(gm, 'grounding_supports') and gm.grounding_supports:
@@ -143,6 +470,7 @@ def _deserialize_grounding_metadata(data):
         def __init__(self, chunk_data):
             self.web = None
             self.retrieved_context = None
+            self.snippet = chunk_data.get('snippet')
             if 'web' in chunk_data and chunk_data['web']:
                 self.web = MockWeb(
                     chunk_data['web'].get('title'),
@@ -190,7 +518,9 @@ def save_fixture(name, message, response_text, grounding_metadata):
             "name": name,
             "message": message,
             "response_text": response_text,
-            "grounding_metadata": _serialize_grounding_metadata(grounding_metadata),
+            "grounding_metadata": _serialize_grounding_metadata(
+                grounding_metadata, _capture_snippets(grounding_metadata)
+            ),
             "created_at": datetime.now().isoformat()
         }
         filename = f"{name}.json"
@@ -281,67 +611,983 @@ def _get_chunk_debug_text(chunk):
                 return value
     return None
 
-
-def get_or_create_store():
-    """Finds or creates the persistent FileSearchStore."""
+def _capture_snippets(gm):
+    """Store the text of each retrieved chunk once in the snippet store.
+
+    Returns snippet ids aligned with gm.grounding_chunks (None where no text
+    is available). Deserialized fixtures already carry their ids.
+    """
+    snippets = []
+    for chunk in (getattr(gm, 'grounding_chunks', None) or []):
+        snippet = getattr(chunk, 'snippet', None)
+        if snippet is None:
+            text = _get_chunk_debug_text(chunk)
+            source = getattr(chunk, 'retrieved_context', None) or getattr(chunk, 'web', None)
+            if text:
+                try:
+                    snippet = snippet_store.put(text, getattr(source, 'title', None), getattr(source, 'uri', None))
+                except OSError as e:
+                    print(f"Warning: Could not store citation snippet: {e}")
+        snippets.append(snippet)
+    return snippets
+
+# Routes whose upstream work (upload + indexing) legitimately takes minutes
+LONG_RUNNING_ENDPOINTS = {'upload_file', 'upload_tar_file', 'save_file', 'clear_store', 'chat_batch'}
+
+@app.before_request
+def _start_request_deadline():
+    """Attach a deadline to the request, optionally shortened by the client."""
+    limit = UPLOAD_DEADLINE_SECONDS if request.endpoint in LONG_RUNNING_ENDPOINTS else UPSTREAM_DEADLINE_SECONDS
     try:
+        requested = float(request.headers.get('X-Request-Timeout', limit))
+    except ValueError:
+        requested = limit
+    g.deadline = Deadline(max(0.0, min(requested, limit)))
+
+def _current_deadline():
+    """The deadline of the current request, or a default one outside requests."""
+    if has_request_context() and 'deadline' in g:
+        return g.deadline
+    return Deadline(UPSTREAM_DEADLINE_SECONDS)
+
+def _with_timeout(config, timeout):
+    """Add an HTTP timeout (seconds) to a google-genai config dict."""
+    if timeout is not None:
+        config = dict(config, http_options={'timeout': max(1, int(timeout * 1000))})
+    return config
+
+def _error_status(e):
+    """The HTTP status and extra headers an exception maps to."""
+    if isinstance(e, DeadlineExceeded):
+        return 504, {}
+    if isinstance(e, CircuitOpenError):
+        return 503, {'Retry-After': str(int(e.retry_after) + 1)}
+    if isinstance(e, TokenBudgetExceeded):
+        return 429, {'Retry-After': str(e.retry_after)}
+    if isinstance(e, JobQueueFull):
+        return 503, {'Retry-After': str(e.retry_after)}
+    return 500, {}
+
+def _error_response(e):
+    """Map an exception to a JSON error response."""
+    status, headers = _error_status(e)
+    return jsonify({"error": str(e)}), status, headers
+
+def _client_ip():
+    """The client address used for per-client rate limits."""
+    if TRUST_PROXY_HEADERS and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or "unknown"
+
+def _admission_controlled(lane):
+    """Run a view in an execution lane, shedding load with 429 + Retry-After.
+
+    The slot is held until the response is closed, so streamed responses
+    count against the limit for as long as they are streaming.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                release = lane.admit(_client_ip())
+            except AdmissionRejected as e:
+                response = jsonify({"error": e.reason, "retry_after": e.retry_after})
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response, 429
+            try:
+                result = app.make_response(view(*args, **kwargs))
+            except Exception:
+                release()
+                raise
+            result.call_on_close(release)
+            return result
+        return wrapper
+    return decorator
+
+def _list_documents(store_name, deadline=None):
+    """List every document in a store, retrying the whole listing on failure."""
+    return upstream.call(
+        "documents.list",
+        lambda timeout: list(get_client().file_search_stores.documents.list(
+            parent=store_name, config=_with_timeout({}, timeout)
+        )),
+        deadline or _current_deadline()
+    )
+
+def _get_document(name, deadline=None):
+    return upstream.call(
+        "documents.get",
+        lambda timeout: get_client().file_search_stores.documents.get(
+            name=name, config=_with_timeout({}, timeout)
+        ),
+        deadline or _current_deadline()
+    )
+
+def _delete_document(name, deadline=None):
+    return upstream.call(
+        "documents.delete",
+        lambda timeout: get_client().file_search_stores.documents.delete(
+            name=name, config=_with_timeout({'force': True}, timeout)
+        ),
+        deadline or _current_deadline()
+    )
+
+def _upload_document(local_path, config, label=None, deadline=None, store_key=DEFAULT_STORE):
+    """Upload a local file to a knowledge base store and wait until it is indexed."""
+    deadline = deadline or _current_deadline()
+    with open(local_path, 'rb') as f:
+        # Uploads are not idempotent, so they are never retried
+        operation = upstream.call(
+            "documents.upload",
+            lambda timeout: get_client().file_search_stores.upload_to_file_search_store(
+                file_search_store_name=_store_name(store_key),
+                file=f,
+                config=_with_timeout(config, timeout)
+            ),
+            deadline,
+            retry=False
+        )
+
+        while not operation.done:
+            if deadline.remaining() <= 1:
+                raise DeadlineExceeded(f"Timed out waiting for {label or local_path} to be indexed")
+            time.sleep(1)
+            if label:
+                print(f"UPLOADING {label}...")
+            operation = upstream.call(
+                "operations.get",
+                lambda timeout: get_client().operations.get(operation, config=_with_timeout({}, timeout)),
+                deadline
+            )
+    return operation
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """The Gemini client for this process, created on first use.
+
+    A client owns HTTP connection pools that must not be shared across a
+    fork, so each worker of a pre-forking server builds its own.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                if not API_KEY:
+                    raise ValueError("GEMINI_API_KEY not found in environment variables")
+                _client = genai.Client(api_key=API_KEY)
+                _client_pid = os.getpid()
+    return _client
+
+def get_or_create_store(display_name=STORE_DISPLAY_NAME):
+    """Finds or creates a persistent FileSearchStore by display name."""
+    def find_or_create(timeout):
         # Check for existing store
-        for store in client.file_search_stores.list():
-            if store.display_name == STORE_DISPLAY_NAME:
+        for store in get_client().file_search_stores.list(config=_with_timeout({}, timeout)):
+            if store.display_name == display_name:
                 return store
         
         # Create new one if not found
-        return client.file_search_stores.create(config={'display_name': STORE_DISPLAY_NAME})
+        return get_client().file_search_stores.create(
+            config=_with_timeout({'display_name': display_name}, timeout)
+        )
+
+    try:
+        return upstream.call("stores", find_or_create, _current_deadline())
     except Exception as e:
         print(f"Error managing store: {e}")
         return None
 
-# Initialize the store reference
-current_store = get_or_create_store()
-print(current_store)
+def _store_display_name(key):
+    """The FileSearchStore display name of a knowledge base."""
+    return STORE_DISPLAY_NAME if key == DEFAULT_STORE else f"{STORE_DISPLAY_NAME} ({key})"
+
+def _upload_folder(key):
+    """The folder holding local copies of a knowledge base's documents."""
+    return UPLOAD_FOLDER if key == DEFAULT_STORE else f"{UPLOAD_FOLDER}_{key}"
+
+# Ensure every knowledge base's upload folder exists
+for _key in KNOWLEDGE_BASES:
+    os.makedirs(_upload_folder(_key), exist_ok=True)
+
+# Stores are resolved lazily (see _ensure_store) so importing this module,
+# e.g. in a pre-forking server's master process, does no network I/O.
+# Each knowledge base has its own slot and retry backoff.
+STORE_RETRY_SECONDS = float(os.getenv("STORE_RETRY_SECONDS", "5"))
+_stores = {key: {"store": None, "failures": 0, "next_attempt": 0.0} for key in KNOWLEDGE_BASES}
+_store_lock = threading.Lock()
+_store_resolver = None
+_resolver_lock = threading.Lock()
+
+def _ensure_store(key=DEFAULT_STORE):
+    """Resolve a knowledge base's FileSearchStore on first use.
+
+    Failed lookups are retried on later calls with exponential backoff
+    (capped at a minute) rather than on every request.
+    """
+    slot = _stores[key]
+    if slot["store"] is not None:
+        return slot["store"]
+    with _store_lock:
+        if slot["store"] is None and time.monotonic() >= slot["next_attempt"]:
+            store = get_or_create_store(_store_display_name(key))
+            if store:
+                slot["store"] = store
+                slot["failures"] = 0
+                print(f"Using store {store.name} for knowledge base '{key}'")
+            else:
+                slot["failures"] += 1
+                slot["next_attempt"] = time.monotonic() + min(60, STORE_RETRY_SECONDS * 2 ** (slot["failures"] - 1))
+    return slot["store"]
+
+def _ensure_stores(keys):
+    """Resolve several knowledge bases; False unless all of them resolved."""
+    return all([_ensure_store(key) for key in keys])
+
+def _store_name(key=DEFAULT_STORE):
+    """The resource name of a resolved knowledge base store."""
+    return _stores[key]["store"].name
+
+def _store_key_for_document(name):
+    """The knowledge base a document resource name belongs to, if any."""
+    for key, slot in _stores.items():
+        if slot["store"] is not None and name.startswith(slot["store"].name + "/"):
+            return key
+    return None
+
+def _requested_store(value):
+    """Validate a `store` request parameter. Returns (key, error)."""
+    key = value or DEFAULT_STORE
+    if key not in _stores:
+        return None, f"Unknown knowledge base '{key}'"
+    return key, None
+
+def _parse_store_selection(value):
+    """Validate the knowledge bases a chat request searches (default: all).
+
+    Returns (keys, error) with keys in configuration order.
+    """
+    if not value:
+        return list(KNOWLEDGE_BASES), None
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not all(isinstance(key, str) for key in value):
+        return None, "stores must be a string or a list of strings"
+    unknown = [key for key in value if key not in _stores]
+    if unknown:
+        return None, f"Unknown knowledge base '{unknown[0]}'"
+    return [key for key in KNOWLEDGE_BASES if key in value], None
+
+# The local search index is built from the upload folders on first use and
+# then kept current by the upload, save, delete and clear endpoints. Those
+# run in one worker process; the others notice the document catalog's
+# revision move on and rescan the folders for changed copies.
+_local_index_ready = False
+_local_index_lock = threading.Lock()
+_local_index_builder = None
+_local_index_revision = None
+_local_index_files = {}  # doc id -> (size, mtime) of the copy last indexed
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def _unindex_local_files(predicate):
+    """Drop the local copies whose doc id satisfies `predicate` from the local indexes."""
+    local_index.remove_documents(predicate)
+    line_locator.remove_files(predicate)
+    for doc_id in [doc_id for doc_id in list(_local_index_files) if predicate(doc_id)]:
+        _local_index_files.pop(doc_id, None)
+
+def _index_local_file(store_key, filename):
+    """(Re-)index one local document copy; files that are not UTF-8 text are skipped."""
+    doc_id = (store_key, filename)
+    local_path = os.path.join(_upload_folder(store_key), filename)
+    try:
+        signature = _file_signature(local_path)
+        with open(local_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        _unindex_local_files(lambda other: other == doc_id)
+        return
+    except UnicodeDecodeError:
+        _unindex_local_files(lambda other: other == doc_id)
+        # Remembered, so rescans skip it until it changes
+        _local_index_files[doc_id] = signature
+        return
+    local_index.add_document(
+        doc_id, text,
+        title=filename, store=store_key, url=extract_url_from_file(local_path)
+    )
+    line_locator.add_file(doc_id, local_path, filename)
+    _local_index_files[doc_id] = signature
+
+def _ensure_local_index():
+    """Build the local search index over every upload folder on first use, and
+    rescan the folders whenever the document catalog changed since (possibly
+    in another worker process): new or modified copies are re-indexed and
+    removed ones dropped.
+    """
+    global _local_index_ready, _local_index_revision
+    revision = document_catalog.revision()
+    if _local_index_ready and revision == _local_index_revision:
+        return
+    with _local_index_lock:
+        if _local_index_ready and revision == _local_index_revision:
+            return
+        started = time.monotonic()
+        present = set()
+        reindexed = 0
+        for key in KNOWLEDGE_BASES:
+            folder = _upload_folder(key)
+            for filename in sorted(os.listdir(folder)):
+                path = os.path.join(folder, filename)
+                if filename.startswith('.') or not os.path.isfile(path):
+                    continue
+                present.add((key, filename))
+                try:
+                    unchanged = _local_index_files.get((key, filename)) == _file_signature(path)
+                except OSError:
+                    continue
+                if not unchanged:
+                    _index_local_file(key, filename)
+                    reindexed += 1
+        removed = len(set(_local_index_files) - present)
+        if removed:
+            _unindex_local_files(lambda doc_id: doc_id not in present)
+        _local_index_revision = revision
+        stats = local_index.stats()
+        if not _local_index_ready:
+            print(f"Local search index: {stats['passages']} passages from {stats['documents']} documents "
+                  f"in {time.monotonic() - started:.2f}s")
+        elif reindexed or removed:
+            print(f"Local search index: re-indexed {reindexed} and removed {removed} documents "
+                  f"in {time.monotonic() - started:.2f}s")
+        _local_index_ready = True
+
+def _local_search(query, store_keys=None, limit=LOCAL_ANSWER_PASSAGES):
+    """BM25 hits for `query` in the given knowledge bases (default all)."""
+    _ensure_local_index()
+    store_keys = set(store_keys or KNOWLEDGE_BASES)
+    return local_index.search(query, limit=limit, doc_filter=lambda doc_id: doc_id[0] in store_keys)
+
+def _locate_lines(title, text, store_keys=None):
+    """Where `text` occurs in the local copy of document `title`.
+
+    Returns {"store", "start_line", "end_line"} or None. Copies that are new
+    or changed on disk are (re-)indexed here first, so lookups stay right
+    even for files edited outside the API.
+    """
+    if not title or not text or os.path.basename(title) != title:
+        return None
+    store_keys = store_keys or KNOWLEDGE_BASES
+    for key in store_keys:
+        path = os.path.join(_upload_folder(key), title)
+        if os.path.isfile(path):
+            line_locator.add_file((key, title), path, title)
+        else:
+            line_locator.remove_file((key, title))
+    keys = set(store_keys)
+    found = line_locator.locate(title, text, doc_filter=lambda doc_id: doc_id[0] in keys)
+    if found is None:
+        return None
+    (store_key, _), start_line, end_line = found
+    return {"store": store_key, "start_line": start_line, "end_line": end_line}
+
+def _locate_chunks(gm, snippets=None, store_keys=None):
+    """Line locations aligned with gm.grounding_chunks (None where unknown).
+
+    Chunk text comes from the response, or from the snippet store for
+    replayed fixtures. Web chunks have no local copy.
+    """
+    locations = []
+    for chunk_idx, chunk in enumerate(getattr(gm, 'grounding_chunks', None) or []):
+        rc = getattr(chunk, 'retrieved_context', None)
+        location = None
+        if rc:
+            text = _get_chunk_debug_text(chunk)
+            if not text and snippets and snippets[chunk_idx]:
+                snippet = snippet_store.get(snippets[chunk_idx])
+                text = snippet["text"] if snippet else None
+            location = _locate_lines(getattr(rc, 'title', None), text, store_keys)
+        locations.append(location)
+    return locations
+
+def _local_link(url, location):
+    """Anchor a localhost:// citation link to the cited line range."""
+    if location and url.startswith("localhost://") and "#" not in url:
+        return f"{url}#L{location['start_line']}-L{location['end_line']}"
+    return url
+
+_prewarm_scheduled = False
+_catalog_reconciler = None
+
+def warm_up():
+    """Start this worker's background work (call once per worker).
+
+    Resolves every store, builds the local index, starts the ingest job
+    workers and the catalog reconciler, and schedules cache pre-warming
+    when it is enabled.
+    """
+    global _store_resolver, _local_index_builder, _catalog_reconciler, _prewarm_scheduled
+    with _resolver_lock:
+        pending = [key for key, slot in _stores.items() if slot["store"] is None]
+        if pending and (_store_resolver is None or not _store_resolver.is_alive()):
+            _store_resolver = threading.Thread(
+                target=_ensure_stores, args=(pending,), name="store-resolver", daemon=True
+            )
+            _store_resolver.start()
+        if not _local_index_ready and _local_index_builder is None:
+            _local_index_builder = threading.Thread(target=_ensure_local_index, name="local-index", daemon=True)
+            _local_index_builder.start()
+        ingest_jobs.start()
+        if CATALOG_RECONCILE_SECONDS > 0 and _catalog_reconciler is None:
+            _catalog_reconciler = threading.Thread(
+                target=_reconcile_catalog_periodically, name="catalog-reconciler", daemon=True
+            )
+            _catalog_reconciler.start()
+        if CACHE_PREWARM_ENABLED and not _prewarm_scheduled:
+            _prewarm_scheduled = True
+            cache_warmer.schedule("startup")
+
+@app.after_request
+def _compress_response(response):
+    """Compress JSON and text responses with the best encoding the client accepts.
+
+    Streamed responses (SSE, NDJSON) are left alone so every event is
+    delivered as soon as it is written.
+    """
+    if (not HTTP_COMPRESSION_ENABLED or response.status_code != 200
+            or (response.is_streamed and not response.direct_passthrough)
+            or 'Content-Encoding' in response.headers or not is_compressible(response.mimetype)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    length = response.content_length
+    if encoding is None or (length is not None and not MIN_SIZE <= length <= HTTP_COMPRESSION_MAX_BYTES):
+        return response
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # The representation changed, so a strong validator no longer applies
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def _conditional_json(data, path):
+    """A JSON response with ETag and Last-Modified (from `path`), 304 if the client's copy is current."""
+    response = jsonify(data)
+    try:
+        response.last_modified = datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+    except OSError:
+        pass
+    response.add_etag(weak=True)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def _latest_mtime_path(folder):
+    """The most recently changed of `folder` and its files (deletions touch the folder)."""
+    latest, latest_mtime = folder, os.path.getmtime(folder)
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:  # Deleted since the listing; the folder's mtime covers it
+            continue
+        if mtime > latest_mtime:
+            latest, latest_mtime = path, mtime
+    return latest
+
+def _send_static(filename):
+    """Serve a static file, preferring an up-to-date .br/.gz sibling the client accepts.
+
+    The siblings are written by `python http_compression.py static` (run
+    by gunicorn.conf.py on start); send_from_directory supplies ETag and
+    Last-Modified and answers conditional requests with 304.
+    """
+    path = safe_join(app.static_folder, filename)
+    if HTTP_COMPRESSION_ENABLED and path and os.path.isfile(path):
+        encoding = negotiate(
+            request.headers.get('Accept-Encoding'),
+            [encoding for encoding in SUFFIXES if precompressed_path(path, encoding)]
+        )
+        if encoding:
+            response = send_from_directory(
+                app.static_folder, filename + SUFFIXES[encoding], mimetype=mimetypes.guess_type(filename)[0]
+            )
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return send_from_directory(app.static_folder, filename)
+
+app.view_functions['static'] = _send_static
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: the process is up and serving requests."""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: every knowledge base store has been resolved."""
+    pending = {key: slot for key, slot in _stores.items() if slot["store"] is None}
+    if not pending:
+        return jsonify({"status": "ready", "stores": {key: _store_name(key) for key in _stores}})
+    warm_up()
+    next_attempt = max(slot["next_attempt"] for slot in pending.values())
+    retry_after = max(1, int(next_attempt - time.monotonic()) + 1)
+    failures = {key: slot["failures"] for key, slot in pending.items() if slot["failures"]}
+    response = jsonify({
+        "status": "unavailable" if failures else "starting",
+        "pending": list(pending),
+        "store_failures": failures,
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+@app.route('/api/stores', methods=['GET'])
+def list_stores():
+    """Lists the configured knowledge bases and their FileSearchStores."""
+    return jsonify([
+        {
+            "key": key,
+            "display_name": _store_display_name(key),
+            "name": slot["store"].name if slot["store"] is not None else None,
+            "default": key == DEFAULT_STORE,
+            "upload_folder": _upload_folder(key),
+        }
+        for key, slot in _stores.items()
+    ])
+
+@app.route('/api/search', methods=['GET'])
+@_admission_controlled(read_lane)
+def search():
+    """Keyword (BM25) search over the local document copies; needs no network.
+
+    Query parameters: `q`, `limit` (default 10, at most 50) and `store`
+    (repeatable or comma-separated; default all knowledge bases).
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "No query provided"}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    requested = [key for value in request.args.getlist('store') for key in value.split(',') if key]
+    store_keys, error = _parse_store_selection(requested)
+    if error:
+        return jsonify({"error": error}), 404
+
+    started = time.monotonic()
+    hits = _local_search(query, store_keys, limit)
+    return jsonify({
+        "query": query,
+        "results": [
+            {key: hit[key] for key in ("title", "store", "url", "start_line", "end_line", "score", "text")}
+            for hit in hits
+        ],
+        "took_ms": round((time.monotonic() - started) * 1000, 2),
+    })
 
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'chat.html')
+    return _send_static('chat.html')
 
 @app.route('/admin')
 def admin():
-    return send_from_directory(app.static_folder, 'index.html')
+    return _send_static('index.html')
+
+def _document_metadata(doc):
+    """A document's custom metadata as {key: value}."""
+    return {
+        item.key: getattr(item, 'string_value', None)
+        for item in (doc.custom_metadata or [])
+    }
+
+def _file_sha256(path):
+    """Hex SHA-256 of a file's content, or None if it cannot be read."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def _catalog_entry(doc, store_key):
+    """The catalog fields of a listed document."""
+    metadata = _document_metadata(doc)
+    create_time = getattr(doc, 'create_time', None)
+    return {
+        "name": doc.name,
+        "store": store_key,
+        "display_name": doc.display_name,
+        "source_url": metadata.get('source_url'),
+        "size_bytes": getattr(doc, 'size_bytes', None),
+        "mime_type": getattr(doc, 'mime_type', None),
+        "state": str(doc.state) if hasattr(doc, 'state') else None,
+        "create_time": create_time.isoformat() if hasattr(create_time, 'isoformat') else create_time,
+        "metadata": metadata,
+    }
+
+def _reconcile_catalog(store_key, deadline=None):
+    """Make the catalog's entries for a store match its remote listing.
+
+    Content hashes of new entries are taken from the local copies.
+    """
+    _apply_remote_listing(store_key, _list_documents(_store_name(store_key), deadline))
+
+def _apply_remote_listing(store_key, docs):
+    """Replace a store's catalog entries with its remote listing `docs`."""
+    folder = _upload_folder(store_key)
+    added, removed, changed = document_catalog.replace_store(
+        store_key,
+        [_catalog_entry(doc, store_key) for doc in docs],
+        content_hash=lambda entry: _file_sha256(os.path.join(folder, entry["display_name"]))
+    )
+    print(f"Catalog for '{store_key}' reconciled: {len(docs)} documents "
+          f"({added} added, {removed} removed, {changed} changed)")
+
+def _ensure_catalog(store_keys):
+    """Reconcile (in parallel) the stores the catalog has not seen yet or was told are stale.
+
+    A store that fails to list keeps its current entries.
+    """
+    pending = [key for key in store_keys if document_catalog.reconciled_at(key) is None]
+    if not pending:
+        return
+    deadline = _current_deadline()
+    with ThreadPoolExecutor(max_workers=min(4, len(pending)), thread_name_prefix="catalog") as executor:
+        futures = {executor.submit(_reconcile_catalog, key, deadline): key for key in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Warning: Could not reconcile the document catalog for '{futures[future]}': {e}")
+
+def _reconcile_catalog_periodically():
+    """Reconcile every resolved store whose catalog entries are older than CATALOG_RECONCILE_SECONDS.
+
+    Reconciliation times are kept in the catalog, so worker processes
+    sharing it do not repeat each other's work.
+    """
+    while True:
+        time.sleep(min(60, CATALOG_RECONCILE_SECONDS))
+        for key in KNOWLEDGE_BASES:
+            reconciled_at = document_catalog.reconciled_at(key)
+            if _stores[key]["store"] is None or (
+                    reconciled_at is not None and time.time() - reconciled_at < CATALOG_RECONCILE_SECONDS):
+                continue
+            try:
+                _reconcile_catalog(key, Deadline(UPSTREAM_DEADLINE_SECONDS))
+            except Exception as e:
+                print(f"Warning: Could not reconcile the document catalog for '{key}': {e}")
+
+_file_snapshots = {}
+_file_snapshots_generation = 0
+_file_snapshots_lock = threading.Lock()
+
+def _invalidate_file_snapshots():
+    global _file_snapshots_generation
+    with _file_snapshots_lock:
+        _file_snapshots.clear()
+        _file_snapshots_generation += 1
+
+def _catalog_summary(doc):
+    """The per-document fields returned by the file listing, from a catalog entry."""
+    return {
+        "name": doc["name"],
+        "display_name": doc["display_name"],
+        "create_time": doc["create_time"],
+        "size_bytes": doc["size_bytes"],
+        "mime_type": doc["mime_type"],
+        "state": doc["state"],
+        "metadata": doc["metadata"],
+    }
+
+def _file_snapshot(store_key, refresh=False, reconciled=False):
+    """A store's listing snapshot, rebuilt from the catalog when older than FILE_LIST_CACHE_SECONDS.
+
+    `refresh` reconciles the catalog with the remote listing first, unless
+    the caller already brought it up to date (`reconciled`).
+    """
+    with _file_snapshots_lock:
+        snapshot = _file_snapshots.get(store_key)
+        generation = _file_snapshots_generation
+    if snapshot and not refresh and time.time() - snapshot["created_at"] < FILE_LIST_CACHE_SECONDS:
+        return snapshot
+    if refresh and not reconciled:
+        _reconcile_catalog(store_key)
+    elif not reconciled:
+        _ensure_catalog([store_key])
+    snapshot = {
+        "created_at": time.time(),
+        "files": [_catalog_summary(doc) for doc in document_catalog.documents(store_key)],
+        "orders": {},  # sort field -> (sort keys, files), built on first use
+    }
+    with _file_snapshots_lock:
+        # A snapshot read before a knowledge base change is not kept
+        if generation == _file_snapshots_generation:
+            _file_snapshots[store_key] = snapshot
+    return snapshot
+
+def _file_sort_key(file, sort):
+    value = file.get(sort)
+    if value is None:
+        value = 0 if sort == 'size_bytes' else ''
+    return (value, file["display_name"], file["name"])
+
+def _sorted_files(snapshot, sort):
+    order = snapshot["orders"].get(sort)
+    if order is None:
+        files = sorted(snapshot["files"], key=lambda file: _file_sort_key(file, sort))
+        order = ([_file_sort_key(file, sort) for file in files], files)
+        snapshot["orders"][sort] = order
+    return order
+
+def _parse_time(value):
+    """An ISO 8601 date or time as an aware datetime (naive means UTC), or None."""
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def _encode_cursor(sort, order, key):
+    raw = json.dumps([sort, order, list(key)], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor, sort, order):
+    """The sort key a cursor continues after, or (None, error)."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, cursor_order, key = json.loads(raw)
+    except (ValueError, TypeError):
+        return None, "Invalid cursor"
+    if (cursor_sort, cursor_order) != (sort, order):
+        return None, "cursor belongs to a different sort order"
+    return tuple(key), None
+
+def _file_filter(args):
+    """A predicate for the filter query args of /api/files, or (None, error)."""
+    query = (args.get('q') or '').strip().lower()
+    mime_type = (args.get('mime_type') or '').strip().lower()
+    state = (args.get('state') or '').strip().lower()
+    bounds = {}
+    for arg in ('created_after', 'created_before'):
+        if args.get(arg):
+            bounds[arg] = _parse_time(args.get(arg))
+            if bounds[arg] is None:
+                return None, f"{arg} must be an ISO 8601 date or time"
+    after, before = bounds.get('created_after'), bounds.get('created_before')
+
+    def matches(file):
+        if query and query not in file["display_name"].lower():
+            return False
+        if mime_type:
+            file_mime = (file["mime_type"] or '').lower()
+            # "text/" matches every text type
+            if file_mime != mime_type and not (mime_type.endswith('/') and file_mime.startswith(mime_type)):
+                return False
+        if state and state not in (file["state"] or '').lower():
+            return False
+        if after or before:
+            created = _parse_time(file["create_time"]) if file["create_time"] else None
+            if created is None or (after and created < after) or (before and created >= before):
+                return False
+        return True
+    return matches, None
+
+def _file_listing(store_key, args, reconciled=False):
+    """One page of a store's files for /api/files, as (page, error).
+
+    Query args: sort (one of FILE_SORT_FIELDS), order (asc or desc), limit,
+    cursor (the previous page's next_cursor), q (name substring), mime_type
+    (exact, or a prefix ending in '/'), state (substring), created_after and
+    created_before (ISO 8601), and refresh=1 to reconcile with the remote
+    store first (skipped when the caller already did: `reconciled`). Cursors
+    hold the last sort key, so pages stay consistent across snapshot rebuilds.
+    """
+    sort = args.get('sort') or 'display_name'
+    if sort not in FILE_SORT_FIELDS:
+        return None, f"sort must be one of {', '.join(FILE_SORT_FIELDS)}"
+    order = args.get('order') or 'asc'
+    if order not in ('asc', 'desc'):
+        return None, "order must be asc or desc"
+    try:
+        limit = int(args.get('limit') or FILE_LIST_PAGE_SIZE)
+    except ValueError:
+        return None, "limit must be an integer"
+    limit = max(1, min(limit, FILE_LIST_MAX_PAGE_SIZE))
+    matches, error = _file_filter(args)
+    if error:
+        return None, error
+    after = None
+    if args.get('cursor'):
+        after, error = _decode_cursor(args.get('cursor'), sort, order)
+        if error:
+            return None, error
+
+    snapshot = _file_snapshot(
+        store_key, refresh=args.get('refresh', '').lower() in ('1', 'true', 'yes'), reconciled=reconciled
+    )
+    keys, files = _sorted_files(snapshot, sort)
+    matching = [i for i, file in enumerate(files) if matches(file)]
+    try:
+        if order == 'asc':
+            start = bisect_left(matching, bisect_right(keys, after)) if after is not None else 0
+            page = matching[start:start + limit]
+            more = start + limit < len(matching)
+        else:
+            end = bisect_left(matching, bisect_left(keys, after)) if after is not None else len(matching)
+            page = matching[max(0, end - limit):end][::-1]
+            more = end > limit
+    except TypeError:  # A cursor key that does not compare with this sort's keys
+        return None, "Invalid cursor"
+    return {
+        "files": [files[i] for i in page],
+        "next_cursor": _encode_cursor(sort, order, keys[page[-1]]) if page and more else None,
+        "total": len(matching),
+        "store": store_key,
+        "sort": sort,
+        "order": order,
+        "snapshot_age_s": round(time.time() - snapshot["created_at"], 1),
+    }, None
+
+def _catalog_upload(store_key, local_path, config, operation):
+    """Record an uploaded document in the catalog.
+
+    If the upload operation does not name the new document, the store is
+    marked stale instead and reconciled on its next lookup.
+    """
+    name = getattr(getattr(operation, 'response', None), 'document_name', None)
+    if not name:
+        document_catalog.mark_stale(store_key)
+        return
+    metadata = {item['key']: item.get('string_value') for item in config.get('custom_metadata') or []}
+    document_catalog.upsert({
+        "name": name,
+        "store": store_key,
+        "display_name": config['display_name'],
+        "source_url": metadata.get('source_url'),
+        "content_hash": _file_sha256(local_path),
+        "size_bytes": os.path.getsize(local_path),
+        "mime_type": config.get('mime_type'),
+        "create_time": datetime.now(timezone.utc).isoformat(),
+        "metadata": metadata,
+    })
+
+_ingest_name_locks = {}
+_ingest_name_locks_lock = threading.Lock()
+
+def _ingest_file(job, file):
+    """Upload and index one file of an ingest job; returns the new document's name.
+
+    Save jobs (and files retried after a crash) first delete the store's
+    documents with the same name.
+    """
+    store_key = job["store"]
+    filename = file["filename"]
+    if not _ensure_store(store_key):
+        raise RuntimeError("Store not initialized")
+    deadline = Deadline(UPLOAD_DEADLINE_SECONDS)
+    with _ingest_name_locks_lock:
+        name_lock = _ingest_name_locks.setdefault((store_key, filename), threading.Lock())
+    # One job at a time per name, so a replacement cannot race another upload of it
+    with name_lock:
+        if file.get("replace"):
+            # The interrupted upload may have finished without reaching the catalog
+            _reconcile_catalog(store_key, deadline)
+        if job["options"].get("replace") or file.get("replace"):
+            _ensure_catalog([store_key])
+            for doc in document_catalog.find(store_key, filename):
+                _delete_document(doc["name"], deadline)
+                document_catalog.remove(doc["name"])
+        operation = _upload_document(
+            file["local_path"], file["config"], label=filename, deadline=deadline, store_key=store_key
+        )
+        _catalog_upload(store_key, file["local_path"], file["config"], operation)
+    _index_local_file(store_key, filename)
+    return getattr(getattr(operation, 'response', None), 'document_name', None)
+
+def _ingest_finished(job):
+    if any(file["status"] == "succeeded" for file in job["files"]):
+        _bump_kb_revision()
+
+ingest_jobs = JobQueue(
+    _ingest_file, INGEST_JOURNAL_FOLDER,
+    workers=INGEST_WORKERS,
+    max_pending=INGEST_MAX_PENDING_JOBS,
+    on_finish=_ingest_finished,
+    retention_hours=float(os.getenv("INGEST_JOB_RETENTION_HOURS", "24")),
+)
+
+def _submit_ingest(kind, store_key, files, options=None, created=()):
+    """Queue an ingest job for local copies that were just written.
+
+    Callers check ingest_jobs.check_capacity() before writing; if the queue
+    filled up in between, the copies in `created` (paths that did not exist
+    before) are removed so none is left behind without a job.
+    """
+    try:
+        return ingest_jobs.submit(kind, store_key, files, options)
+    except JobQueueFull:
+        for path in created:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+
+def _job_accepted_body(job, body):
+    """`body` plus the ingest job and the URLs to follow it."""
+    status_url = f"/api/jobs/{job['id']}"
+    return dict(body, job_id=job["id"], job=job, status_url=status_url, events_url=f"{status_url}/events")
+
+def _job_accepted(job, body):
+    """The 202 response for a queued ingest job."""
+    body = _job_accepted_body(job, body)
+    return jsonify(body), 202, {'Location': body["status_url"]}
 
 @app.route('/api/files', methods=['GET'])
+@_admission_controlled(read_lane)
 def list_files():
-    """Lists files in the current FileSearchStore with metadata."""
-    if not current_store:
+    """Lists one page of files in a knowledge base's FileSearchStore (?store=, default store) with metadata.
+
+    See _file_listing for paging, sorting and filtering.
+    """
+    store_key, error = _requested_store(request.args.get('store'))
+    if error:
+        return jsonify({"error": error}), 404
+    if not _ensure_store(store_key):
         return jsonify({"error": "Store not initialized"}), 500
     
     try:
-        files = []
-        documents_pager = client.file_search_stores.documents.list(
-                parent=current_store.name
-            )
-
-        for doc in documents_pager:
-            files.append({
-                "name": doc.name,
-                "display_name": doc.display_name,
-                "create_time": doc.create_time,
-                "size_bytes": getattr(doc, 'size_bytes', 0),
-                "mime_type": getattr(doc, 'mime_type', 'unknown'),
-                "state": str(doc.state) if hasattr(doc, 'state') else 'unknown'
-            })
-        return jsonify(files)
+        page, error = _file_listing(store_key, request.args)
+        if error:
+            return jsonify({"error": error}), 400
+        return jsonify(page)
     except Exception as e:
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
 
 @app.route('/api/files/<path:file_id>', methods=['GET'])
+@_admission_controlled(read_lane)
 def get_file_details(file_id):
     """Retrieves full details for a specific file in the FileSearchStore."""
-    if not current_store:
+    if not _ensure_stores(KNOWLEDGE_BASES):
         return jsonify({"error": "Store not initialized"}), 500
     
     try:
-        doc = client.file_search_stores.documents.get(name=file_id)
+        doc = _get_document(file_id)
         
         # Convert CustomMetadata list to a flat dictionary for JSON serialization and easier UI display
         custom_meta_dict = {}
@@ -363,15 +1609,23 @@ def get_file_details(file_id):
             "size_bytes": getattr(doc, 'size_bytes', 0),
             "mime_type": getattr(doc, 'mime_type', 'unknown'),
             "state": str(doc.state) if hasattr(doc, 'state') else 'unknown',
-            "custom_metadata": custom_meta_dict if custom_meta_dict else None
+            "custom_metadata": custom_meta_dict if custom_meta_dict else None,
+            "store": _store_key_for_document(doc.name)
         })
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
 
 @app.route('/api/upload', methods=['POST'])
+@_admission_controlled(admin_lane)
 def upload_file():
-    """Uploads a file to the FileSearchStore and saves a local copy."""
-    if not current_store:
+    """Saves a local copy of a file and queues its upload to a knowledge base's FileSearchStore.
+
+    Returns 202 with the ingest job (see /api/jobs/<id>).
+    """
+    store_key, error = _requested_store(request.values.get('store'))
+    if error:
+        return jsonify({"error": error}), 404
+    if not _ensure_store(store_key):
         return jsonify({"error": "Store not initialized"}), 500
     
     if 'file' not in request.files:
@@ -380,50 +1634,49 @@ def upload_file():
     file = request.files['file']
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
+    explicit, error = parse_metadata({key: request.form[key] for key in METADATA_KEYS if key in request.form})
+    if error:
+        return jsonify({"error": error}), 400
 
     try:
         print("Starting UPLOADING... ", file.filename)
+        ingest_jobs.check_capacity()
         
         # Save local copy
-        local_path = os.path.join(UPLOAD_FOLDER, file.filename)
+        local_path = os.path.join(_upload_folder(store_key), file.filename)
+        created = [] if os.path.exists(local_path) else [local_path]
         file.save(local_path)
         
-        # Extract URL for citation
-        source_url = extract_url_from_file(local_path)
-        
-        # Upload and index (re-open the file for stream)
-        with open(local_path, 'rb') as f:
-            config = {
-                'display_name': file.filename,
-                'mime_type': file.content_type
-            }
-            if source_url:
-                config['custom_metadata'] = [{'key': 'source_url', 'string_value': source_url}]
-                
-            uploaded_operation = client.file_search_stores.upload_to_file_search_store(
-                file_search_store_name=current_store.name,
-                file=f,
-                config=config
-            )
-            
-            while not uploaded_operation.done:
-                time.sleep(1)
-                print("UPLOADING...")
-                uploaded_operation = client.operations.get(uploaded_operation)
-
-        print("UPLOAD finished")
-        
-        return jsonify({
-            "message": "File upload successful",
-            "file_name": file.filename
+        # Upload and index, tagged with source URL (for citations) and metadata
+        config = {
+            'display_name': file.filename,
+            'mime_type': file.content_type,
+            'custom_metadata': _document_custom_metadata(local_path, file.filename, explicit)
+        }
+        job = _submit_ingest("upload", store_key, [
+            {"filename": file.filename, "local_path": local_path, "config": config}
+        ], created=created)
+        print(f"UPLOAD queued as job {job['id']}")
+
+        return _job_accepted(job, {
+            "message": "File upload queued",
+            "file_name": file.filename,
+            "store": store_key
         })
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
 
 @app.route('/api/upload-tar', methods=['POST'])
+@_admission_controlled(admin_lane)
 def upload_tar_file():
-    """Uploads a .tar.gz file, extracts it, adds files to FileSearchStore, and saves local copies."""
-    if not current_store:
+    """Extracts a .tar.gz file into local copies and queues their upload to a knowledge base's FileSearchStore.
+
+    Returns 202 with a single ingest job covering every file in the archive.
+    """
+    store_key, error = _requested_store(request.values.get('store'))
+    if error:
+        return jsonify({"error": error}), 404
+    if not _ensure_store(store_key):
         return jsonify({"error": "Store not initialized"}), 500
     
     if 'file' not in request.files:
@@ -435,9 +1688,14 @@ def upload_tar_file():
 
     if not (file.filename.endswith('.tar.gz') or file.filename.endswith('.tgz')):
         return jsonify({"error": "Invalid file type. Please upload a .tar.gz file"}), 400
+    # Explicit metadata applies to every file in the archive
+    explicit, error = parse_metadata({key: request.form[key] for key in METADATA_KEYS if key in request.form})
+    if error:
+        return jsonify({"error": error}), 400
 
     try:
         print(f"Starting TAR UPLOAD... {file.filename}")
+        ingest_jobs.check_capacity()
         with tempfile.TemporaryDirectory() as temp_dir:
             tar_path = os.path.join(temp_dir, file.filename)
             file.save(tar_path)
@@ -447,7 +1705,8 @@ def upload_tar_file():
             
             os.remove(tar_path)
             
-            uploaded_files = []
+            queued_files = []
+            created = []
             for root, dirs, files in os.walk(temp_dir):
                 for filename in files:
                     file_path = os.path.join(root, filename)
@@ -460,115 +1719,161 @@ def upload_tar_file():
                         mime_type = 'text/plain'
 
                     # Save local copy
-                    local_path = os.path.join(UPLOAD_FOLDER, filename)
+                    local_path = os.path.join(_upload_folder(store_key), filename)
+                    if not os.path.exists(local_path):
+                        created.append(local_path)
                     shutil.copy2(file_path, local_path)
 
-                    # Extract URL for citation
-                    source_url = extract_url_from_file(local_path)
-
-                    print(f"Uploading {filename} (type: {mime_type})...")
-                    
-                    with open(local_path, 'rb') as f:
-                        config = {
-                            'display_name': filename,
-                            'mime_type': mime_type
-                        }
-                        if source_url:
-                            config['custom_metadata'] = [{'key': 'source_url', 'string_value': source_url}]
-
-                        uploaded_operation = client.file_search_stores.upload_to_file_search_store(
-                            file_search_store_name=current_store.name,
-                            file=f,
-                            config=config
-                        )
-                        
-                        while not uploaded_operation.done:
-                            time.sleep(1)
-                            print(f"UPLOADING {filename}...")
-                            uploaded_operation = client.operations.get(uploaded_operation)
-                    
-                    uploaded_files.append(filename)
-                    print(f"Finished uploading {filename}")
-
-            return jsonify({
-                "message": f"Successfully uploaded {len(uploaded_files)} files from archive",
-                "files": uploaded_files
+                    config = {
+                        'display_name': filename,
+                        'mime_type': mime_type,
+                        'custom_metadata': _document_custom_metadata(local_path, filename, explicit)
+                    }
+                    queued_files.append({"filename": filename, "local_path": local_path, "config": config})
+
+            job = _submit_ingest("tar", store_key, queued_files, created=created)
+            print(f"TAR UPLOAD of {len(queued_files)} files queued as job {job['id']}")
+            return _job_accepted(job, {
+                "message": f"Queued {len(queued_files)} files from archive for upload",
+                "files": [entry["filename"] for entry in queued_files],
+                "store": store_key
             })
             
     except Exception as e:
         print(f"Error during tar upload: {e}")
         print(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
 
 @app.route('/api/files/<path:file_id>', methods=['DELETE'])
+@_admission_controlled(admin_lane)
 def delete_file(file_id):
-    """Deletes a file from the FileSearchStore and its local copy."""
-    if not current_store:
+    """Deletes a file from its FileSearchStore and its local copy."""
+    if not _ensure_stores(KNOWLEDGE_BASES):
         return jsonify({"error": "Store not initialized"}), 500
+    store_key = _store_key_for_document(file_id)
+    if store_key is None:
+        return jsonify({"error": "File does not belong to a configured knowledge base"}), 404
     
     try:
         # Get details first to find the display name
-        doc = client.file_search_stores.documents.get(name=file_id)
+        doc = _get_document(file_id)
         display_name = doc.display_name
         
         # Delete from store
-        client.file_search_stores.documents.delete(name=file_id, config={'force': True})
+        _delete_document(file_id)
         
         # Delete local copy
-        local_path = os.path.join(UPLOAD_FOLDER, display_name)
+        local_path = os.path.join(_upload_folder(store_key), display_name)
         if os.path.exists(local_path):
             os.remove(local_path)
-            
+        _unindex_local_files(lambda doc_id: doc_id == (store_key, display_name))
+        # Last, so other workers rescanning on the catalog change no longer see the copy
+        document_catalog.remove(file_id)
+
+        _bump_kb_revision()
         return jsonify({"message": "File deleted successfully"})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
 
 @app.route('/api/store/clear', methods=['POST'])
+@_admission_controlled(admin_lane)
 def clear_store():
-    """Deletes the entire FileSearchStore and all local copies."""
-    global current_store
-    if not current_store:
+    """Deletes one knowledge base's FileSearchStore (?store=, default store) and its local copies.
+
+    Other knowledge bases are untouched, so the corpus can be re-indexed
+    one shard at a time.
+    """
+    store_key, error = _requested_store(request.values.get('store'))
+    if error:
+        return jsonify({"error": error}), 404
+    if not _ensure_store(store_key):
         return jsonify({"error": "Store not initialized"}), 500
     
     try:
         # Delete the store from Google with force=True to handle non-empty stores
-        print(f"Deleting store (force): {current_store.name}")
-        client.file_search_stores.delete(name=current_store.name, config={'force': True})
+        store_name = _store_name(store_key)
+        print(f"Deleting store (force): {store_name}")
+        upstream.call(
+            "stores",
+            lambda timeout: get_client().file_search_stores.delete(
+                name=store_name, config=_with_timeout({'force': True}, timeout)
+            ),
+            _current_deadline()
+        )
         
         # Clear the local uploads folder
-        if os.path.exists(UPLOAD_FOLDER):
-            shutil.rmtree(UPLOAD_FOLDER)
-            os.makedirs(UPLOAD_FOLDER)
+        upload_folder = _upload_folder(store_key)
+        if os.path.exists(upload_folder):
+            shutil.rmtree(upload_folder)
+            os.makedirs(upload_folder)
+        _unindex_local_files(lambda doc_id: doc_id[0] == store_key)
+        document_catalog.clear_store(store_key)
             
-        # Re-initialize/Re-create the store
-        current_store = get_or_create_store()
+        # Re-initialize/Re-create the store (lazily, if this attempt fails)
+        with _store_lock:
+            _stores[store_key].update(store=None, failures=0, next_attempt=0.0)
+        _ensure_store(store_key)
+        _bump_kb_revision()
         
-        return jsonify({"message": "Knowledge base cleared successfully"})
+        return jsonify({"message": "Knowledge base cleared successfully", "store": store_key})
     except Exception as e:
         print(f"Error clearing store: {e}")
         print(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
 
 @app.route('/api/files/content/<filename>')
+@_admission_controlled(read_lane)
 def get_file_content(filename):
-    """Serves the content of a locally stored file."""
+    """Serves the content of a locally stored file (?store=, default store).
+
+    ?lines=START-END returns just that (1-based, inclusive) line range as
+    plain text, which is what line-anchored citations link to.
+    """
+    store_key, error = _requested_store(request.args.get('store'))
+    if error:
+        return jsonify({"error": error}), 404
+    line_range = request.args.get('lines')
+    if line_range:
+        start, _, end = line_range.partition('-')
+        try:
+            start, end = int(start), int(end or start)
+        except ValueError:
+            return jsonify({"error": "lines must be START-END"}), 400
+        if start < 1 or end < start:
+            return jsonify({"error": "lines must be START-END"}), 400
+        try:
+            with open(safe_join(_upload_folder(store_key), filename), 'r', encoding='utf-8') as f:
+                lines = list(itertools.islice(f, start - 1, end))
+        except (OSError, TypeError, UnicodeDecodeError) as e:
+            return jsonify({"error": str(e)}), 404
+        return Response("".join(lines), mimetype='text/plain')
     try:
-        return send_from_directory(UPLOAD_FOLDER, filename)
+        return send_from_directory(_upload_folder(store_key), filename)
     except Exception as e:
         return jsonify({"error": str(e)}), 404
 
 @app.route('/api/files/save', methods=['POST'])
+@_admission_controlled(admin_lane)
 def save_file():
-    """Saves a new or edited file locally and uploads it to the FileSearchStore."""
-    if not current_store:
+    """Saves a new or edited file locally and queues its upload to a knowledge base's FileSearchStore.
+
+    Returns 202 with the ingest job (see /api/jobs/<id>).
+    """
+    data = request.json
+    store_key, error = _requested_store(data.get('store') or request.args.get('store'))
+    if error:
+        return jsonify({"error": error}), 404
+    if not _ensure_store(store_key):
         return jsonify({"error": "Store not initialized"}), 500
     
-    data = request.json
     filename = data.get('filename')
     content = data.get('content')
     
     if not filename or content is None:
         return jsonify({"error": "Missing filename or content"}), 400
+    explicit, error = parse_metadata(data.get('metadata'))
+    if error:
+        return jsonify({"error": error}), 400
 
     # Ensure filename doesn't have path traversal and has a valid extension
     filename = os.path.basename(filename)
@@ -576,49 +1881,81 @@ def save_file():
         filename += '.txt'
 
     try:
-        local_path = os.path.join(UPLOAD_FOLDER, filename)
+        ingest_jobs.check_capacity()
+        local_path = os.path.join(_upload_folder(store_key), filename)
+        created = [] if os.path.exists(local_path) else [local_path]
         
         # Save local copy
         with open(local_path, 'w', encoding='utf-8') as f:
             f.write(content)
         
-        # Extract URL for citation
-        source_url = extract_url_from_file(local_path)
-        
-        # Upload to Gemini (if it already exists in the store, we should ideally delete the old one first, 
-        # but for simplicity we'll just upload and the store will handle it or we can let the user delete it)
-        # To be clean, let's check if it exists and delete it if so
-        documents_pager = client.file_search_stores.documents.list(parent=current_store.name)
-        for doc in documents_pager:
-            if doc.display_name == filename:
-                client.file_search_stores.documents.delete(name=doc.name, config={'force': True})
-                break
-
-        with open(local_path, 'rb') as f:
-            config = {
-                'display_name': filename,
-                'mime_type': 'text/plain'
-            }
-            if source_url:
-                config['custom_metadata'] = [{'key': 'source_url', 'string_value': source_url}]
-
-            uploaded_operation = client.file_search_stores.upload_to_file_search_store(
-                file_search_store_name=current_store.name,
-                file=f,
-                config=config
-            )
-            
-            while not uploaded_operation.done:
-                time.sleep(1)
-                uploaded_operation = client.operations.get(uploaded_operation)
-
-        return jsonify({
-            "message": "File saved and uploaded successfully",
-            "filename": filename
+        config = {
+            'display_name': filename,
+            'mime_type': 'text/plain',
+            'custom_metadata': _document_custom_metadata(local_path, filename, explicit)
+        }
+        # The job replaces any existing document with the same name
+        job = _submit_ingest("save", store_key, [
+            {"filename": filename, "local_path": local_path, "config": config}
+        ], options={"replace": True}, created=created)
+        return _job_accepted(job, {
+            "message": "File saved and queued for upload",
+            "filename": filename,
+            "store": store_key
         })
     except Exception as e:
         print(f"Error saving file: {e}")
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Returns the most recent ingest jobs, newest first (?limit=, default 20)."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 200))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify({"jobs": ingest_jobs.recent(limit), "stats": ingest_jobs.stats()})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Returns an ingest job with the status of each of its files."""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Streams an ingest job's progress as Server-Sent Events.
+
+    Emits a `progress` event with the job (as /api/jobs/<id>) on every
+    change, then a `done` event once all its files have finished.
+    """
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        current = job
+        while current["status"] not in JOB_FINISHED:
+            yield _sse_event("progress", current)
+            latest = current
+            while latest is not None and latest["version"] == current["version"]:
+                latest = ingest_jobs.wait(job_id, current["version"], timeout=15)
+                if latest is not None and latest["version"] == current["version"]:
+                    # Comment frames keep proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+            if latest is None:
+                yield _sse_event("error", {"error": "Job not found"})
+                return
+            current = latest
+        yield _sse_event("done", current)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/api/system-instruction', methods=['GET'])
 def get_system_instruction():
@@ -636,7 +1973,8 @@ def get_all_system_instructions():
             "id": "default",
             "name": "Default",
             "instruction": SYSTEM_INSTRUCTION,
-            "is_default": True
+            "is_default": True,
+            "generation": dict(DEFAULT_GENERATION)
         }
     ]
     
@@ -646,7 +1984,8 @@ def get_all_system_instructions():
             "name": custom.get("name"),
             "instruction": custom.get("instruction"),
             "is_default": False,
-            "created_at": custom.get("created_at")
+            "created_at": custom.get("created_at"),
+            "generation": custom.get("generation") or {}
         })
     
     return jsonify({"instructions": result})
@@ -662,6 +2001,12 @@ def create_system_instruction():
         return jsonify({"error": "Name is required"}), 400
     if not instruction:
         return jsonify({"error": "Instruction is required"}), 400
+    generation, error = _parse_generation_settings(data.get('generation'))
+    if error:
+        return jsonify({"error": error}), 400
+    token_budget, error = _parse_token_budget(data.get('token_budget'))
+    if error:
+        return jsonify({"error": error}), 400
     
     custom_instructions = load_custom_instructions()
     
@@ -674,6 +2019,10 @@ def create_system_instruction():
         "instruction": instruction,
         "created_at": datetime.now().isoformat()
     }
+    if generation:
+        new_instruction["generation"] = generation
+    if token_budget:
+        new_instruction["token_budget"] = token_budget
     
     custom_instructions.append(new_instruction)
     
@@ -708,7 +2057,8 @@ def get_system_instruction_by_id(instruction_id):
             "id": "default",
             "name": "Default",
             "instruction": SYSTEM_INSTRUCTION,
-            "is_default": True
+            "is_default": True,
+            "generation": dict(DEFAULT_GENERATION)
         })
     
     custom_instructions = load_custom_instructions()
@@ -719,24 +2069,27 @@ def get_system_instruction_by_id(instruction_id):
                 "name": inst.get("name"),
                 "instruction": inst.get("instruction"),
                 "is_default": False,
-                "created_at": inst.get("created_at")
+                "created_at": inst.get("created_at"),
+                "generation": inst.get("generation") or {}
             })
     
     return jsonify({"error": "Instruction not found"}), 404
 
 @app.route('/api/fixtures', methods=['GET'])
+@_admission_controlled(read_lane)
 def list_fixtures_endpoint():
     """List all available test fixtures."""
     fixtures = list_fixtures()
-    return jsonify({"fixtures": fixtures})
+    return _conditional_json({"fixtures": fixtures}, _latest_mtime_path(FIXTURES_FOLDER))
 
 @app.route('/api/fixtures/<fixture_name>', methods=['GET'])
+@_admission_controlled(read_lane)
 def get_fixture(fixture_name):
     """Get a specific test fixture."""
     fixture = load_fixture(fixture_name)
     if not fixture:
         return jsonify({"error": "Fixture not found"}), 404
-    return jsonify(fixture)
+    return _conditional_json(fixture, os.path.join(FIXTURES_FOLDER, f"{fixture_name}.json"))
 
 @app.route('/api/fixtures', methods=['POST'])
 def save_fixture_endpoint():
@@ -763,18 +2116,55 @@ def save_fixture_endpoint():
     else:
         return jsonify({"error": "Failed to save fixture"}), 500
 
-def save_chat_history(conversation_id, messages):
-    """Save a chat conversation to disk."""
+# A conversation's history is loaded, changed and saved under its lock. The
+# conversations hash onto stripes: a thread lock each, plus a byte-range lock
+# on one byte of chat_history/.lock so worker processes exclude each other.
+CONVERSATION_LOCK_STRIPES = 64
+_conversation_locks = [threading.Lock() for _ in range(CONVERSATION_LOCK_STRIPES)]
+_conversation_lock_file = None
+_conversation_lock_file_lock = threading.Lock()
+
+@contextmanager
+def _conversation_lock(conversation_id):
+    """Hold a conversation's lock across a load, modify and save of its history."""
+    global _conversation_lock_file
+    stripe = int(hashlib.sha1(conversation_id.encode('utf-8')).hexdigest()[:8], 16) % CONVERSATION_LOCK_STRIPES
+    with _conversation_locks[stripe]:
+        if fcntl is None:
+            yield
+            return
+        with _conversation_lock_file_lock:
+            if _conversation_lock_file is None:
+                # Opened once and never closed: closing any descriptor of the
+                # file would drop every lock this process holds on it
+                _conversation_lock_file = open(os.path.join(CHAT_HISTORY_FOLDER, ".lock"), "a")
+        fcntl.lockf(_conversation_lock_file, fcntl.LOCK_EX, 1, stripe)
+        try:
+            yield
+        finally:
+            fcntl.lockf(_conversation_lock_file, fcntl.LOCK_UN, 1, stripe)
+
+def save_chat_history(conversation_id, messages, created_at=None, summary=None):
+    """Save a chat conversation to disk.
+
+    The file is replaced atomically, so a concurrent load never sees a
+    partly written conversation. Callers changing an existing conversation
+    hold its _conversation_lock().
+    """
     try:
         conversation_data = {
             "id": conversation_id,
-            "created_at": datetime.now().isoformat(),
+            "created_at": created_at or datetime.now().isoformat(),
             "messages": messages
         }
+        if summary:
+            conversation_data["summary"] = summary
         filename = f"{conversation_id}.json"
         filepath = os.path.join(CHAT_HISTORY_FOLDER, filename)
-        with open(filepath, 'w', encoding='utf-8') as f:
+        tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(conversation_data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, filepath)
         return True
     except Exception as e:
         print(f"Error saving chat history: {e}")
@@ -820,226 +2210,1110 @@ def list_chat_histories():
         print(f"Error listing chat histories: {e}")
         return []
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    """Asks a question grounded in the FileSearchStore."""
-    if not current_store:
-        return jsonify({"error": "Store not initialized"}), 500
-    
-    data = request.json
+VALID_OUTPUT_MODES = ['html', 'markdown', 'raw', 'phpbb']
+# Response fields carrying each rendered output format
+OUTPUT_FORMAT_FIELDS = {
+    'html': ('html',),
+    'markdown': ('markdown_formatted',),
+    'raw': ('raw', 'raw_citations'),
+    'phpbb': ('phpbb',),
+}
+# "local" answers with the best matching local passages instead of calling Gemini
+CHAT_MODES = ['grounded', 'local']
+
+def _fetch_doc_url_by_title(store_keys=None):
+    """Source URLs for every document in the given knowledge bases, from the document catalog."""
+    store_keys = store_keys or KNOWLEDGE_BASES
+    _ensure_catalog(store_keys)
+    return document_catalog.url_map(store_keys)
+
+def _build_grounding_supports(gm, answer_text, doc_url_by_title, snippets=None, locations=None):
+    """Convert grounding metadata into support dicts with citation URLs, snippet
+    ids and (with `locations` from _locate_chunks) line ranges.
+    """
+    grounding_supports = []
+    if not gm or not (hasattr(gm, 'grounding_supports') and gm.grounding_supports):
+        return grounding_supports
+    if snippets is None:
+        snippets = _capture_snippets(gm)
+    for support in gm.grounding_supports:
+        segment = getattr(support, 'segment', None)
+        if not segment:
+            continue
+        citation_urls = []
+        seen = set()
+        if support.grounding_chunk_indices and hasattr(gm, 'grounding_chunks'):
+            for chunk_idx in support.grounding_chunk_indices:
+                if chunk_idx >= len(gm.grounding_chunks):
+                    continue
+                chunk = gm.grounding_chunks[chunk_idx]
+                title = None
+                url = None
+                if hasattr(chunk, 'web') and chunk.web:
+                    title = getattr(chunk.web, 'title', None)
+                    url = getattr(chunk.web, 'uri', None)
+                elif hasattr(chunk, 'retrieved_context') and chunk.retrieved_context:
+                    rc = chunk.retrieved_context
+                    title = getattr(rc, 'title', None)
+                    url = doc_url_by_title.get(title) or getattr(rc, 'uri', None)
+                location = locations[chunk_idx] if locations else None
+                # If no URL but we have a title, create a localhost:// link
+                if not url and title:
+                    url = _local_link(f"localhost://{title}", location)
+                key = f"{title}|{url}"
+                if url and key not in seen:
+                    seen.add(key)
+                    citation_urls.append({
+                        "title": title,
+                        "url": url,
+                        "chunk_idx": chunk_idx,  # Track which chunk this citation comes from
+                        "snippet": snippets[chunk_idx],
+                        "location": location,
+                    })
+        grounding_supports.append({
+            "segment": {
+                "start_index": getattr(segment, "start_index", 0),
+                "end_index": getattr(segment, "end_index", len(answer_text)),
+            },
+            "citation_urls": citation_urls,
+            "grounding_chunk_indices": support.grounding_chunk_indices if hasattr(support, 'grounding_chunk_indices') else [],
+        })
+    return grounding_supports
+
+def _build_answer_payload(answer_text, grounding_supports, output_mode, formats=None):
+    """Render the answer in the requested formats (default: just output_mode)
+    and return the shared response/history fields.
+
+    Other formats can be rendered later from the stored raw answer and
+    supports (see render_chat_history_message).
+    """
+    # Rendering merges supports in place; answers may be shared with the cache
+    # or with coalesced requests, so render from a private copy.
+    grounding_supports = copy.deepcopy(grounding_supports)
+    payload = {
+        # Same text the html renderer returns (line endings normalized)
+        "answer": "\n".join((answer_text or "").splitlines()),
+        "answer_raw": answer_text,
+        "output_mode": output_mode,  # The initially requested mode
+        "formats": list(formats or [output_mode]),
+    }
+    for output_format in payload["formats"]:
+        rendered = render_markdown_with_citations(answer_text, grounding_supports, output_format)
+        # blocks, supports and chunks are the same for every format
+        payload.setdefault("blocks", rendered["blocks"])
+        payload.setdefault("supports", rendered["supports"])
+        payload.setdefault("chunks", rendered["chunks"])  # Map of chunk_idx -> {title, url, citation_num}
+        for field in OUTPUT_FORMAT_FIELDS[output_format]:
+            payload[field] = rendered.get(field, "" if field == "raw_citations" else rendered["markdown"])
+    return payload
+
+def _supports_from_rendered(supports):
+    """Rebuild grounding supports from rendered ones, for history saved without them."""
+    return [
+        {
+            "segment": {"start_index": support["start_offset"], "end_index": support["end_offset"]},
+            "citation_urls": [
+                {"title": url.get("title"), "url": url.get("url"), "chunk_idx": url.get("chunk_idx")}
+                for url in support.get("urls", [])
+            ],
+            "grounding_chunk_indices": [url.get("chunk_idx") for url in support.get("urls", [])],
+        }
+        for support in supports or []
+    ]
+
+def _append_chat_history(conversation_id, message, payload, grounding_supports=None, usage=None):
+    """Append a user message and the bot answer to a stored conversation.
+
+    The grounding supports are kept with the answer so other output formats
+    can be rendered on demand, and `usage` records the tokens it took.
+    Returns the index of the bot message.
+    """
+    user_message = {
+        "role": "user",
+        "message": message,
+        "timestamp": datetime.now().isoformat()
+    }
+    bot_message = {
+        "role": "bot", **payload, "grounding_supports": grounding_supports or [],
+        "timestamp": datetime.now().isoformat()
+    }
+    if usage:
+        bot_message["usage"] = usage
+
+    with _conversation_lock(conversation_id):
+        # Load existing conversation or create new
+        conversation = load_chat_history(conversation_id)
+        if not conversation:
+            conversation = {
+                "id": conversation_id,
+                "created_at": datetime.now().isoformat(),
+                "messages": []
+            }
+        conversation["messages"].extend([user_message, bot_message])
+        save_chat_history(
+            conversation_id, conversation["messages"],
+            conversation.get("created_at"), conversation.get("summary")
+        )
+    return len(conversation["messages"]) - 1
+
+def _summarize_turns(summary, turns, deadline=None):
+    """Fold turns into the rolling conversation summary with a fast model."""
+    try:
+        response = upstream.call(
+            "summarize",
+            lambda timeout: get_client().models.generate_content(
+                model=CHAT_SUMMARY_MODEL,
+                contents=summary_prompt(summary, turns, CHAT_SUMMARY_TOKENS),
+                config=_with_timeout({
+                    'max_output_tokens': CHAT_SUMMARY_TOKENS * 2,
+                    'thinking_config': {'thinking_budget': 0},
+                }, timeout)
+            ),
+            deadline or _current_deadline()
+        )
+        if response.text and response.text.strip():
+            return clip_to_tokens(response.text.strip(), CHAT_SUMMARY_TOKENS)
+    except Exception as e:
+        print(f"Warning: Could not summarize conversation: {e}")
+    return extractive_summary(summary, turns, CHAT_SUMMARY_TOKENS)
+
+def _conversation_context(conversation_id, message, deadline=None):
+    """Earlier turns of a conversation as Gemini contents for a follow-up question.
+
+    Recent turns are kept verbatim within CHAT_CONTEXT_TOKENS; older turns
+    are folded into a summary stored with the conversation, so each turn is
+    summarized once. Returns None when there is no earlier turn, otherwise
+    {"contents", "recent_turns", "summarized_turns", "tokens"}.
+    """
+    if not conversation_id:
+        return None
+    conversation = load_chat_history(conversation_id)
+    turns = conversation_turns(conversation.get("messages", [])) if conversation else []
+    if not turns:
+        return None
+
+    summary = conversation.get("summary") or {}
+    summary_text = summary.get("text", "")
+    covered = min(summary.get("turns", 0), len(turns))
+    start = recent_turns_start(turns, message, CHAT_CONTEXT_TOKENS - CHAT_SUMMARY_TOKENS, covered)
+    if start > covered:
+        summary_text = _summarize_turns(summary_text, turns[covered:start], deadline)
+        # Turns may have been added while summarizing: store only the summary
+        with _conversation_lock(conversation_id):
+            current = load_chat_history(conversation_id)
+            if current and (current.get("summary") or {}).get("turns", 0) < start:
+                save_chat_history(
+                    conversation_id, current["messages"], current.get("created_at"),
+                    {"text": summary_text, "turns": start}
+                )
+
+    contents = build_contents(turns[start:], message, summary_text)
+    return {
+        "contents": contents,
+        "recent_turns": len(turns) - start,
+        "summarized_turns": start,
+        "tokens": sum(estimate_tokens(c["parts"][0]["text"]) for c in contents),
+    }
+
+def _store_names(generation=None):
+    """Resource names of the stores a chat request searches."""
+    return [_store_name(key) for key in (generation or DEFAULT_GENERATION).get('stores') or KNOWLEDGE_BASES]
+
+def _generation_config(instruction, timeout=None, generation=None):
+    """Build the generation config used for grounded chat requests."""
+    generation = generation or DEFAULT_GENERATION
+    thinking_config = None
+    if generation.get('thinking_budget') is not None:
+        thinking_config = types.ThinkingConfig(thinking_budget=generation['thinking_budget'])
+    return types.GenerateContentConfig(
+        http_options=types.HttpOptions(timeout=max(1, int(timeout * 1000))) if timeout is not None else None,
+        system_instruction=instruction,
+        temperature=generation.get('temperature'),
+        max_output_tokens=generation.get('max_output_tokens'),
+        thinking_config=thinking_config,
+        tools=[
+            types.Tool(
+                file_search=types.FileSearch(
+                    file_search_store_names=_store_names(generation),
+                    metadata_filter=generation.get('metadata_filter')
+                )
+            )
+        ]
+    )
+
+def _parse_chat_request(data):
+    """Extract and validate the common chat request fields.
+
+    Returns (params, error); error is None when valid.
+    """
     message = data.get('message')
     custom_instruction = data.get('system_instruction', '').strip()
-    test_mode = data.get('test_mode', False)
-    fixture_name = data.get('fixture_name')
-    save_fixture_name = data.get('save_fixture')
     output_mode = data.get('output_mode', 'html')  # Default to 'html'
-    
+
     # Validate output_mode
-    valid_modes = ['html', 'markdown', 'raw', 'phpbb']
-    if output_mode not in valid_modes:
+    if output_mode not in VALID_OUTPUT_MODES:
         output_mode = 'html'
-    
+    # Formats to render besides output_mode; others can be rendered on demand
+    formats = data.get('formats') or []
+    if isinstance(formats, str):
+        formats = formats.split(',')
+    if not isinstance(formats, list) or any(f not in VALID_OUTPUT_MODES for f in formats):
+        return None, f"formats must be a list of: {', '.join(VALID_OUTPUT_MODES)}"
+    formats = [output_mode] + [f for f in VALID_OUTPUT_MODES if f in formats and f != output_mode]
+
     if not message:
-        return jsonify({"error": "No message provided"}), 400
+        return None, "No message provided"
+    mode = data.get('mode') or 'grounded'
+    if mode not in CHAT_MODES:
+        return None, f"mode must be one of {', '.join(CHAT_MODES)}"
+    filters, error = parse_filters(data.get('filters'))
+    if error:
+        return None, error
+    store_keys, error = _parse_store_selection(data.get('stores'))
+    if error:
+        return None, error
+
+    # Use the custom instruction if provided, otherwise the selected profile's
+    profile_id, instruction, overrides, error = _resolve_profile(data.get('instruction_id'), custom_instruction)
+    if error:
+        return None, error
+    generation, routed = _route_generation(message, dict(DEFAULT_GENERATION, **overrides), 'model' in overrides)
+    # Like the metadata filter below, the searched stores are part of the
+    # generation settings so that cached answers are kept per selection
+    generation = dict(generation, stores=store_keys)
+    if filters:
+        # The retrieval filter travels with the generation settings so that
+        # cache, similarity and coalescing keys account for it
+        generation = dict(generation, metadata_filter=metadata_filter(filters))
+    return {
+        "message": message,
+        "instruction": instruction,
+        "output_mode": output_mode,
+        "formats": formats,
+        "conversation_id": data.get('conversation_id'),
+        "mode": mode,
+        "profile": profile_id,
+        "generation": generation,
+        "routed": routed,
+        "budget": None,
+    }, None
+
+def _chat_stores_ready(params):
+    """Resolve the stores a chat request searches.
+
+    If they cannot be resolved (e.g. Gemini is down), the request is
+    downgraded to local mode when LOCAL_FALLBACK_ENABLED. Returns the
+    params to use, or None if the request cannot be served.
+    """
+    if params["mode"] == "local" or _ensure_stores(params["generation"]["stores"]):
+        return params
+    if LOCAL_FALLBACK_ENABLED:
+        print("Knowledge base stores unavailable; answering from local search")
+        return dict(params, mode="local")
+    return None
 
-    # Use the custom instruction if provided, otherwise fall back to base
-    instruction = custom_instruction if custom_instruction else SYSTEM_INSTRUCTION
+def _profile_token_budget(profile_id):
+    """The (soft, hard) token budgets of an instruction profile."""
+    profile = next((p for p in load_custom_instructions() if p.get("id") == profile_id), None)
+    budget = (profile or {}).get("token_budget") or {}
+    return budget.get("soft", TOKEN_BUDGET_SOFT), budget.get("hard", TOKEN_BUDGET_HARD)
+
+def _budget_state(profile_id):
+    """The token budget of a profile and how much of it is used."""
+    soft, hard = _profile_token_budget(profile_id)
+    used = token_ledger.used(profile_id, TOKEN_BUDGET_WINDOW_HOURS)
+    state = "ok"
+    if hard and used >= hard:
+        state = "hard"
+    elif soft and used >= soft:
+        state = "soft"
+    return {"soft": soft, "hard": hard, "window_hours": TOKEN_BUDGET_WINDOW_HOURS, "used": used, "state": state}
+
+def _apply_token_budget(params):
+    """Enforce the profile's token budget on a parsed chat request.
+
+    Over the soft budget the request is downgraded to CHAT_FAST_MODEL with
+    thinking disabled (params["budget"] is "soft"); over the hard budget
+    TokenBudgetExceeded is raised. Local mode uses no tokens.
+    """
+    if params["mode"] == "local":
+        return params
+    budget = _budget_state(params["profile"])
+    if budget["state"] == "hard":
+        raise TokenBudgetExceeded(
+            params["profile"], budget["used"], budget["hard"],
+            token_ledger.seconds_until_released(params["profile"], TOKEN_BUDGET_WINDOW_HOURS)
+        )
+    if budget["state"] == "soft":
+        generation = dict(params["generation"], model=CHAT_FAST_MODEL, thinking_budget=0)
+        return dict(params, generation=generation, budget="soft")
+    return params
+
+def _record_usage(params, answer, elapsed):
+    """Account the tokens of a freshly generated answer; returns the request's usage."""
+    usage = answer.get("usage")
+    if not usage:
+        return None
+    usage = dict(usage, model=params["generation"]["model"], elapsed_ms=round(elapsed * 1000, 1))
+    token_ledger.record(params["profile"], usage, params["conversation_id"])
+    return usage
+
+def _generate_grounded_answer(message, instruction, deadline=None, generation=None, contents=None):
+    """Call Gemini with file search and return the answer as a cacheable dict.
+
+    `contents` replaces the bare message for follow-ups in a conversation.
+    """
+    generation = generation or DEFAULT_GENERATION
+    response = upstream.call(
+        "generate_content",
+        lambda timeout: chat_hedge.call(lambda: get_client().models.generate_content(
+            model=generation['model'],
+            contents=contents or message,
+            config=_generation_config(instruction, timeout, generation)
+        )),
+        deadline or _current_deadline()
+    )
+    print("RESPONSE", response.text)
+    gm = None
+    if response.candidates and response.candidates[0].grounding_metadata:
+        gm = response.candidates[0].grounding_metadata
+    return _answer_from_response(
+        response.text or "", gm, store_keys=generation.get('stores'),
+        usage=usage_from_metadata(getattr(response, 'usage_metadata', None))
+    )
+
+def _answer_from_response(answer_text, gm, doc_url_by_title=None, store_keys=None, usage=None):
+    """Resolve citation URLs for a generated answer.
+
+    `usage` (token counts of the call) is kept with the answer.
+    """
+    grounding_supports = []
+    snippets = None
+    if gm:
+        if doc_url_by_title is None:
+            doc_url_by_title = _fetch_doc_url_by_title(store_keys)
+        snippets = _capture_snippets(gm)
+        locations = _locate_chunks(gm, snippets, store_keys)
+        grounding_supports = _build_grounding_supports(gm, answer_text, doc_url_by_title, snippets, locations)
+    return {
+        "answer_text": answer_text,
+        "grounding_supports": grounding_supports,
+        "grounding_metadata": _serialize_grounding_metadata(gm, snippets),
+        "usage": usage,
+    }
+
+def _coalescing_key(message, instruction, generation=None, contents=None):
+    """Identical in-flight questions share one upstream call under this key."""
+    # Store names change when a knowledge base is cleared and re-created
+    return hashlib.sha256(json.dumps([
+        ResponseCache.normalize_message(message), instruction, _store_names(generation),
+        _generation_fingerprint(generation or DEFAULT_GENERATION), contents
+    ]).encode('utf-8')).hexdigest()
+
+def _generate_coalesced_answer(message, instruction, deadline=None, generation=None, contents=None):
+    """Generate an answer, sharing the upstream call with identical in-flight requests.
+
+    Returns (answer, shared) where shared is True if another request made the call.
+    """
+    key = _coalescing_key(message, instruction, generation, contents)
+    return chat_inflight.do(
+        key, lambda: _generate_grounded_answer(message, instruction, deadline, generation, contents)
+    )
+
+def _refresh_cache_entry(key, message, instruction, generation=None):
+    """Regenerate a stale cache entry in the background."""
+    def run():
+        try:
+            answer, _ = _generate_coalesced_answer(message, instruction, generation=generation)
+            response_cache.put(key, answer)
+        except Exception as e:
+            print(f"Error refreshing cache entry: {e}")
+        finally:
+            response_cache.end_refresh(key)
+
+    if response_cache.begin_refresh(key):
+        threading.Thread(target=run, daemon=True).start()
+
+def _similarity_scope(instruction, generation=None):
+    """Near-duplicate matches are only shared within one instruction profile."""
+    fingerprint = _generation_fingerprint(generation or DEFAULT_GENERATION)
+    return hashlib.sha256(f"{fingerprint}|{instruction}".encode('utf-8')).hexdigest()
+
+def _cache_key(message, instruction, generation=None):
+    generation = generation or DEFAULT_GENERATION
+    return response_cache.make_key(message, instruction, generation['model'], _generation_fingerprint(generation))
+
+def _get_cached_answer(message, instruction, generation=None):
+    """Look up an answer in the response cache.
+
+    Falls back to the closest previously answered question in the same
+    instruction profile. Returns (key, answer, cache_state, match) where
+    match is None or {"question", "similarity"} for near-duplicate hits.
+    Stale entries are returned as-is and refreshed in the background.
+    """
+    key = _cache_key(message, instruction, generation)
+    answer, cache_state = response_cache.get(key)
+    match = None
+    if answer is None:
+        found = similarity_index.lookup(_similarity_scope(instruction, generation), message)
+        if found:
+            matched_key, matched_question, score = found
+            answer, matched_state = response_cache.get(matched_key, record_stats=False)
+            if answer is not None:
+                match = {"question": matched_question, "similarity": round(score, 3)}
+                cache_state = "similar"
+                if matched_state == "stale":
+                    _refresh_cache_entry(matched_key, matched_question, instruction, generation)
+                return key, answer, cache_state, match
+    if cache_state == "stale":
+        _refresh_cache_entry(key, message, instruction, generation)
+    return key, answer, cache_state, match
+
+def _local_answer(message, generation=None):
+    """An answer quoting the best matching local passages, without calling Gemini.
+
+    Each passage is one support citing its document, so the answer renders
+    with the same chunks/supports structure as a grounded one. Metadata
+    filters are not applied.
+    """
+    hits = _local_search(message, (generation or DEFAULT_GENERATION).get('stores'))
+    if not hits:
+        return {
+            "answer_text": "The assistant is unavailable right now, and no matching passages "
+                           "were found in the knowledge base.",
+            "grounding_supports": [],
+            "grounding_metadata": None,
+        }
+    answer_text = ("The assistant is unavailable right now, so here are the most relevant "
+                   "passages from the knowledge base:")
+    grounding_supports = []
+    for chunk_idx, hit in enumerate(hits):
+        answer_text += f"\n\n**{hit['title']}** (lines {hit['start_line']}-{hit['end_line']})\n\n"
+        quote = "\n".join(f"> {line}".rstrip() for line in hit["text"].splitlines())
+        location = {"store": hit["store"], "start_line": hit["start_line"], "end_line": hit["end_line"]}
+        grounding_supports.append({
+            "segment": {"start_index": len(answer_text), "end_index": len(answer_text) + len(quote)},
+            "citation_urls": [{
+                "title": hit["title"],
+                "url": hit["url"] or _local_link(f"localhost://{hit['title']}", location),
+                "chunk_idx": chunk_idx,
+                "snippet": snippet_store.put(hit["text"], hit["title"], hit["url"]),
+                "location": location,
+            }],
+            "grounding_chunk_indices": [chunk_idx],
+        })
+        answer_text += quote
+    return {"answer_text": answer_text, "grounding_supports": grounding_supports, "grounding_metadata": None}
+
+def _fallback_answer(message, instruction, error, generation=None):
+    """Serve a cached answer, even an expired one, when upstream is failing.
+
+    Without a usable cached answer, degrades to local passages if
+    LOCAL_FALLBACK_ENABLED. Returns (answer, match, cache_state) with
+    cache_state "fallback" or "local", or (None, None, None) if the error is
+    not an upstream availability problem.
+    """
+    if not (isinstance(error, UpstreamUnavailable) or _is_retryable_error(error)):
+        return None, None, None
+    key = _cache_key(message, instruction, generation)
+    answer, _ = response_cache.get(key, record_stats=False, allow_expired=True)
+    if answer is not None:
+        return answer, None, "fallback"
+    found = similarity_index.lookup(_similarity_scope(instruction, generation), message)
+    if found:
+        matched_key, matched_question, score = found
+        answer, _ = response_cache.get(matched_key, record_stats=False, allow_expired=True)
+        if answer is not None:
+            return answer, {"question": matched_question, "similarity": round(score, 3)}, "fallback"
+    if LOCAL_FALLBACK_ENABLED:
+        return _local_answer(message, generation), None, "local"
+    return None, None, None
+
+def _put_cached_answer(key, message, instruction, answer, generation=None):
+    """Store a fresh answer and index its question for near-duplicate lookups."""
+    response_cache.put(key, answer)
+    similarity_index.add(_similarity_scope(instruction, generation), message, key)
+
+def _bump_kb_revision():
+    """Invalidate cached answers after the knowledge base changes."""
+    revision = response_cache.bump_revision()
+    similarity_index.clear()
+    _invalidate_file_snapshots()
+    print(f"Knowledge base revision is now {revision}")
+    if CACHE_PREWARM_ENABLED:
+        cache_warmer.schedule("kb-change")
+
+def _prewarm_questions():
+    """Questions worth answering ahead of time, most frequently asked first.
+
+    Only the opening question of each conversation counts: follow-ups are
+    answered with their conversation and bypass the cache. Fixture
+    questions are always included.
+    """
+    counts = Counter()
+    asked_as = {}
+    for filename in os.listdir(CHAT_HISTORY_FOLDER):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(CHAT_HISTORY_FOLDER, filename), 'r', encoding='utf-8') as f:
+                messages = json.load(f).get("messages", [])
+        except (OSError, ValueError):
+            continue
+        first = next((m.get("message") for m in messages if m.get("role") == "user"), None)
+        if first:
+            key = ResponseCache.normalize_message(first)
+            counts[key] += 1
+            asked_as.setdefault(key, first)
+    questions = [
+        asked_as[key] for key, count in counts.most_common(CACHE_PREWARM_QUESTIONS)
+        if count >= CACHE_PREWARM_MIN_ASKED
+    ]
+    seen = set(counts)
+    for fixture in list_fixtures():
+        data = load_fixture(fixture["name"])
+        message = data.get("message") if data else None
+        if message and ResponseCache.normalize_message(message) not in seen:
+            seen.add(ResponseCache.normalize_message(message))
+            questions.append(message)
+    return questions
+
+def _prewarm_question(message):
+    """Answer one question through the cached chat pipeline (default profile, all stores).
+
+    Returns True if a new answer was generated and cached.
+    """
+    params, error = _parse_chat_request({"message": message})
+    if error:
+        raise ValueError(error)
+    params = _chat_stores_ready(params)
+    if params is None or params["mode"] == "local":
+        raise RuntimeError("Knowledge base stores are unavailable")
+    params = _apply_token_budget(params)
+    result = _answer_chat(params, Deadline(UPSTREAM_DEADLINE_SECONDS))
+    if result["cache"] in ("fallback", "local"):
+        raise RuntimeError("Upstream is unavailable")
+    # A generated answer was a cache miss (None when the cache was bypassed)
+    return result["cache"] in (None, "miss")
+
+# With a shared on-disk cache only one worker process warms it
+cache_warmer = CacheWarmer(
+    _prewarm_questions, _prewarm_question,
+    concurrency=int(os.getenv("CACHE_PREWARM_CONCURRENCY", "2")),
+    rate=float(os.getenv("CACHE_PREWARM_RATE", "1")),
+    delay=float(os.getenv("CACHE_PREWARM_DELAY_SECONDS", "30")),
+    lock_path=os.path.join(response_cache.persist_dir, ".prewarm.lock") if response_cache.persist_dir else None,
+)
+
+def _answer_from_fixture(fixture):
+    """Build an answer from a saved fixture (test mode)."""
+    # In test mode, skip doc lookup (URLs should be in fixture)
+    answer_text = fixture['response_text'] or ""
+    gm = _deserialize_grounding_metadata(fixture.get('grounding_metadata'))
+    snippets = _capture_snippets(gm)
+    return {
+        "answer_text": answer_text,
+        "grounding_supports": _build_grounding_supports(gm, answer_text, {}, snippets, _locate_chunks(gm, snippets)),
+    }
+
+def _context_summary(context):
+    """The context fields reported in chat responses."""
+    if not context:
+        return None
+    return {key: context[key] for key in ("recent_turns", "summarized_turns", "tokens")}
+
+def _finish_chat(params, answer, cache=None, match=None, usage=None, **extra):
+    """Render an answer, record it in the conversation and build the response body.
+
+    `usage` is the token usage of the request (None when nothing was generated).
+    """
+    payload = _build_answer_payload(
+        answer["answer_text"], answer["grounding_supports"], params["output_mode"], params["formats"]
+    )
+
+    # Save to chat history if conversation_id is provided
+    conversation_id = params["conversation_id"]
+    if conversation_id:
+        extra["message_index"] = _append_chat_history(
+            conversation_id, params["message"], payload, answer["grounding_supports"], usage
+        )
+
+    degraded = cache == "local"
+    response_data = dict(
+        payload, conversation_id=conversation_id, cache=cache, degraded=degraded,
+        profile=params["profile"], model=None if degraded else params["generation"]["model"],
+        routed=params["routed"], budget=params["budget"], usage=usage, **extra
+    )
+    if match:
+        response_data["matched_question"] = match["question"]
+        response_data["similarity"] = match["similarity"]
+    return response_data
+
+def _lookup_answer(params, deadline, use_cache=True, save_fixture_name=None):
+    """The transport-independent first half of answering a chat request.
+
+    Loads the conversation context and looks the question up in the answer
+    cache. Returns the state _settle_answer() needs; its "answer" is None
+    when the caller must generate one from its "contents".
+    """
+    message = params["message"]
+    generation = params["generation"]
+    lookup = {"answer": None, "cache": None, "match": None, "context": None, "contents": None,
+              "key": None, "use_cache": False, "save_fixture_name": save_fixture_name}
+    if params["mode"] == "local":
+        lookup.update(answer=_local_answer(message, generation), cache="local")
+        return lookup
+    context = _conversation_context(params["conversation_id"], message, deadline)
+    lookup["context"] = context
+    lookup["contents"] = context["contents"] if context else None
+    # Saving a fixture needs a fresh upstream response, and follow-ups
+    # depend on the conversation, so both bypass the answer cache
+    lookup["use_cache"] = use_cache and not save_fixture_name and lookup["contents"] is None
+    if lookup["use_cache"]:
+        lookup["key"], lookup["answer"], lookup["cache"], lookup["match"] = _get_cached_answer(
+            message, params["instruction"], generation
+        )
+    return lookup
+
+def _settle_answer(params, lookup, answer=None, coalesced=False, elapsed=None, error=None):
+    """The transport-independent second half of answering a chat request.
+
+    Called with the generated `answer` (and the seconds it took), with the
+    `error` generating it raised, or with neither on a cache hit. Falls back
+    to a stale or similar cached answer on error, records latency and usage,
+    caches and saves fixtures. Returns {"answer", "cache", "match",
+    "coalesced", "context", "usage"}; usage is None unless this request made
+    the upstream call.
+    """
+    message = params["message"]
+    instruction = params["instruction"]
+    generation = params["generation"]
+    cache_state = lookup["cache"]
+    match = lookup["match"]
+    usage = None
+    if error is not None:
+        answer, match, cache_state = _fallback_answer(message, instruction, error, generation)
+        if answer is None:
+            raise error
+        print(f"Serving {cache_state} fallback answer: {error}")
+    elif answer is not None:
+        profile_latency.record(params["profile"], generation["model"], elapsed)
+        # Coalesced requests share the tokens of the call they joined
+        if not coalesced:
+            usage = _record_usage(params, answer, elapsed)
+        if lookup["use_cache"]:
+            _put_cached_answer(lookup["key"], message, instruction, answer, generation)
+    else:
+        answer = lookup["answer"]
+
+    if lookup["save_fixture_name"] and cache_state != "local":
+        save_fixture(
+            lookup["save_fixture_name"], message, answer["answer_text"],
+            _deserialize_grounding_metadata(answer["grounding_metadata"])
+        )
+    return {"answer": answer, "cache": cache_state, "match": match, "coalesced": coalesced,
+            "context": lookup["context"], "usage": usage}
+
+def _answer_chat(params, deadline, use_cache=True, save_fixture_name=None):
+    """Answer a parsed chat request from the cache or with a grounded Gemini call.
+
+    Returns the result of _settle_answer().
+    """
+    lookup = _lookup_answer(params, deadline, use_cache, save_fixture_name)
+    if lookup["answer"] is not None:
+        return _settle_answer(params, lookup)
+    started = time.monotonic()
     try:
+        answer, coalesced = _generate_coalesced_answer(
+            params["message"], params["instruction"], deadline, params["generation"], lookup["contents"]
+        )
+    except Exception as e:
+        return _settle_answer(params, lookup, error=e)
+    return _settle_answer(params, lookup, answer, coalesced, time.monotonic() - started)
+
+@app.route('/api/chat', methods=['POST'])
+@_admission_controlled(chat_admission)
+def chat():
+    """Asks a question grounded in the selected knowledge bases (`stores`, default all)."""
+    data = request.json
+    params, error = _parse_chat_request(data)
+    if error:
+        return jsonify({"error": error}), 400
+    params = _chat_stores_ready(params)
+    if params is None:
+        return jsonify({"error": "Store not initialized"}), 500
+    test_mode = data.get('test_mode', False)
+    fixture_name = data.get('fixture_name')
+    save_fixture_name = data.get('save_fixture')
+    try:
+        params = _apply_token_budget(params)
         # Test mode: load from fixture instead of calling API
         if test_mode and fixture_name:
             fixture = load_fixture(fixture_name)
             if not fixture:
                 return jsonify({"error": f"Fixture '{fixture_name}' not found"}), 404
             
-            # Create a mock response object
-            class MockResponse:
-                def __init__(self, text, grounding_metadata):
-                    self.text = text
-                    self.candidates = [MockCandidate(grounding_metadata)] if grounding_metadata else []
-            
-            class MockCandidate:
-                def __init__(self, grounding_metadata):
-                    self.grounding_metadata = _deserialize_grounding_metadata(grounding_metadata)
-            
-            response = MockResponse(
-                fixture['response_text'],
-                fixture.get('grounding_metadata')
-            )
-        else:
-            # Normal mode: call the API
-            response = client.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=message,
-                config=types.GenerateContentConfig(
-                    system_instruction=instruction,
-                    tools=[
-                        types.Tool(
-                            file_search=types.FileSearch(
-                                file_search_store_names=[current_store.name]
-                            )
-                        )
-                    ]
-                )
-            )
-        
-        print("RESPONSE", response.text)
-
-        # Save fixture if requested (only in normal mode)
-        if save_fixture_name and not test_mode:
-            gm = None
-            if response.candidates and response.candidates[0].grounding_metadata:
-                gm = response.candidates[0].grounding_metadata
-            save_fixture(save_fixture_name, message, response.text or "", gm)
-        
-        grounding_supports = []
-        if response.candidates and response.candidates[0].grounding_metadata:
-            gm = response.candidates[0].grounding_metadata
-            # In test mode, skip doc lookup (URLs should be in fixture)
-            # In normal mode, look up document URLs
-            doc_url_by_title = {}
-            if not test_mode:
-                try:
-                    doc_list = list(client.file_search_stores.documents.list(parent=current_store.name))
-                    for doc in doc_list:
-                        url = None
-                        if doc.custom_metadata:
-                            for item in doc.custom_metadata:
-                                if item.key == 'source_url':
-                                    url = getattr(item, 'string_value', None)
-                                    break
-                        if url:
-                            doc_url_by_title[doc.display_name] = url
-                except Exception as e:
-                    print(f"Warning: Could not fetch document URLs: {e}")
-
-            if hasattr(gm, 'grounding_supports') and gm.grounding_supports:
-                for support in gm.grounding_supports:
-                    segment = getattr(support, 'segment', None)
-                    if not segment:
-                        continue
-                    citation_urls = []
-                    seen = set()
-                    if support.grounding_chunk_indices and hasattr(gm, 'grounding_chunks'):
-                        for chunk_idx in support.grounding_chunk_indices:
-                            if chunk_idx >= len(gm.grounding_chunks):
-                                continue
-                            chunk = gm.grounding_chunks[chunk_idx]
-                            title = None
-                            url = None
-                            if hasattr(chunk, 'web') and chunk.web:
-                                title = getattr(chunk.web, 'title', None)
-                                url = getattr(chunk.web, 'uri', None)
-                            elif hasattr(chunk, 'retrieved_context') and chunk.retrieved_context:
-                                rc = chunk.retrieved_context
-                                title = getattr(rc, 'title', None)
-                                url = doc_url_by_title.get(title) or getattr(rc, 'uri', None)
-                            # If no URL but we have a title, create a localhost:// link
-                            if not url and title:
-                                url = f"localhost://{title}"
-                            key = f"{title}|{url}"
-                            if url and key not in seen:
-                                seen.add(key)
-                                citation_urls.append({
-                                    "title": title,
-                                    "url": url,
-                                    "chunk_idx": chunk_idx,  # Track which chunk this citation comes from
-                                })
-                    grounding_supports.append({
-                        "segment": {
-                            "start_index": getattr(segment, "start_index", 0),
-                            "end_index": getattr(segment, "end_index", len(response.text)),
-                        },
-                        "citation_urls": citation_urls,
-                        "grounding_chunk_indices": support.grounding_chunk_indices if hasattr(support, 'grounding_chunk_indices') else [],
-                    })
+            return jsonify(_finish_chat(params, _answer_from_fixture(fixture), coalesced=False, context=None))
 
-        answer_text = response.text or ""
-        # Always generate all formats for dynamic switching
-        rendered_html = render_markdown_with_citations(answer_text, grounding_supports, 'html')
-        rendered_markdown = render_markdown_with_citations(answer_text, grounding_supports, 'markdown')
-        rendered_raw = render_markdown_with_citations(answer_text, grounding_supports, 'raw')
-        rendered_phpbb = render_markdown_with_citations(answer_text, grounding_supports, 'phpbb')
-        
-        # Use the requested mode's rendered output as primary
-        rendered = rendered_html if output_mode == 'html' else (
-            rendered_markdown if output_mode == 'markdown' else (
-                rendered_raw if output_mode == 'raw' else rendered_phpbb
-            )
+        result = _answer_chat(
+            params, _current_deadline(),
+            use_cache=not data.get('no_cache', False), save_fixture_name=save_fixture_name
         )
-        
-        
-        # Save to chat history if conversation_id is provided
-        conversation_id = data.get('conversation_id')
-        if conversation_id:
-            # Load existing conversation or create new
-            conversation = load_chat_history(conversation_id)
-            if not conversation:
-                conversation = {
-                    "id": conversation_id,
-                    "created_at": datetime.now().isoformat(),
-                    "messages": []
-                }
-            
-            # Add user message and bot response
-            conversation["messages"].append({
-                "role": "user",
-                "message": message,
-                "timestamp": datetime.now().isoformat()
-            })
-            bot_message = {
-                "role": "bot",
-                "answer": rendered_html["markdown"],
-                "answer_raw": answer_text,
-                "blocks": rendered_html["blocks"],
-                "supports": rendered_html["supports"],
-                "chunks": rendered_html["chunks"],  # Map of chunk_idx -> {title, url, citation_num}
-                "output_mode": output_mode,  # Store the initially requested mode
-                "timestamp": datetime.now().isoformat(),
-                # Store all formats for dynamic switching
-                "html": rendered_html.get("html", ""),
-                "markdown_formatted": rendered_markdown.get("markdown_formatted", rendered_markdown["markdown"]),
-                "raw": rendered_raw.get("raw", rendered_raw["markdown"]),
-                "raw_citations": rendered_raw.get("raw_citations", ""),
-                "phpbb": rendered_phpbb.get("phpbb", rendered_phpbb["markdown"])
-            }
-            
-            conversation["messages"].append(bot_message)
-            
-            save_chat_history(conversation_id, conversation["messages"])
-        
-        response_data = {
-            "answer": rendered_html["markdown"],
-            "answer_raw": answer_text,
-            "blocks": rendered_html["blocks"],
-            "supports": rendered_html["supports"],
-            "chunks": rendered_html["chunks"],  # Map of chunk_idx -> {title, url, citation_num}
-            "output_mode": output_mode,  # The initially requested mode
-            "conversation_id": conversation_id,  # Return the conversation_id
-            # Include all formats for dynamic switching
-            "html": rendered_html.get("html", ""),
-            "markdown_formatted": rendered_markdown.get("markdown_formatted", rendered_markdown["markdown"]),
-            "raw": rendered_raw.get("raw", rendered_raw["markdown"]),
-            "raw_citations": rendered_raw.get("raw_citations", ""),
-            "phpbb": rendered_phpbb.get("phpbb", rendered_phpbb["markdown"])
-        }
-        
-        return jsonify(response_data)
+        return jsonify(_finish_chat(
+            params, result["answer"], cache=result["cache"], match=result["match"], usage=result["usage"],
+            coalesced=result["coalesced"], context=_context_summary(result["context"])
+        ))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return _error_response(e)
+
+def _sse_event(event, data):
+    """Format a single Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+@_admission_controlled(chat_admission)
+def chat_stream():
+    """Streams a grounded answer as Server-Sent Events.
+
+    Emits `delta` events with text fragments as they arrive, then a single
+    `done` event carrying the same fields as /api/chat (supports, chunks and
+    all rendered formats), or an `error` event if generation fails.
+    """
+    data = request.json
+    params, error = _parse_chat_request(data)
+    if error:
+        return jsonify({"error": error}), 400
+    params = _chat_stores_ready(params)
+    if params is None:
+        return jsonify({"error": "Store not initialized"}), 500
+    try:
+        params = _apply_token_budget(params)
+    except TokenBudgetExceeded as e:
+        return _error_response(e)
+    deadline = _current_deadline()
+    generation = params["generation"]
+    context = None
+
+    def open_stream(timeout):
+        # Pull the first chunk inside the retried call so connection and
+        # time-to-first-token failures are retried; later chunks are not.
+        stream = iter(get_client().models.generate_content_stream(
+            model=generation["model"],
+            contents=context["contents"] if context else params["message"],
+            config=_generation_config(params["instruction"], timeout, generation)
+        ))
+        return next(stream, None), stream
+
+    def generate():
+        nonlocal context
+        message = params["message"]
+        instruction = params["instruction"]
+        try:
+            if params["mode"] == "local":
+                answer = _local_answer(message, generation)
+                yield _sse_event("delta", {"text": answer["answer_text"]})
+                yield _sse_event("done", _finish_chat(params, answer, cache="local", context=None))
+                return
+            context = _conversation_context(params["conversation_id"], message, deadline)
+            # Follow-ups depend on the conversation, so they bypass the answer cache
+            use_cache = not data.get('no_cache', False) and context is None
+            answer = None
+            cache_state = None
+            match = None
+            usage = None
+            if use_cache:
+                key, answer, cache_state, match = _get_cached_answer(message, instruction, generation)
+            if answer is not None:
+                # Cache hit: send the whole answer as a single delta
+                yield _sse_event("delta", {"text": answer["answer_text"]})
+            else:
+                text_parts = []
+                gm = None
+                usage_metadata = None
+                started = time.monotonic()
+                try:
+                    first, stream = upstream.call("generate_content", open_stream, deadline)
+                except Exception as e:
+                    answer, match, cache_state = _fallback_answer(message, instruction, e, generation)
+                    if answer is None:
+                        raise
+                    first, stream = None, iter(())
+                    yield _sse_event("delta", {"text": answer["answer_text"]})
+                for chunk in itertools.chain([first] if first else [], stream):
+                    if chunk.text:
+                        text_parts.append(chunk.text)
+                        yield _sse_event("delta", {"text": chunk.text})
+                    # Grounding metadata and usage normally arrive with the final chunk
+                    if chunk.candidates and chunk.candidates[0].grounding_metadata:
+                        gm = chunk.candidates[0].grounding_metadata
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage_metadata = chunk.usage_metadata
+                if answer is None:
+                    elapsed = time.monotonic() - started
+                    profile_latency.record(params["profile"], generation["model"], elapsed)
+                    answer = _answer_from_response(
+                        "".join(text_parts), gm, store_keys=generation["stores"],
+                        usage=usage_from_metadata(usage_metadata)
+                    )
+                    usage = _record_usage(params, answer, elapsed)
+                    if use_cache:
+                        _put_cached_answer(key, message, instruction, answer, generation)
+
+            yield _sse_event("done", _finish_chat(
+                params, answer, cache=cache_state, match=match, usage=usage, context=_context_summary(context)
+            ))
+        except Exception as e:
+            traceback.print_exc()
+            yield _sse_event("error", {"error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def _batch_items(data):
+    """Normalize the questions of a batch request.
+
+    Each question is a string or {"message", "id", "save_fixture"}.
+    Returns (items, error).
+    """
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not questions:
+        return None, "questions must be a non-empty list"
+    if len(questions) > CHAT_BATCH_MAX_QUESTIONS:
+        return None, f"At most {CHAT_BATCH_MAX_QUESTIONS} questions per batch"
+    prefix = data.get('save_fixtures')
+    items = []
+    for index, question in enumerate(questions):
+        if isinstance(question, str):
+            question = {"message": question}
+        if not isinstance(question, dict) or not question.get('message'):
+            return None, f"Question {index} has no message"
+        fixture_name = question.get('save_fixture')
+        if not fixture_name and prefix:
+            fixture_name = f"{prefix}_{index:04d}"
+        if fixture_name:
+            # Fixture names become file names
+            fixture_name = re.sub(r'[^A-Za-z0-9_.-]', '_', str(fixture_name)).lstrip('.')
+        items.append({
+            "index": index,
+            "id": question.get('id', index),
+            "message": question['message'],
+            "save_fixture": fixture_name or None,
+        })
+    return items, None
+
+@app.route('/api/chat/batch', methods=['POST'])
+@_admission_controlled(batch_lane)
+def chat_batch():
+    """Answers a list of questions with a bounded worker pool, streaming NDJSON.
+
+    Each question goes through the same grounding and rendering pipeline as
+    /api/chat and holds a chat lane slot while it is answered, so batches
+    (admitted through their own lane) never exceed the chat concurrency
+    limit; a question the busy chat lane sheds fails with its retry_after.
+    A `result` line is written per question as soon as it finishes (in
+    completion order, with its index, id and elapsed_ms), then a final
+    `summary` line. Set `save_fixtures` to a name prefix to save every
+    answer as a fixture.
+    """
+    data = request.json
+    items, error = _batch_items(data)
+    if error:
+        return jsonify({"error": error}), 400
+    # Batch answers are not part of any conversation
+    shared = {
+        key: data[key] for key in (
+            'system_instruction', 'instruction_id', 'output_mode', 'formats', 'filters', 'stores', 'mode'
+        )
+        if key in data
+    }
+    params, error = _parse_chat_request(dict(shared, message=items[0]["message"]))
+    if error:
+        return jsonify({"error": error}), 400
+    params = _chat_stores_ready(params)
+    if params is None:
+        return jsonify({"error": "Store not initialized"}), 500
+    if params["mode"] == "local":
+        shared['mode'] = "local"
+    try:
+        concurrency = int(data.get('concurrency', CHAT_BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be a number"}), 400
+    # More workers than chat lane slots would only queue (and be shed) there
+    concurrency = max(1, min(
+        concurrency, CHAT_BATCH_MAX_CONCURRENCY, chat_admission.limiter.max_concurrent, len(items)
+    ))
+    use_cache = not data.get('no_cache', False)
+
+    def run(item):
+        started = time.monotonic()
+        line = {"type": "result", "index": item["index"], "id": item["id"], "message": item["message"]}
+        try:
+            params, error = _parse_chat_request(dict(shared, message=item["message"]))
+            if error:
+                raise ValueError(error)
+            params = _apply_token_budget(params)
+            release = chat_admission.admit_slot()
+            try:
+                result = _answer_chat(
+                    params, Deadline(UPSTREAM_DEADLINE_SECONDS),
+                    use_cache=use_cache, save_fixture_name=item["save_fixture"]
+                )
+            finally:
+                release()
+            line.update(_finish_chat(
+                params, result["answer"], cache=result["cache"], match=result["match"], usage=result["usage"],
+                coalesced=result["coalesced"]
+            ))
+            line["status"] = "ok"
+            if item["save_fixture"]:
+                line["fixture"] = item["save_fixture"]
+        except AdmissionRejected as e:
+            line["status"] = "error"
+            line["error"] = e.reason
+            line["retry_after"] = e.retry_after
+        except Exception as e:
+            line["status"] = "error"
+            line["error"] = str(e)
+        line["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return line
+
+    def generate():
+        started = time.monotonic()
+        succeeded = failed = 0
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        try:
+            futures = [executor.submit(run, item) for item in items]
+            for future in as_completed(futures):
+                line = future.result()
+                if line["status"] == "ok":
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+            yield json.dumps({
+                "type": "summary",
+                "total": len(items),
+                "succeeded": succeeded,
+                "failed": failed,
+                "concurrency": concurrency,
+                "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+            }) + "\n"
+        finally:
+            # Stop queued questions if the client goes away
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Returns runtime metrics for the chat pipeline."""
+    return jsonify({
+        "cache": response_cache.stats(),
+        "similarity": similarity_index.stats(),
+        "coalescing": chat_inflight.stats(),
+        "hedging": chat_hedge.stats(),
+        "upstream": upstream.stats(),
+        "lanes": {lane.name: lane.stats() for lane in LANES},
+        "local_search": local_index.stats(),
+        "line_locator": line_locator.stats(),
+        "snippets": snippet_store.stats(),
+        "prewarm": cache_warmer.stats(),
+        "catalog": document_catalog.stats(),
+        "ingest": ingest_jobs.stats(),
+        "profile_latency": profile_latency.stats(),
+    })
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Returns response cache hit/miss counters."""
+    return jsonify(dict(response_cache.stats(), similarity=similarity_index.stats(), prewarm=cache_warmer.stats()))
+
+@app.route('/api/cache/prewarm', methods=['POST'])
+@_admission_controlled(admin_lane)
+def prewarm_cache():
+    """Starts a cache pre-warming pass now (see CACHE_PREWARM_*); progress is in /api/cache/stats."""
+    cache_warmer.schedule("manual", delay=0)
+    return jsonify({"message": "Cache pre-warming started", "prewarm": cache_warmer.stats()}), 202
+
+@app.route('/api/usage', methods=['GET'])
+def token_usage():
+    """Returns token usage per instruction profile (totals, hourly breakdown and
+    budget state) and the conversations that used the most tokens.
+    """
+    stats = token_ledger.stats()
+    profile_ids = [p["id"] for p in [_default_profile()] + load_custom_instructions()]
+    for profile_id in profile_ids + [p for p in stats["profiles"] if p not in profile_ids]:
+        stats["profiles"].setdefault(profile_id, {"total": None, "hours": {}})["budget"] = _budget_state(profile_id)
+    return jsonify(stats)
+
+@app.route('/api/citations/<snippet_id>', methods=['GET'])
+@_admission_controlled(read_lane)
+def get_citation_snippet(snippet_id):
+    """Returns the text of a cited chunk by its snippet id.
+
+    Ids are content hashes, so a response never changes and may be cached
+    indefinitely by the browser and any proxy.
+    """
+    snippet = snippet_store.get(snippet_id)
+    if snippet is None:
+        return jsonify({"error": "Snippet not found"}), 404
+    response = jsonify(snippet)
+    response.set_etag(snippet_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
 
 @app.route('/api/chat/history', methods=['GET'])
+@_admission_controlled(read_lane)
 def list_chat_history():
     """List all chat conversations."""
     conversations = list_chat_histories()
-    return jsonify({"conversations": conversations})
+    return _conditional_json({"conversations": conversations}, _latest_mtime_path(CHAT_HISTORY_FOLDER))
 
 @app.route('/api/chat/history/<conversation_id>', methods=['GET'])
+@_admission_controlled(read_lane)
 def get_chat_history(conversation_id):
     """Get a specific chat conversation."""
     conversation = load_chat_history(conversation_id)
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
-    return jsonify(conversation)
+    return _conditional_json(conversation, os.path.join(CHAT_HISTORY_FOLDER, f"{conversation_id}.json"))
+
+@app.route('/api/chat/history/<conversation_id>/messages/<int:index>/render', methods=['GET'])
+@_admission_controlled(read_lane)
+def render_chat_history_message(conversation_id, index):
+    """Renders a stored answer in one output format (?format=html|markdown|raw|phpbb).
+
+    Answers only carry the formats requested when they were given; this
+    renders the others from the stored raw answer and grounding supports.
+    """
+    output_format = request.args.get('format', 'html')
+    if output_format not in VALID_OUTPUT_MODES:
+        return jsonify({"error": f"format must be one of: {', '.join(VALID_OUTPUT_MODES)}"}), 400
+    conversation = load_chat_history(conversation_id)
+    if not conversation:
+        return jsonify({"error": "Conversation not found"}), 404
+    messages = conversation.get("messages", [])
+    if not 0 <= index < len(messages) or messages[index].get("role") != "bot":
+        return jsonify({"error": "Answer not found"}), 404
+
+    message = messages[index]
+    fields = OUTPUT_FORMAT_FIELDS[output_format]
+    if not all(field in message for field in fields):
+        grounding_supports = message.get("grounding_supports")
+        if grounding_supports is None:
+            grounding_supports = _supports_from_rendered(message.get("supports"))
+        answer_text = message.get("answer_raw") or message.get("answer") or ""
+        message = _build_answer_payload(answer_text, grounding_supports, output_format)
+    return jsonify(dict({field: message[field] for field in fields}, format=output_format))
 
 @app.route('/api/chat/history/<conversation_id>', methods=['DELETE'])
 def delete_chat_history(conversation_id):
@@ -1047,19 +3321,24 @@ def delete_chat_history(conversation_id):
     try:
         filename = f"{conversation_id}.json"
         filepath = os.path.join(CHAT_HISTORY_FOLDER, filename)
-        if os.path.exists(filepath):
+        with _conversation_lock(conversation_id):
+            if not os.path.exists(filepath):
+                return jsonify({"error": "Conversation not found"}), 404
             os.remove(filepath)
-            return jsonify({"message": "Conversation deleted successfully"})
-        else:
-            return jsonify({"error": "Conversation not found"}), 404
+        return jsonify({"message": "Conversation deleted successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/history')
 def history_page():
     """Serve the chat history page."""
-    return send_from_directory(app.static_folder, 'history.html')
+    return _send_static('history.html')
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0',debug=True, port=5000)
+    debug = True
+    # With debug the reloader runs the app in a child process (WERKZEUG_RUN_MAIN
+    # set); warm up only there so the background work is not started twice
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN"):
+        warm_up()
+    app.run(host='0.0.0.0', debug=debug, port=5000)
 
@@ -0,0 +1,487 @@
+"""
+ASGI Serving Mode
+
+Serves the chat, file listing and file save endpoints natively on asyncio
+with the google-genai async client, so an in-flight Gemini call costs a
+coroutine instead of an OS thread. Every other route is handed to the
+Flask app through asgiref's WsgiToAsgi adapter, so routes and JSON
+contracts are the same in both modes.
+
+Run with:
+    uvicorn asgi_app:application --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+import traceback
+from functools import wraps
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+import app as pichat
+from admission import AdmissionController, AdmissionRejected
+from http_compression import MIN_SIZE, compress, negotiate
+from resilience import Deadline
+
+upstream = pichat.upstream
+
+# A waiting chat only holds a coroutine here, so the lane can be far wider
+# than the threaded one
+async_chat_lane = AdmissionController(
+    name="chat_async",
+    max_concurrent=int(os.getenv("ASYNC_CHAT_MAX_CONCURRENT", "2000")),
+    max_queue=int(os.getenv("ASYNC_CHAT_MAX_QUEUE", "4000")),
+    queue_timeout=float(os.getenv("CHAT_QUEUE_TIMEOUT_SECONDS", "2")),
+    rate_per_client=float(os.getenv("CHAT_RATE_PER_CLIENT", "1")),
+    burst_per_client=int(os.getenv("CHAT_BURST_PER_CLIENT", "10")),
+)
+pichat.LANES.append(async_chat_lane)
+
+flask_app = WsgiToAsgi(pichat.app)
+
+
+class Request:
+    """The parts of an ASGI HTTP request the native handlers need."""
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {
+            name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope.get('headers', [])
+        }
+        self.args = {
+            name: values[0]
+            for name, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()
+        }
+
+    def json(self):
+        try:
+            data = json.loads(self.body or b'null')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def client_ip(self):
+        """The client address used for per-client rate limits."""
+        forwarded = self.headers.get('x-forwarded-for')
+        if pichat.TRUST_PROXY_HEADERS and forwarded:
+            return forwarded.split(',')[0].strip()
+        client_addr = self.scope.get('client')
+        return client_addr[0] if client_addr else "unknown"
+
+    def deadline(self, limit):
+        """A deadline for this request, optionally shortened by the client."""
+        try:
+            requested = float(self.headers.get('x-request-timeout', limit))
+        except ValueError:
+            requested = limit
+        return Deadline(max(0.0, min(requested, limit)))
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def _headers(content_type, extra=None):
+    headers = {'content-type': content_type, 'access-control-allow-origin': '*'}
+    headers.update({name.lower(): value for name, value in (extra or {}).items()})
+    return [(name.encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+
+
+async def _send_json(send, data, status=200, headers=None, request=None):
+    """Send a JSON response, compressed if `request` accepts it (as app._compress_response)."""
+    # Use Flask's JSON provider so values like datetimes serialize identically
+    body = (pichat.app.json.dumps(data) + "\n").encode('utf-8')
+    if request is not None and pichat.HTTP_COMPRESSION_ENABLED and MIN_SIZE <= len(body):
+        encoding = negotiate(request.headers.get('accept-encoding'))
+        headers = dict(headers or {}, Vary='Accept-Encoding')
+        if encoding:
+            body = await asyncio.to_thread(compress, body, encoding)
+            headers['Content-Encoding'] = encoding
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': _headers('application/json', headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_error(send, e):
+    status, headers = pichat._error_status(e)
+    await _send_json(send, {"error": str(e)}, status, headers)
+
+
+def _admission_controlled(lane):
+    """Run a handler in an execution lane, shedding load with 429 + Retry-After."""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, send):
+            try:
+                release = await lane.admit_async(request.client_ip())
+            except AdmissionRejected as e:
+                await _send_json(
+                    send, {"error": e.reason, "retry_after": e.retry_after}, 429,
+                    {'Retry-After': str(e.retry_after)}
+                )
+                return
+            try:
+                await handler(request, send)
+            finally:
+                release()
+        return wrapper
+    return decorator
+
+
+async def _answer_from_response(answer_text, gm, store_keys, usage=None):
+    # Catalog lookups, snippet capture and line lookup touch the disk
+    return await asyncio.to_thread(
+        pichat._answer_from_response, answer_text, gm, None, store_keys, usage
+    )
+
+
+async def _generate_grounded_answer(message, instruction, deadline, generation, contents=None):
+    """Call Gemini with file search and return the answer as a cacheable dict."""
+    response = await upstream.call_async(
+        "generate_content",
+        lambda timeout: pichat.chat_hedge.call_async(lambda: pichat.get_client().aio.models.generate_content(
+            model=generation["model"],
+            contents=contents or message,
+            config=pichat._generation_config(instruction, timeout, generation)
+        )),
+        deadline
+    )
+    gm = None
+    if response.candidates and response.candidates[0].grounding_metadata:
+        gm = response.candidates[0].grounding_metadata
+    return await _answer_from_response(
+        response.text or "", gm, generation["stores"],
+        pichat.usage_from_metadata(getattr(response, 'usage_metadata', None))
+    )
+
+
+async def _generate_coalesced_answer(message, instruction, deadline, generation, contents=None):
+    key = pichat._coalescing_key(message, instruction, generation, contents)
+    return await pichat.chat_inflight.do_async(
+        key, lambda: _generate_grounded_answer(message, instruction, deadline, generation, contents)
+    )
+
+
+@_admission_controlled(async_chat_lane)
+async def chat(request, send):
+    """Asks a question grounded in the selected knowledge bases."""
+    data = request.json()
+    if data is None:
+        return await _send_json(send, {"error": "Request body must be a JSON object"}, 400)
+    # Resolving the instruction profile reads system_instructions.json
+    params, error = await asyncio.to_thread(pichat._parse_chat_request, data)
+    if error:
+        return await _send_json(send, {"error": error}, 400)
+    params = await asyncio.to_thread(pichat._chat_stores_ready, params)
+    if params is None:
+        return await _send_json(send, {"error": "Store not initialized"}, 500)
+    try:
+        # Reads the profile's budget from system_instructions.json
+        params = await asyncio.to_thread(pichat._apply_token_budget, params)
+    except pichat.TokenBudgetExceeded as e:
+        return await _send_error(send, e)
+    fixture_name = data.get('fixture_name')
+    try:
+        if data.get('test_mode', False) and fixture_name:
+            fixture = await asyncio.to_thread(pichat.load_fixture, fixture_name)
+            if not fixture:
+                return await _send_json(send, {"error": f"Fixture '{fixture_name}' not found"}, 404)
+            # Parsing the fixture's grounding metadata is CPU work
+            answer = await asyncio.to_thread(pichat._answer_from_fixture, fixture)
+            result = {"answer": answer, "cache": None, "match": None,
+                      "coalesced": False, "context": None, "usage": None}
+        else:
+            deadline = request.deadline(pichat.UPSTREAM_DEADLINE_SECONDS)
+            # History, the occasional summary call and the cache are blocking;
+            # only the Gemini call itself runs on the event loop
+            lookup = await asyncio.to_thread(
+                pichat._lookup_answer, params, deadline,
+                not data.get('no_cache', False), data.get('save_fixture')
+            )
+            if lookup["answer"] is not None:
+                result = await asyncio.to_thread(pichat._settle_answer, params, lookup)
+            else:
+                started = time.monotonic()
+                try:
+                    answer, coalesced = await _generate_coalesced_answer(
+                        params["message"], params["instruction"], deadline, params["generation"],
+                        lookup["contents"]
+                    )
+                except Exception as e:
+                    result = await asyncio.to_thread(pichat._settle_answer, params, lookup, error=e)
+                else:
+                    result = await asyncio.to_thread(
+                        pichat._settle_answer, params, lookup, answer, coalesced, time.monotonic() - started
+                    )
+
+        # Rendering every output format is CPU work; keep it off the event loop
+        response_data = await asyncio.to_thread(
+            pichat._finish_chat, params, result["answer"], cache=result["cache"], match=result["match"],
+            usage=result["usage"], coalesced=result["coalesced"], context=pichat._context_summary(result["context"])
+        )
+        await _send_json(send, response_data, request=request)
+    except Exception as e:
+        await _send_error(send, e)
+
+
+@_admission_controlled(async_chat_lane)
+async def chat_stream(request, send):
+    """Streams a grounded answer as Server-Sent Events (see app.chat_stream)."""
+    data = request.json()
+    if data is None:
+        return await _send_json(send, {"error": "Request body must be a JSON object"}, 400)
+    # Resolving the instruction profile reads system_instructions.json
+    params, error = await asyncio.to_thread(pichat._parse_chat_request, data)
+    if error:
+        return await _send_json(send, {"error": error}, 400)
+    params = await asyncio.to_thread(pichat._chat_stores_ready, params)
+    if params is None:
+        return await _send_json(send, {"error": "Store not initialized"}, 500)
+    try:
+        # Reads the profile's budget from system_instructions.json
+        params = await asyncio.to_thread(pichat._apply_token_budget, params)
+    except pichat.TokenBudgetExceeded as e:
+        return await _send_error(send, e)
+    message = params["message"]
+    instruction = params["instruction"]
+    generation = params["generation"]
+    deadline = request.deadline(pichat.UPSTREAM_DEADLINE_SECONDS)
+    context = None
+
+    async def open_stream(timeout):
+        # Pull the first chunk inside the retried call so connection and
+        # time-to-first-token failures are retried; later chunks are not.
+        stream = await pichat.get_client().aio.models.generate_content_stream(
+            model=generation["model"],
+            contents=context["contents"] if context else message,
+            config=pichat._generation_config(instruction, timeout, generation)
+        )
+        return await anext(stream, None), stream
+
+    async def emit(event, payload):
+        await send({
+            'type': 'http.response.body',
+            'body': pichat._sse_event(event, payload).encode('utf-8'),
+            'more_body': True,
+        })
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': _headers('text/event-stream; charset=utf-8', {
+            'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'
+        }),
+    })
+    try:
+        if params["mode"] == "local":
+            answer = await asyncio.to_thread(pichat._local_answer, message, generation)
+            await emit("delta", {"text": answer["answer_text"]})
+            done = await asyncio.to_thread(pichat._finish_chat, params, answer, cache="local", context=None)
+            await emit("done", done)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        context = await asyncio.to_thread(
+            pichat._conversation_context, params["conversation_id"], message, deadline
+        )
+        use_cache = not data.get('no_cache', False) and context is None
+        answer = None
+        cache_state = None
+        match = None
+        usage = None
+        if use_cache:
+            key, answer, cache_state, match = await asyncio.to_thread(
+                pichat._get_cached_answer, message, instruction, generation
+            )
+        if answer is not None:
+            # Cache hit: send the whole answer as a single delta
+            await emit("delta", {"text": answer["answer_text"]})
+        else:
+            text_parts = []
+            gm = None
+            usage_metadata = None
+            stream = None
+            started = time.monotonic()
+            try:
+                first, stream = await upstream.call_async("generate_content", open_stream, deadline)
+            except Exception as e:
+                answer, match, cache_state = await asyncio.to_thread(
+                    pichat._fallback_answer, message, instruction, e, generation
+                )
+                if answer is None:
+                    raise
+                first = None
+                await emit("delta", {"text": answer["answer_text"]})
+            chunk = first
+            while chunk is not None:
+                if chunk.text:
+                    text_parts.append(chunk.text)
+                    await emit("delta", {"text": chunk.text})
+                # Grounding metadata and usage normally arrive with the final chunk
+                if chunk.candidates and chunk.candidates[0].grounding_metadata:
+                    gm = chunk.candidates[0].grounding_metadata
+                if getattr(chunk, 'usage_metadata', None):
+                    usage_metadata = chunk.usage_metadata
+                chunk = await anext(stream, None)
+            if answer is None:
+                elapsed = time.monotonic() - started
+                pichat.profile_latency.record(params["profile"], generation["model"], elapsed)
+                answer = await _answer_from_response(
+                    "".join(text_parts), gm, generation["stores"],
+                    pichat.usage_from_metadata(usage_metadata)
+                )
+                usage = pichat._record_usage(params, answer, elapsed)
+                if use_cache:
+                    await asyncio.to_thread(
+                        pichat._put_cached_answer, key, message, instruction, answer, generation
+                    )
+
+        done = await asyncio.to_thread(
+            pichat._finish_chat, params, answer, cache=cache_state, match=match, usage=usage,
+            context=pichat._context_summary(context)
+        )
+        await emit("done", done)
+    except Exception as e:
+        traceback.print_exc()
+        await emit("error", {"error": str(e)})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _list_documents(store_key, deadline):
+    """Every document in a store, listed with the async client (as app._list_documents)."""
+    async def list_all(timeout):
+        pager = await pichat.get_client().aio.file_search_stores.documents.list(
+            parent=pichat._store_name(store_key), config=pichat._with_timeout({}, timeout)
+        )
+        return [doc async for doc in pager]
+    return await upstream.call_async("documents.list", list_all, deadline)
+
+
+async def _reconcile_catalog(store_key, deadline):
+    """Make the catalog's entries for a store match its remote listing (as app._reconcile_catalog)."""
+    docs = await _list_documents(store_key, deadline)
+    # Hashing local copies and writing the catalog touch the disk
+    await asyncio.to_thread(pichat._apply_remote_listing, store_key, docs)
+
+
+@_admission_controlled(pichat.read_lane)
+async def list_files(request, send):
+    """Lists one page of files in a knowledge base's FileSearchStore (?store=, default store) with metadata."""
+    store_key, error = pichat._requested_store(request.args.get('store'))
+    if error:
+        return await _send_json(send, {"error": error}, 404)
+    if not await asyncio.to_thread(pichat._ensure_store, store_key):
+        return await _send_json(send, {"error": "Store not initialized"}, 500)
+    try:
+        refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+        if refresh or await asyncio.to_thread(pichat.document_catalog.reconciled_at, store_key) is None:
+            try:
+                await _reconcile_catalog(store_key, request.deadline(pichat.UPSTREAM_DEADLINE_SECONDS))
+            except Exception as e:
+                if refresh:
+                    raise
+                # As app._ensure_catalog: the store keeps its current entries
+                print(f"Warning: Could not reconcile the document catalog for '{store_key}': {e}")
+        page, error = await asyncio.to_thread(pichat._file_listing, store_key, request.args, True)
+        if error:
+            return await _send_json(send, {"error": error}, 400)
+        await _send_json(send, page, request=request)
+    except Exception as e:
+        traceback.print_exc()
+        await _send_error(send, e)
+
+
+@_admission_controlled(pichat.admin_lane)
+async def save_file(request, send):
+    """Saves a new or edited file locally and queues its upload to a knowledge base's FileSearchStore."""
+    data = request.json() or {}
+    store_key, error = pichat._requested_store(data.get('store') or request.args.get('store'))
+    if error:
+        return await _send_json(send, {"error": error}, 404)
+    if not await asyncio.to_thread(pichat._ensure_store, store_key):
+        return await _send_json(send, {"error": "Store not initialized"}, 500)
+
+    filename = data.get('filename')
+    content = data.get('content')
+    if not filename or content is None:
+        return await _send_json(send, {"error": "Missing filename or content"}, 400)
+    explicit, error = pichat.parse_metadata(data.get('metadata'))
+    if error:
+        return await _send_json(send, {"error": error}, 400)
+
+    # Ensure filename doesn't have path traversal and has a valid extension
+    filename = os.path.basename(filename)
+    if not filename.endswith('.txt'):
+        filename += '.txt'
+
+    try:
+        pichat.ingest_jobs.check_capacity()
+        local_path = os.path.join(pichat._upload_folder(store_key), filename)
+
+        def write_local_copy():
+            created = [] if os.path.exists(local_path) else [local_path]
+            with open(local_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            return pichat._document_custom_metadata(local_path, filename, explicit), created
+        metadata, created = await asyncio.to_thread(write_local_copy)
+
+        config = {
+            'display_name': filename,
+            'mime_type': 'text/plain',
+            'custom_metadata': metadata
+        }
+        # The job replaces any existing document with the same name
+        job = await asyncio.to_thread(
+            pichat._submit_ingest, "save", store_key,
+            [{"filename": filename, "local_path": local_path, "config": config}],
+            {"replace": True}, created
+        )
+        body = pichat._job_accepted_body(job, {
+            "message": "File saved and queued for upload",
+            "filename": filename,
+            "store": store_key
+        })
+        await _send_json(send, body, 202, {'Location': body["status_url"]})
+    except Exception as e:
+        print(f"Error saving file: {e}")
+        await _send_error(send, e)
+
+
+ROUTES = {
+    ('POST', '/api/chat'): chat,
+    ('POST', '/api/chat/stream'): chat_stream,
+    ('GET', '/api/files'): list_files,
+    ('POST', '/api/files/save'): save_file,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Background store resolution, local index and cache pre-warming
+            pichat.warm_up()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI entry point: native async handlers, everything else via Flask."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        return await flask_app(scope, receive, send)
+    request = Request(scope, await _read_body(receive))
+    await handler(request, send)
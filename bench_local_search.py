@@ -0,0 +1,103 @@
+"""
+Local Search Benchmark
+
+Builds the BM25 index used by /api/search and the degraded chat mode over
+the local document copies, then reports build time, index size, query
+latency percentiles and the cost of an incremental update. Runs offline.
+
+    python bench_local_search.py
+    python bench_local_search.py --folder uploads --folder uploads_pico --rounds 50
+"""
+import argparse
+import os
+import statistics
+import time
+
+from local_search import LocalSearchIndex
+
+QUESTIONS = [
+    "How do I enable SSH?",
+    "How do I boot from an NVMe SSD?",
+    "What power supply does the Raspberry Pi 5 need?",
+    "How do I set a static IP address?",
+    "Camera Module 3 autofocus settings",
+    "How do I connect a Pico W to Wi-Fi?",
+    "What is the maximum current of the GPIO pins?",
+    "How do I rotate the display?",
+    "Compute Module 5 eMMC flashing with rpiboot",
+    "How do I update the bootloader EEPROM?",
+    "Configure the fan on the active cooler",
+    "How do I enable secure boot on RP2350?",
+    "What is the difference between Bookworm and Bullseye networking?",
+    "How do I use the AI HAT+ with rpicam-apps?",
+    "UART serial console configuration in config.txt",
+    "micropython",
+]
+
+
+def _percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _read_documents(folders):
+    documents = []
+    skipped = 0
+    for folder in folders:
+        for filename in sorted(os.listdir(folder)):
+            path = os.path.join(folder, filename)
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    documents.append(((folder, filename), f.read()))
+            except UnicodeDecodeError:
+                skipped += 1
+    return documents, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", action="append", help="Folder of document copies (repeatable; default uploads)")
+    parser.add_argument("--rounds", type=int, default=20, help="Times each question is searched")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+    folders = args.folder or ["uploads"]
+
+    documents, skipped = _read_documents(folders)
+    corpus_mb = sum(len(text.encode('utf-8')) for _, text in documents) / 1e6
+    index = LocalSearchIndex()
+    started = time.perf_counter()
+    for doc_id, text in documents:
+        index.add_document(doc_id, text, title=doc_id[1])
+    build_seconds = time.perf_counter() - started
+    stats = index.stats()
+    print(f"Corpus:       {len(documents)} documents, {corpus_mb:.1f} MB ({skipped} non-text files skipped)")
+    print(f"Index:        {stats['passages']} passages, {stats['terms']} terms")
+    print(f"Build:        {build_seconds * 1000:.0f} ms")
+
+    latencies = []
+    for _ in range(args.rounds):
+        for question in QUESTIONS:
+            started = time.perf_counter()
+            index.search(question, limit=args.limit)
+            latencies.append(time.perf_counter() - started)
+    ordered = sorted(latencies)
+    print(f"Queries:      {len(latencies)} "
+          f"(mean {statistics.mean(ordered) * 1000:.2f} ms, p50 {_percentile(ordered, 50) * 1000:.2f} ms, "
+          f"p95 {_percentile(ordered, 95) * 1000:.2f} ms, p99 {_percentile(ordered, 99) * 1000:.2f} ms, "
+          f"max {ordered[-1] * 1000:.2f} ms)")
+
+    # Incremental maintenance: re-index and remove the largest document
+    doc_id, text = max(documents, key=lambda item: len(item[1]))
+    started = time.perf_counter()
+    index.add_document(doc_id, text, title=doc_id[1])
+    reindex_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    index.remove_document(doc_id)
+    remove_ms = (time.perf_counter() - started) * 1000
+    print(f"Update:       re-index {doc_id[1]} ({len(text) / 1e3:.0f} kB) {reindex_ms:.1f} ms, "
+          f"remove {remove_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Serving Benchmark
+
+Drives concurrent /api/chat requests at a running server and reports
+throughput, latency percentiles and (optionally) the server's peak RSS, to
+compare the threaded Flask mode with the asyncio mode in asgi_app.py.
+
+Start each server with per-client rate limiting off, e.g.
+    CHAT_RATE_PER_CLIENT=0 python app.py
+    CHAT_RATE_PER_CLIENT=0 uvicorn asgi_app:application --port 5001
+
+then run
+    python bench_serving.py --url http://localhost:5000 --concurrency 500 --requests 5000 --pid <server pid>
+    python bench_serving.py --url http://localhost:5001 --concurrency 500 --requests 5000 --pid <server pid>
+
+By default each request asks a distinct question with no_cache set, so every
+chat is a real grounded Gemini call; --fixture replays a saved fixture
+instead to measure serving overhead alone.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+import httpx
+
+
+def _rss_mb(pid):
+    """Resident set size of a local process in MB (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(url, concurrency, total, fixture=None, question="How do I enable SSH on a Raspberry Pi?",
+              timeout=120.0, pid=None):
+    latencies = []
+    statuses = Counter()
+    issued = 0
+    peak_rss = _rss_mb(pid) if pid else None
+
+    def next_body():
+        nonlocal issued
+        if issued >= total:
+            return None
+        issued += 1
+        if fixture:
+            return {"message": question, "test_mode": True, "fixture_name": fixture}
+        return {"message": f"{question} (request {issued})", "no_cache": True}
+
+    async def worker(http):
+        while True:
+            body = next_body()
+            if body is None:
+                return
+            started = time.monotonic()
+            try:
+                response = await http.post(f"{url}/api/chat", json=body)
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                continue
+            if response.status_code == 200:
+                latencies.append(time.monotonic() - started)
+
+    async def sample_rss(stop):
+        nonlocal peak_rss
+        while not stop.is_set():
+            rss = _rss_mb(pid)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+            await asyncio.sleep(0.2)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as http:
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(stop)) if pid else None
+        started = time.monotonic()
+        await asyncio.gather(*(worker(http) for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+        stop.set()
+        if sampler:
+            await sampler
+
+    ordered = sorted(latencies)
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "requests": total,
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "statuses": dict(statuses),
+        "p50_ms": round(_percentile(ordered, 50) * 1000, 1),
+        "p90_ms": round(_percentile(ordered, 90) * 1000, 1),
+        "p99_ms": round(_percentile(ordered, 99) * 1000, 1),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 1) if ordered else 0.0,
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--fixture", help="replay this fixture in test mode instead of calling Gemini")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--pid", type=int, help="server process to sample peak RSS from")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(
+        args.url.rstrip("/"), args.concurrency, args.requests,
+        fixture=args.fixture, timeout=args.timeout, pid=args.pid
+    ))
+    for name, value in result.items():
+        print(f"{name:>16}: {value}")
+
+
+if __name__ == "__main__":
+    main()
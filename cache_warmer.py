@@ -0,0 +1,169 @@
+"""
+Cache Warmer Module
+
+Replays popular questions through the answer pipeline in the background, so
+their answers are cached before users ask them again (after a deploy, or
+after a knowledge base change has invalidated the cache).
+
+A pass is scheduled with a delay and rescheduling restarts the countdown,
+so a burst of uploads triggers one pass once it settles; a pass that is
+still running when a new one is scheduled stops early, since its answers
+belong to an outdated knowledge base. Passes run at most `concurrency`
+questions at a time and start at most `rate` questions per second.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; every process then warms
+    fcntl = None
+
+
+class CacheWarmer:
+    """
+    `collect()` returns the questions to warm, most important first;
+    `warm(question)` answers one through the cached pipeline and returns True
+    if an answer was generated, False if one was already cached. Exceptions
+    count as failures.
+
+    With `lock_path`, only the process holding an exclusive lock on that
+    file runs a pass (for workers sharing an on-disk cache).
+    """
+
+    def __init__(self, collect, warm, concurrency=2, rate=1.0, delay=30.0, lock_path=None):
+        self.collect = collect
+        self.warm = warm
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.delay = delay
+        self.lock_path = lock_path
+        self._lock = threading.Lock()
+        self._timer = None
+        self._generation = 0
+        self._next_start = 0.0
+        self.running = False
+        self.passes = 0
+        self.last_pass = None
+
+    def schedule(self, reason, delay=None):
+        """Run a pass `delay` seconds from now (default self.delay), replacing any pending one."""
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(
+                self.delay if delay is None else delay, self._run, args=(generation, reason)
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _current(self, generation):
+        with self._lock:
+            return generation == self._generation
+
+    def _wait_for_rate(self):
+        """Space question starts 1/rate seconds apart across all threads."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def _acquire_process_lock(self):
+        """The open lock file if this process may run the pass, else None."""
+        handle = open(self.lock_path, "a")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+        return handle
+
+    def _run(self, generation, reason):
+        with self._lock:
+            if self.running or generation != self._generation:
+                # The running pass stops at its next question and the
+                # newest schedule() call runs after it
+                if generation == self._generation:
+                    self._timer = threading.Timer(1.0, self._run, args=(generation, reason))
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self.running = True
+        handle = None
+        try:
+            if self.lock_path and fcntl is not None:
+                handle = self._acquire_process_lock()
+                if handle is None:
+                    print(f"Cache pre-warming ({reason}) skipped: another process is warming")
+                    return
+            self._warm_all(generation, reason)
+        except Exception as e:
+            print(f"Cache pre-warming ({reason}) failed: {e}")
+        finally:
+            if handle is not None:
+                handle.close()
+            with self._lock:
+                self.running = False
+
+    def _warm_all(self, generation, reason):
+        started = time.monotonic()
+        questions = self.collect()
+        counts = {"warmed": 0, "cached": 0, "failed": 0}
+        pending = list(reversed(questions))
+
+        def worker():
+            while self._current(generation):
+                with self._lock:
+                    if not pending:
+                        return
+                    question = pending.pop()
+                self._wait_for_rate()
+                if not self._current(generation):
+                    return
+                try:
+                    outcome = "warmed" if self.warm(question) else "cached"
+                except Exception as e:
+                    print(f"Cache pre-warming failed for '{question[:80]}': {e}")
+                    outcome = "failed"
+                with self._lock:
+                    counts[outcome] += 1
+
+        threads = [
+            threading.Thread(target=worker, name=f"cache-warmer-{i}", daemon=True)
+            for i in range(min(self.concurrency, len(questions)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        summary = dict(
+            counts,
+            reason=reason,
+            questions=len(questions),
+            cancelled=not self._current(generation),
+            elapsed_s=round(elapsed, 2),
+            finished_at=datetime.now(timezone.utc).isoformat(),
+        )
+        with self._lock:
+            self.passes += 1
+            self.last_pass = summary
+        print(f"Cache pre-warming ({reason}): warmed {counts['warmed']}, already cached {counts['cached']}, "
+              f"failed {counts['failed']} of {len(questions)} questions in {elapsed:.1f}s"
+              f"{' (cancelled)' if summary['cancelled'] else ''}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self.running,
+                "scheduled": self._timer is not None and self._timer.is_alive() and not self.running,
+                "passes": self.passes,
+                "last_pass": self.last_pass,
+            }
@@ -351,7 +351,7 @@ class CitationRenderer:
                             "chunk_idx": chunk_idx,
                         })
 
-        # Build chunks map: chunk_idx -> {title, url, citation_num}
+        # Build chunks map: chunk_idx -> {title, url, citation_num[, snippet, location]}
         # This will be sent to frontend for the citation sidebar
         chunks_map = {}
         for item in supports_with_lines:
@@ -373,10 +373,14 @@ class CitationRenderer:
                         chunk_idx = citation.get("chunk_idx")
                         url = citation.get("url")
                         title = citation.get("title")
+                        snippet = citation.get("snippet")
+                        location = citation.get("location")
                     else:
                         chunk_idx = getattr(citation, "chunk_idx", None)
                         url = getattr(citation, "url", None)
                         title = getattr(citation, "title", None)
+                        snippet = getattr(citation, "snippet", None)
+                        location = getattr(citation, "location", None)
                     
                     if not url and title:
                         url = f"localhost://{title}"
@@ -388,6 +392,12 @@ class CitationRenderer:
                             "url": url,
                             "citation_num": citation_num,
                         }
+                        # Id of the chunk's text in the snippet store, for previews
+                        if snippet:
+                            chunks_map[chunk_idx]["snippet"] = snippet
+                        # Line range of the chunk in the local copy of the document
+                        if location:
+                            chunks_map[chunk_idx]["location"] = location
 
         # Insert citations into text based on output mode
         if output_mode == 'html':
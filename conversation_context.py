@@ -0,0 +1,106 @@
+"""
+Conversation Context Module
+
+Builds the `contents` for a follow-up question from a stored conversation
+under a token budget: the most recent turns are sent verbatim and older
+turns are folded into a rolling summary, so the prompt stays bounded no
+matter how long the conversation runs.
+"""
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def clip_to_tokens(text, max_tokens):
+    """Trim text to roughly `max_tokens`, keeping the end (the most recent part)."""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    clipped = text[-max_chars:]
+    # Don't start mid-line if a line break is close by
+    newline = clipped.find("\n")
+    if 0 <= newline < 200:
+        clipped = clipped[newline + 1:]
+    return clipped
+
+
+def conversation_turns(messages):
+    """
+    Pair stored history messages into (question, answer) turns. Only the
+    question and the plain answer text are kept; rendered HTML, citations
+    and other bulky fields are dropped.
+    """
+    turns = []
+    question = None
+    for message in messages:
+        if message.get("role") == "user":
+            question = message.get("message") or ""
+        elif message.get("role") == "bot" and question is not None:
+            turns.append((question, message.get("answer_raw") or message.get("answer") or ""))
+            question = None
+    return turns
+
+
+def turn_tokens(turn):
+    question, answer = turn
+    return estimate_tokens(question) + estimate_tokens(answer)
+
+
+def recent_turns_start(turns, message, budget, covered=0):
+    """
+    Index of the first turn to send verbatim: as many of the most recent
+    turns as fit in `budget` tokens alongside `message`. Turns before
+    `covered` are already in the summary and are never sent verbatim.
+    """
+    remaining = budget - estimate_tokens(message)
+    start = len(turns)
+    while start > covered:
+        cost = turn_tokens(turns[start - 1])
+        if cost > remaining:
+            break
+        remaining -= cost
+        start -= 1
+    return start
+
+
+def summary_prompt(summary, turns, max_tokens):
+    """Prompt asking the model to fold `turns` into the existing summary."""
+    lines = [
+        f"Update the running summary of a conversation with a Raspberry Pi assistant. "
+        f"Keep the facts, devices, versions and decisions a follow-up question might refer to. "
+        f"Reply with the summary only, in at most {max_tokens * 3 // 4} words.",
+        "",
+        "Current summary:",
+        summary or "(none)",
+        "",
+        "New turns:",
+    ]
+    for question, answer in turns:
+        lines.append(f"User: {question}")
+        lines.append(f"Assistant: {answer}")
+    return "\n".join(lines)
+
+
+def extractive_summary(summary, turns, max_tokens):
+    """Fallback summary listing the questions asked, used if summarization fails."""
+    lines = [summary] if summary else []
+    lines.extend(f"- The user asked: {question}" for question, _ in turns)
+    return clip_to_tokens("\n".join(lines), max_tokens)
+
+
+def build_contents(turns, message, summary=""):
+    """
+    Gemini `contents` for `message` following the verbatim `turns`, with the
+    summary of older turns prefixed to the first user turn.
+    """
+    contents = []
+    for question, answer in turns:
+        contents.append({"role": "user", "parts": [{"text": question}]})
+        contents.append({"role": "model", "parts": [{"text": answer}]})
+    contents.append({"role": "user", "parts": [{"text": message}]})
+    if summary:
+        first = contents[0]["parts"][0]
+        first["text"] = f"Summary of the earlier conversation:\n{summary}\n\n{first['text']}"
+    return contents
@@ -0,0 +1,192 @@
+"""
+Document Catalog Module
+
+A local SQLite catalog of the documents in each knowledge base store
+(display name, document resource name, source URL, content hash, size,
+state and custom metadata), so hot paths such as citation URL resolution
+and replacing a saved file are local lookups instead of listing the remote
+store. The app keeps it current on upload, save, delete and clear, and
+reconciles each store against the remote listing periodically.
+
+The database is shared by the worker processes of a server (WAL mode);
+each process opens its own connection. A revision number advances with
+every change, so a process can tell when another one changed a store.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    name TEXT PRIMARY KEY,
+    store TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    source_url TEXT,
+    content_hash TEXT,
+    size_bytes INTEGER,
+    mime_type TEXT,
+    state TEXT,
+    create_time TEXT,
+    metadata TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_by_display_name ON documents (store, display_name);
+CREATE TABLE IF NOT EXISTS reconciliations (
+    store TEXT PRIMARY KEY,
+    reconciled_at REAL
+);
+CREATE TABLE IF NOT EXISTS revision (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO revision VALUES (0, 0);
+"""
+_BUMP = "UPDATE revision SET value = value + 1 WHERE id = 0"
+
+FIELDS = ('name', 'store', 'display_name', 'source_url', 'content_hash', 'size_bytes',
+          'mime_type', 'state', 'create_time', 'metadata')
+_UPSERT = (f"INSERT OR REPLACE INTO documents ({', '.join(FIELDS)}, updated_at) "
+           f"VALUES ({', '.join('?' * len(FIELDS))}, ?)")
+
+
+def _row_values(document, updated_at):
+    values = [document.get(field) for field in FIELDS]
+    values[FIELDS.index('metadata')] = json.dumps(document.get('metadata') or {}, sort_keys=True)
+    return values + [updated_at]
+
+
+def _row_dict(row):
+    document = dict(row)
+    document["metadata"] = json.loads(document["metadata"]) if document["metadata"] else {}
+    return document
+
+
+class DocumentCatalog:
+    """Documents keyed by resource name, grouped by knowledge base (store key)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Connections must not cross a fork
+        if self._conn is None or self._pid != os.getpid():
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=(), change=False):
+        """Run one statement; with `change`, advance the revision in the same transaction."""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                rows = conn.execute(sql, params).fetchall()
+                if change:
+                    conn.execute(_BUMP)
+                return rows
+
+    def upsert(self, document):
+        """Insert or replace a document ({name, store, display_name, ...}; metadata is a dict)."""
+        self._execute(_UPSERT, _row_values(document, time.time()), change=True)
+
+    def remove(self, name):
+        self._execute("DELETE FROM documents WHERE name = ?", (name,), change=True)
+
+    def revision(self):
+        """A number that advances whenever any process changes the catalog."""
+        return self._execute("SELECT value FROM revision WHERE id = 0")[0]["value"]
+
+    def clear_store(self, store):
+        """Forget every document of a store; the (now empty) store counts as reconciled."""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM documents WHERE store = ?", (store,))
+                conn.execute("INSERT OR REPLACE INTO reconciliations VALUES (?, ?)", (store, time.time()))
+                conn.execute(_BUMP)
+
+    def get(self, name):
+        rows = self._execute("SELECT * FROM documents WHERE name = ?", (name,))
+        return _row_dict(rows[0]) if rows else None
+
+    def find(self, store, display_name):
+        """Every document of a store with the given display name."""
+        rows = self._execute(
+            "SELECT * FROM documents WHERE store = ? AND display_name = ?", (store, display_name)
+        )
+        return [_row_dict(row) for row in rows]
+
+    def documents(self, store):
+        rows = self._execute("SELECT * FROM documents WHERE store = ? ORDER BY display_name", (store,))
+        return [_row_dict(row) for row in rows]
+
+    def url_map(self, stores):
+        """{display_name: source_url} over the given stores."""
+        rows = self._execute(
+            f"SELECT display_name, source_url FROM documents "
+            f"WHERE source_url IS NOT NULL AND store IN ({', '.join('?' * len(stores))})",
+            list(stores)
+        )
+        return {row["display_name"]: row["source_url"] for row in rows}
+
+    def reconciled_at(self, store):
+        """When the store was last reconciled (epoch seconds), or None if never or marked stale."""
+        rows = self._execute("SELECT reconciled_at FROM reconciliations WHERE store = ?", (store,))
+        return rows[0]["reconciled_at"] if rows else None
+
+    def mark_stale(self, store):
+        """Force a reconciliation of the store before its next lookup."""
+        self._execute("INSERT OR REPLACE INTO reconciliations VALUES (?, NULL)", (store,))
+
+    def replace_store(self, store, documents, content_hash=None):
+        """
+        Make the store's entries match `documents` (the remote listing).
+        Content hashes of documents already catalogued are kept; new ones
+        get `content_hash(document)` if given. Returns (added, removed,
+        changed) counts.
+        """
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                known = {
+                    row["name"]: _row_dict(row)
+                    for row in conn.execute("SELECT * FROM documents WHERE store = ?", (store,))
+                }
+                added = changed = 0
+                now = time.time()
+                for document in documents:
+                    document = dict(document, store=store)
+                    previous = known.pop(document["name"], None)
+                    if previous is None:
+                        added += 1
+                        if content_hash is not None:
+                            document["content_hash"] = content_hash(document)
+                    else:
+                        document["content_hash"] = previous["content_hash"]
+                        if any(previous.get(field) != document.get(field) for field in FIELDS):
+                            changed += 1
+                        else:
+                            continue
+                    conn.execute(_UPSERT, _row_values(document, now))
+                conn.executemany("DELETE FROM documents WHERE name = ?", [(name,) for name in known])
+                conn.execute("INSERT OR REPLACE INTO reconciliations VALUES (?, ?)", (store, now))
+                if added or known or changed:
+                    conn.execute(_BUMP)
+        return added, len(known), changed
+
+    def stats(self):
+        rows = self._execute(
+            "SELECT documents.store AS store, COUNT(*) AS documents, reconciled_at FROM documents "
+            "LEFT JOIN reconciliations ON reconciliations.store = documents.store GROUP BY documents.store"
+        )
+        return {row["store"]: {"documents": row["documents"], "reconciled_at": row["reconciled_at"]} for row in rows}
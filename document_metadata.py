@@ -0,0 +1,130 @@
+"""
+Document Metadata Module
+
+Derives structured metadata (product family, document type, OS release)
+for knowledge base documents from their filename and content, and turns
+chat-time filters over those fields into a FileSearch metadata filter.
+"""
+import re
+
+METADATA_KEYS = ('product_family', 'doc_type', 'os_release')
+
+# First matching rule wins; patterns are matched against the lowercased filename
+PRODUCT_FAMILY_RULES = [
+    ('pico', r'pico|rp2040|rp2350|c_sdk|micropython|microcontroller|debug-probe|power_switching'),
+    ('compute_module', r'cm[345]|compute[-_]module|cm_provisioner'),
+    ('camera', r'camera'),
+    ('display', r'display|lcd|dpi|dsi|hdmi|monitor|touch'),
+    ('accessories', r'hat|keyboard|mouse|bumper|case|cooling|accessor|ssd|usb-3-hub|build-hat'),
+]
+
+DOC_TYPE_RULES = [
+    ('transition_guide', r'transition|forward_guidance'),
+    ('troubleshooting', r'troubleshoot|debugging'),
+    ('datasheet', r'-ds-|datasheet|\.pdf$'),
+    ('api_reference', r'\.h\.txt$|doxygen|sdk'),
+    ('whitepaper', r'\.typ$'),
+    ('documentation', r'\.html\.txt$'),
+]
+
+OS_RELEASES = ('trixie', 'bookworm', 'bullseye', 'buster', 'stretch')
+
+# Only these characters are allowed in filter values, so they can be
+# embedded in a filter expression without escaping
+_VALUE_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def _first_match(rules, name):
+    for value, pattern in rules:
+        if re.search(pattern, name):
+            return value
+    return None
+
+
+def _os_release(name, text):
+    for release in OS_RELEASES:
+        if release in name:
+            return release
+    # Otherwise the release the content mentions most, if it is a clear theme
+    lowered = (text or '').lower()
+    counts = {release: lowered.count(release) for release in OS_RELEASES}
+    release, count = max(counts.items(), key=lambda item: item[1])
+    return release if count >= 3 else None
+
+
+def derive_metadata(filename, text=None):
+    """Best-effort metadata for a document from its filename and text."""
+    name = (filename or '').lower()
+    metadata = {
+        'product_family': _first_match(PRODUCT_FAMILY_RULES, name),
+        'doc_type': _first_match(DOC_TYPE_RULES, name),
+        'os_release': _os_release(name, text),
+    }
+    if metadata['doc_type'] is None and text and 'raspberrypi.com/documentation' in text[:500]:
+        metadata['doc_type'] = 'documentation'
+    return {key: value for key, value in metadata.items() if value}
+
+
+def parse_metadata(data):
+    """
+    Validate explicitly supplied metadata ({key: value} for METADATA_KEYS).
+    Returns (metadata, error).
+    """
+    if not data:
+        return {}, None
+    if not isinstance(data, dict):
+        return None, "metadata must be an object"
+    metadata = {}
+    for key, value in data.items():
+        if key not in METADATA_KEYS:
+            return None, f"Unknown metadata key '{key}'"
+        if value in (None, ''):
+            continue
+        if not isinstance(value, str) or not _VALUE_PATTERN.match(value):
+            return None, f"Invalid value for metadata key '{key}'"
+        metadata[key] = value.lower()
+    return metadata, None
+
+
+def custom_metadata(metadata, source_url=None):
+    """The custom_metadata list for an upload config."""
+    entries = [{'key': key, 'string_value': value} for key, value in sorted(metadata.items())]
+    if source_url:
+        entries.append({'key': 'source_url', 'string_value': source_url})
+    return entries
+
+
+def parse_filters(data):
+    """
+    Validate chat-time filters: {key: value or [values]} for METADATA_KEYS.
+    Returns (filters, error) with every value as a sorted list.
+    """
+    if not data:
+        return {}, None
+    if not isinstance(data, dict):
+        return None, "filters must be an object"
+    filters = {}
+    for key, values in data.items():
+        if key not in METADATA_KEYS:
+            return None, f"Unknown filter key '{key}'"
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not values:
+            return None, f"Filter '{key}' must be a string or a non-empty list"
+        for value in values:
+            if not isinstance(value, str) or not _VALUE_PATTERN.match(value):
+                return None, f"Invalid value for filter '{key}'"
+        filters[key] = sorted({value.lower() for value in values})
+    return filters, None
+
+
+def metadata_filter(filters):
+    """
+    A FileSearch metadata filter expression (AIP-160) for parsed filters:
+    values of one key are OR'ed, different keys are AND'ed.
+    """
+    clauses = []
+    for key in sorted(filters):
+        terms = [f'{key} = "{value}"' for value in filters[key]]
+        clauses.append(terms[0] if len(terms) == 1 else "(" + " OR ".join(terms) + ")")
+    return " AND ".join(clauses) or None
@@ -0,0 +1,47 @@
+"""
+Gunicorn configuration for production serving.
+
+    gunicorn app:app
+
+The app is preloaded once in the master (importing it does no network I/O)
+and forked into workers; each worker builds its own Gemini client on first
+use and resolves the knowledge base stores in the background as it starts.
+Static assets are precompressed (.br/.gz) once when the master starts.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Requests mostly wait on Gemini, so each worker serves several at once.
+# There must be a thread for every slot of the admission lanes in app.py (plus
+# a few for unlaned routes such as static files and job progress streams), or
+# a chat burst takes every thread before the chat lane fills and the admin
+# and read lanes stop protecting their routes.
+worker_class = "gthread"
+LANE_THREADS = sum(int(os.getenv(name, default)) for name, default in (
+    ("CHAT_MAX_CONCURRENT", "16"),
+    ("ADMIN_MAX_CONCURRENT", "2"),
+    ("READ_MAX_CONCURRENT", "8"),
+    ("BATCH_MAX_CONCURRENT", "2"),
+))
+threads = int(os.getenv("GUNICORN_THREADS", LANE_THREADS + 4))
+preload_app = True
+# Ingest job progress streams stay open while uploads index (up to UPLOAD_DEADLINE_SECONDS)
+timeout = int(float(os.getenv("UPLOAD_DEADLINE_SECONDS", "900"))) + 30
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+
+def on_starting(server):
+    import mimetypes
+    from http_compression import precompress_folder
+    written = precompress_folder(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"),
+                                 lambda name: mimetypes.guess_type(name)[0])
+    server.log.info("Precompressed %d static files", len(written))
+
+
+def post_fork(server, worker):
+    import app
+    app.warm_up()
@@ -0,0 +1,155 @@
+"""
+Hedging Module
+
+Hedged upstream calls: if the first attempt has not answered within a
+percentile of recently observed latency, a second identical attempt is
+started and whichever finishes first wins.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class HedgePolicy:
+    """
+    Latency-percentile hedging with a cap on the fraction of hedged calls.
+
+    Losing attempts cannot be interrupted once their HTTP request is on the
+    wire; their result is simply ignored (an attempt still queued in the
+    executor is cancelled). Size `max_workers` to twice the number of calls
+    that may run at once, so neither attempt waits for a thread. call_async()
+    hedges coroutines instead, where the losing attempt is cancelled outright.
+    """
+
+    def __init__(self, enabled=False, percentile=95, max_hedge_ratio=0.05,
+                 min_samples=20, window=500, max_workers=16):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None if there is too little data."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    def _timed(self, fn):
+        start = time.monotonic()
+        result = fn()
+        self._record(time.monotonic() - start)
+        return result
+
+    def _may_hedge(self):
+        with self._lock:
+            return self.hedges < self.max_hedge_ratio * self.calls
+
+    def call(self, fn):
+        """Run `fn()`, hedging it with a second attempt if it is slow."""
+        with self._lock:
+            self.calls += 1
+        delay = self.hedge_delay() if self.enabled else None
+        if delay is None:
+            return self._timed(fn)
+
+        started = threading.Event()
+
+        def run_primary():
+            started.set()
+            return self._timed(fn)
+
+        primary = self._executor.submit(run_primary)
+        # The delay counts from when the primary starts, not from time spent
+        # queued for an executor thread
+        started.wait()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._may_hedge():
+            return primary.result()
+
+        with self._lock:
+            self.hedges += 1
+        hedge = self._executor.submit(self._timed, fn)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _timed_async(self, fn):
+        start = time.monotonic()
+        result = await fn()
+        self._record(time.monotonic() - start)
+        return result
+
+    async def call_async(self, fn):
+        """Await `fn()`, hedging it with a second attempt if it is slow."""
+        with self._lock:
+            self.calls += 1
+        delay = self.hedge_delay() if self.enabled else None
+        if delay is None:
+            return await self._timed_async(fn)
+
+        primary = asyncio.ensure_future(self._timed_async(fn))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not self._may_hedge():
+            return await primary
+
+        with self._lock:
+            self.hedges += 1
+        hedge = asyncio.ensure_future(self._timed_async(fn))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for loser in pending:
+                loser.cancel()
+
+    def stats(self):
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "percentile": self.percentile,
+                "max_hedge_ratio": self.max_hedge_ratio,
+                "hedge_delay": delay,
+                "samples": len(self._latencies),
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_rate": self.hedges / self.calls if self.calls else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "hedge_win_rate": self.hedge_wins / self.hedges if self.hedges else 0.0,
+            }
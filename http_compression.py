@@ -0,0 +1,113 @@
+"""
+HTTP Compression Module
+
+Content-coding negotiation (Accept-Encoding) and gzip/brotli compression
+for responses, plus a build step that writes precompressed .br/.gz
+siblings for static assets:
+
+    python http_compression.py static
+
+Brotli is optional: without the `brotli` package only gzip is offered.
+"""
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Media types worth compressing; images, PDFs and archives are already compressed
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml',
+    'image/svg+xml',
+)
+MIN_SIZE = 1024
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def available_encodings():
+    """Encodings this process can produce, in order of preference."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def is_compressible(mimetype):
+    return bool(mimetype) and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encoding, encodings=None):
+    """
+    The preferred encoding from `encodings` that the Accept-Encoding header
+    allows (highest q-value, ties going to the earlier entry), or None.
+    """
+    encodings = available_encodings() if encodings is None else encodings
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(data, encoding, level=None):
+    """Compress bytes with 'br' or 'gzip'; `level` defaults to a fast setting."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=5 if level is None else level)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6 if level is None else level, mtime=0)
+    raise ValueError(f"Unsupported encoding '{encoding}'")
+
+
+def precompressed_path(path, encoding):
+    """The .br/.gz sibling of a static file, if it exists and is up to date."""
+    candidate = path + SUFFIXES[encoding]
+    try:
+        if os.path.getmtime(candidate) >= os.path.getmtime(path):
+            return candidate
+    except OSError:
+        pass
+    return None
+
+
+def precompress_folder(folder, mimetype_of):
+    """Write maximum-compression .br/.gz siblings for compressible files in `folder`."""
+    written = []
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            if filename.endswith(tuple(SUFFIXES.values())) or not is_compressible(mimetype_of(filename)):
+                continue
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < MIN_SIZE:
+                continue
+            for encoding in available_encodings():
+                level = 11 if encoding == 'br' else 9
+                with open(path + SUFFIXES[encoding], 'wb') as f:
+                    f.write(compress(data, encoding, level))
+                written.append(path + SUFFIXES[encoding])
+    return written
+
+
+if __name__ == '__main__':
+    import mimetypes
+
+    for path in precompress_folder(sys.argv[1] if len(sys.argv) > 1 else 'static',
+                                   lambda name: mimetypes.guess_type(name)[0]):
+        print(path)
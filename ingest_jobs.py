@@ -0,0 +1,360 @@
+"""
+Ingest Jobs Module
+
+A background queue for knowledge base uploads. A job is a list of local
+files to upload and index into one store; submitting it returns at once,
+and a bounded pool of worker threads uploads the files one at a time per
+worker, recording each file's outcome.
+
+Every job has an append-only journal (one JSON object per line: the job
+itself, then each status change), so its state survives a restart. Worker
+processes that share the journal folder each run the jobs they accepted;
+when a process starts, it resumes the unfinished jobs of processes that
+are gone. A file that was uploading when its process died is uploaded
+again with `replace` set, so the runner can delete a half-recorded copy.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; processes then do not coordinate resumes
+    fcntl = None
+
+# Job and file states
+QUEUED = "queued"
+RUNNING = "running"
+UPLOADING = "uploading"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+PARTIAL = "partial"
+FINISHED = (SUCCEEDED, FAILED, PARTIAL)
+
+
+class JobQueueFull(Exception):
+    """Too many unfinished jobs; `retry_after` is a hint in seconds."""
+
+    def __init__(self, pending, retry_after=30):
+        super().__init__(f"Too many ingest jobs in progress ({pending}), try again later")
+        self.pending = pending
+        self.retry_after = retry_after
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _apply(job, event):
+    """Apply one journal event to a job dict."""
+    at = event.get("at")
+    if "owner" in event:
+        job["owner"] = event["owner"]
+    if "file" in event:
+        file = job["files"][event["file"]]
+        file["status"] = event["status"]
+        if event["status"] == UPLOADING:
+            file["attempts"] += 1
+            file["started_at"] = at
+        else:
+            file["finished_at"] = at
+            file["error"] = event.get("error")
+            file["document"] = event.get("document")
+        if job["status"] == QUEUED:
+            job["status"] = RUNNING
+            job["started_at"] = at
+    if "finished" in event:
+        job["status"] = event["finished"]
+        job["finished_at"] = at
+    job["version"] += 1
+
+
+def _new_job(job_id, kind, store, files, options, owner):
+    return {
+        "id": job_id,
+        "kind": kind,
+        "store": store,
+        "options": options or {},
+        "status": QUEUED,
+        "owner": owner,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "version": 0,
+        "files": [
+            dict(file, status=QUEUED, attempts=0, error=None, document=None, started_at=None, finished_at=None)
+            for file in files
+        ],
+    }
+
+
+def snapshot(job):
+    """The public view of a job: status and per-file progress, without local paths or configs."""
+    counts = {}
+    for file in job["files"]:
+        counts[file["status"]] = counts.get(file["status"], 0) + 1
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "store": job["store"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "version": job["version"],
+        "total": len(job["files"]),
+        "counts": counts,
+        "files": [
+            {key: file[key] for key in ("filename", "status", "attempts", "error", "document")}
+            for file in job["files"]
+        ],
+    }
+
+
+class JobQueue:
+    """
+    `run_file(job, file)` uploads one file of a job (file is the submitted
+    dict plus status fields; `file["replace"]` is set on a retry after a
+    crash) and returns the new document's name. Exceptions fail the file.
+    `on_finish(job)` is called once a job's files are all done.
+    """
+
+    def __init__(self, run_file, journal_dir, workers=2, max_pending=100, on_finish=None,
+                 retention_hours=24, max_in_memory=200):
+        self.run_file = run_file
+        self.journal_dir = journal_dir
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.on_finish = on_finish
+        self.retention_hours = retention_hours
+        self.max_in_memory = max_in_memory
+        self._jobs = OrderedDict()   # job id -> job, the ones this process ran or runs
+        self._queue = queue.Queue()  # (job id, file index)
+        self._changed = threading.Condition()
+        self._started_pid = None
+        self.resumed = 0
+
+    def _journal_path(self, job_id):
+        return os.path.join(self.journal_dir, f"{job_id}.jsonl")
+
+    def _append(self, job_id, record):
+        with open(self._journal_path(job_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def _load(self, job_id):
+        """Replay a job's journal, or None if there is none."""
+        try:
+            with open(self._journal_path(job_id), 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except (OSError, ValueError):
+            return None
+        job = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:  # A line cut short by a crash
+                continue
+            if job is None:
+                job = record
+            else:
+                _apply(job, record)
+        return job
+
+    def start(self):
+        """Start the workers and resume orphaned jobs (once per process)."""
+        with self._changed:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            # Jobs and threads of a parent process do not carry over a fork
+            self._jobs.clear()
+            self._queue = queue.Queue()
+        os.makedirs(self.journal_dir, exist_ok=True)
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True).start()
+        self._resume_orphans()
+
+    def _resume_orphans(self):
+        lock = open(os.path.join(self.journal_dir, ".lock"), "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            cutoff = time.time() - self.retention_hours * 3600
+            for name in sorted(os.listdir(self.journal_dir)):
+                if not name.endswith(".jsonl"):
+                    continue
+                job = self._load(name[:-len(".jsonl")])
+                if job is None:
+                    continue
+                if job["status"] in FINISHED:
+                    if (job["finished_at"] or 0) < cutoff:
+                        os.remove(self._journal_path(job["id"]))
+                    continue
+                owner = job.get("owner")
+                if owner != os.getpid() and _pid_alive(owner):
+                    continue
+                self._append(job["id"], {"owner": os.getpid(), "at": time.time()})
+                job["owner"] = os.getpid()
+                pending = []
+                for index, file in enumerate(job["files"]):
+                    if file["status"] == UPLOADING:
+                        file["replace"] = True
+                    if file["status"] in (QUEUED, UPLOADING):
+                        file["status"] = QUEUED
+                        pending.append(index)
+                self._remember(job)
+                print(f"Resuming ingest job {job['id']} ({len(pending)} of {len(job['files'])} files left)")
+                self.resumed += 1
+                if pending:
+                    for index in pending:
+                        self._queue.put((job["id"], index))
+                else:
+                    self._finish(job)
+        finally:
+            lock.close()
+
+    def _remember(self, job):
+        with self._changed:
+            self._jobs[job["id"]] = job
+            # Forget the oldest finished jobs; their journals still answer get()
+            finished = [job_id for job_id, known in self._jobs.items() if known["status"] in FINISHED]
+            for job_id in finished[:max(0, len(self._jobs) - self.max_in_memory)]:
+                del self._jobs[job_id]
+
+    def pending(self):
+        with self._changed:
+            return sum(1 for job in self._jobs.values() if job["status"] not in FINISHED)
+
+    def check_capacity(self):
+        """Raise JobQueueFull if a job submitted now would be refused."""
+        pending = self.pending()
+        if pending >= self.max_pending:
+            raise JobQueueFull(pending)
+
+    def submit(self, kind, store, files, options=None):
+        """Queue a job for `files` ([{filename, local_path, config}]) and return its snapshot."""
+        self.start()
+        self.check_capacity()
+        job = _new_job(uuid.uuid4().hex, kind, store, files, options, os.getpid())
+        record = {key: value for key, value in job.items() if key != "files"}
+        record["files"] = [dict(file) for file in job["files"]]
+        self._append(job["id"], record)
+        self._remember(job)
+        for index in range(len(files)):
+            self._queue.put((job["id"], index))
+        if not files:
+            self._finish(job)
+        return snapshot(job)
+
+    def _record(self, job, event):
+        event["at"] = time.time()
+        with self._changed:
+            # Under the lock, so the journal has events in the order they were applied
+            self._append(job["id"], event)
+            _apply(job, event)
+            self._changed.notify_all()
+
+    def _work(self):
+        while True:
+            job_id, index = self._queue.get()
+            with self._changed:
+                job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            file = job["files"][index]
+            self._record(job, {"file": index, "status": UPLOADING})
+            try:
+                document = self.run_file(job, file)
+                self._record(job, {"file": index, "status": SUCCEEDED, "document": document})
+            except Exception as e:
+                print(f"Ingest job {job_id}: {file['filename']} failed: {e}")
+                self._record(job, {"file": index, "status": FAILED, "error": str(e)})
+            with self._changed:
+                done = not job.get("finishing") and all(
+                    f["status"] in (SUCCEEDED, FAILED) for f in job["files"]
+                )
+                if done:
+                    # Claimed here so only one worker finishes the job
+                    job["finishing"] = True
+            if done:
+                self._finish(job)
+
+    def _finish(self, job):
+        succeeded = sum(1 for file in job["files"] if file["status"] == SUCCEEDED)
+        if succeeded == len(job["files"]):
+            status = SUCCEEDED
+        else:
+            status = FAILED if succeeded == 0 else PARTIAL
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                print(f"Ingest job {job['id']}: finishing failed: {e}")
+        self._record(job, {"finished": status})
+        print(f"Ingest job {job['id']} {status}: {succeeded} of {len(job['files'])} files")
+
+    def get(self, job_id):
+        """A job's snapshot, from memory or (for other processes' jobs) its journal; None if unknown."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return snapshot(job)
+        if not job_id.isalnum():
+            return None
+        job = self._load(job_id)
+        return snapshot(job) if job else None
+
+    def wait(self, job_id, version, timeout):
+        """The job's snapshot once its version is past `version`, or the current one after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                while job["version"] <= version and job["status"] not in FINISHED:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                return snapshot(job)
+        # Run by another process: poll its journal
+        while True:
+            current = self.get(job_id)
+            if current is None or current["version"] > version or current["status"] in FINISHED:
+                return current
+            if time.monotonic() >= deadline:
+                return current
+            time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+
+    def recent(self, limit=50):
+        """Snapshots of the most recently created jobs in the journal folder."""
+        try:
+            names = [name for name in os.listdir(self.journal_dir) if name.endswith(".jsonl")]
+        except OSError:
+            return []
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(self.journal_dir, name)), reverse=True)
+        jobs = [self.get(name[:-len(".jsonl")]) for name in names[:limit]]
+        jobs = [job for job in jobs if job is not None]
+        jobs.sort(key=lambda job: job["created_at"], reverse=True)
+        return jobs
+
+    def stats(self):
+        with self._changed:
+            by_status = {}
+            for job in self._jobs.values():
+                by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+        return {
+            "workers": self.workers,
+            "queued_files": self._queue.qsize(),
+            "jobs": by_status,
+            "resumed": self.resumed,
+        }
@@ -0,0 +1,50 @@
+"""
+Latency Stats Module
+
+Rolling latency percentiles grouped by a label, e.g. per instruction
+profile and model, for tuning generation settings.
+"""
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """Keeps the last `window` samples for each (group, subgroup) pair."""
+
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, group, subgroup, seconds):
+        key = (group, subgroup)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    @staticmethod
+    def _summary(samples, count):
+        ordered = sorted(samples)
+
+        def pct(p):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 1)
+        return {
+            "count": count,
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+        }
+
+    def stats(self):
+        """Return {group: {subgroup: {count, mean_ms, p50_ms, p95_ms, p99_ms}}}."""
+        with self._lock:
+            snapshot = {key: (list(samples), self._counts[key]) for key, samples in self._samples.items()}
+        result = {}
+        for (group, subgroup), (samples, count) in sorted(snapshot.items()):
+            result.setdefault(group, {})[subgroup] = self._summary(samples, count)
+        return result
@@ -0,0 +1,164 @@
+"""
+Line Locator Module
+
+Finds where a retrieved chunk's text occurs in the local copy of its source
+document, so citations can link to a line range instead of a whole file.
+
+Each file is indexed once by the line number of every word and a sample of
+its word shingles (runs of SHINGLE_WORDS consecutive words). Shingles are
+sampled by hash rather than by position, so a chunk selects the same
+shingles as the file it was cut from whatever its alignment, and whitespace
+or line wrapping differences between the chunk and the file do not matter.
+A lookup hashes the chunk's shingles, lets every indexed match vote for the
+word where the chunk starts, and reads the lines of the chunk's first and
+last words from there. Files are re-indexed one at a time when their size
+or mtime changes.
+"""
+import os
+import re
+import threading
+import zlib
+from array import array
+from collections import Counter
+
+_WORD = re.compile(r"\w+")
+
+SHINGLE_WORDS = 6
+# Index one shingle in SAMPLE_RATE (chosen by hash)
+SAMPLE_RATE = 4
+# Shingles occurring more often than this in a file (boilerplate) do not vote
+MAX_OCCURRENCES = 8
+
+
+def _words(text):
+    """Lowercased words of text and an array of the (1-based) line each is on."""
+    words = []
+    word_lines = array('L')
+    for number, line in enumerate(text.lower().split("\n"), 1):
+        found = _WORD.findall(line)
+        words.extend(found)
+        word_lines.extend([number] * len(found))
+    return words, word_lines
+
+
+def _sampled_shingles(words):
+    """Yield (hash, index of first word) of every sampled shingle."""
+    hashes = [zlib.crc32(word.encode("utf-8")) for word in words]
+    runs = zip(*(hashes[i:] for i in range(SHINGLE_WORDS)))
+    for i, value in enumerate(map(hash, runs)):
+        if value % SAMPLE_RATE == 0:
+            yield value, i
+
+
+class LineLocator:
+    """Per-file shingle indexes keyed by doc id, looked up by document title."""
+
+    def __init__(self, min_votes=2):
+        self.min_votes = min_votes
+        self._files = {}        # doc_id -> {title, path, signature, word_lines, shingles}
+        self._by_title = {}     # title -> set of doc ids
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def add_file(self, doc_id, path, title):
+        """Index (or re-index) a file unless it is unchanged since last indexed.
+
+        Returns False for files that are missing or not UTF-8 text (they are
+        dropped from the index).
+        """
+        try:
+            signature = self._signature(path)
+            with self._lock:
+                current = self._files.get(doc_id)
+                if current and current["signature"] == signature and current["title"] == title:
+                    return True
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            self.remove_file(doc_id)
+            return False
+        words, word_lines = _words(text)
+        shingles = {}
+        for value, word_index in _sampled_shingles(words):
+            shingles.setdefault(value, []).append(word_index)
+        entry = {
+            "title": title,
+            "path": path,
+            "signature": signature,
+            "word_lines": word_lines,
+            "shingles": shingles,
+        }
+        with self._lock:
+            self._remove_locked(doc_id)
+            self._files[doc_id] = entry
+            self._by_title.setdefault(title, set()).add(doc_id)
+        return True
+
+    def remove_file(self, doc_id):
+        with self._lock:
+            return self._remove_locked(doc_id)
+
+    def remove_files(self, predicate):
+        """Remove every file whose doc id satisfies `predicate`."""
+        with self._lock:
+            doomed = [doc_id for doc_id in self._files if predicate(doc_id)]
+            for doc_id in doomed:
+                self._remove_locked(doc_id)
+            return len(doomed)
+
+    def _remove_locked(self, doc_id):
+        entry = self._files.pop(doc_id, None)
+        if entry is None:
+            return False
+        titles = self._by_title[entry["title"]]
+        titles.discard(doc_id)
+        if not titles:
+            del self._by_title[entry["title"]]
+        return True
+
+    def locate(self, title, text, doc_filter=None):
+        """
+        The (doc_id, start_line, end_line) where `text` occurs in a file
+        titled `title` (1-based, inclusive lines), or None if it cannot be
+        placed with confidence. `doc_filter(doc_id)` restricts the files.
+        """
+        if not title or not text:
+            return None
+        words, _ = _words(text)
+        query = list(_sampled_shingles(words))
+        if not query:
+            return None
+        with self._lock:
+            candidates = [(doc_id, self._files[doc_id]) for doc_id in self._by_title.get(title, ())
+                          if doc_filter is None or doc_filter(doc_id)]
+        best = None
+        for doc_id, entry in candidates:
+            shingles = entry["shingles"]
+            # Each match votes for the file word where the chunk would start
+            votes = Counter()
+            for value, query_index in query:
+                positions = shingles.get(value, ())
+                if len(positions) <= MAX_OCCURRENCES:
+                    votes.update(word_index - query_index for word_index in positions)
+            if not votes:
+                continue
+            first_word, count = votes.most_common(1)[0]
+            if count >= self.min_votes and (best is None or count > best[0]):
+                best = (count, doc_id, entry, first_word)
+        if best is None:
+            return None
+        _, doc_id, entry, first_word = best
+        word_lines = entry["word_lines"]
+        last_word = min(first_word + len(words), len(word_lines)) - 1
+        return doc_id, word_lines[max(first_word, 0)], word_lines[last_word]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "shingles": sum(len(entry["shingles"]) for entry in self._files.values()),
+            }
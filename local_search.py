@@ -0,0 +1,187 @@
+"""
+Local Search Module
+
+An in-memory BM25 index over the local copies of knowledge base documents,
+used for offline keyword search and as a degraded answer source when Gemini
+is unavailable. Documents are split into passages of whole lines, so every
+hit carries the line range it came from, and can be added, replaced or
+removed one at a time as the upload folders change.
+"""
+import math
+import re
+import threading
+from collections import Counter
+
+from similarity_index import STOPWORDS
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords, with plural 's' stripped."""
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def split_passages(text, max_chars=1200):
+    """
+    Split text into passages of whole lines, breaking at blank lines where
+    possible. Returns a list of (start_line, end_line, text) with 1-based,
+    inclusive line numbers.
+    """
+    passages = []
+    lines = text.splitlines()
+    start = None
+    size = 0
+    for number, line in enumerate(lines, 1):
+        if start is None:
+            if not line.strip():
+                continue
+            start = number
+        size += len(line) + 1
+        at_break = not line.strip() or number == len(lines)
+        # Prefer paragraph breaks; split long paragraphs once they are
+        # well over the limit
+        if (at_break and size >= max_chars // 2) or size >= max_chars * 3 // 2 or number == len(lines):
+            end = number
+            while end > start and not lines[end - 1].strip():
+                end -= 1
+            passages.append((start, end, "\n".join(lines[start - 1:end])))
+            start = None
+            size = 0
+    return passages
+
+
+class LocalSearchIndex:
+    """
+    BM25 (Okapi) over passages. Postings map each term to the passages it
+    occurs in with its frequency; document frequencies and the average
+    passage length are kept current as documents come and go, so no
+    rebuild is needed after an incremental update.
+    """
+
+    def __init__(self, k1=1.2, b=0.75, passage_chars=1200):
+        self.k1 = k1
+        self.b = b
+        self.passage_chars = passage_chars
+        self._documents = {}    # doc_id -> {"fields": dict, "passages": [passage ids]}
+        self._passages = {}     # passage id -> {doc_id, start_line, end_line, text, length}
+        self._postings = {}     # term -> {passage id: term frequency}
+        self._total_length = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add_document(self, doc_id, text, **fields):
+        """Index (or re-index) a document; `fields` are returned with its hits."""
+        passages = []
+        for start_line, end_line, passage in split_passages(text, self.passage_chars):
+            terms = Counter(tokenize(passage))
+            if terms:
+                passages.append((start_line, end_line, passage, terms))
+        with self._lock:
+            self._remove_locked(doc_id)
+            ids = []
+            for start_line, end_line, passage, terms in passages:
+                passage_id = self._next_id
+                self._next_id += 1
+                length = sum(terms.values())
+                self._passages[passage_id] = {
+                    "doc_id": doc_id,
+                    "start_line": start_line,
+                    "end_line": end_line,
+                    "text": passage,
+                    "length": length,
+                }
+                self._total_length += length
+                for term, count in terms.items():
+                    self._postings.setdefault(term, {})[passage_id] = count
+                ids.append(passage_id)
+            self._documents[doc_id] = {"fields": fields, "passages": ids}
+        return len(passages)
+
+    def remove_document(self, doc_id):
+        with self._lock:
+            return self._remove_locked(doc_id)
+
+    def remove_documents(self, predicate):
+        """Remove every document whose id satisfies `predicate`."""
+        with self._lock:
+            doomed = [doc_id for doc_id in self._documents if predicate(doc_id)]
+            for doc_id in doomed:
+                self._remove_locked(doc_id)
+            return len(doomed)
+
+    def _remove_locked(self, doc_id):
+        document = self._documents.pop(doc_id, None)
+        if document is None:
+            return False
+        for passage_id in document["passages"]:
+            passage = self._passages.pop(passage_id)
+            self._total_length -= passage["length"]
+            for term in set(tokenize(passage["text"])):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(passage_id, None)
+                    if not postings:
+                        del self._postings[term]
+        return True
+
+    def search(self, query, limit=5, doc_filter=None, max_per_document=2):
+        """
+        The best matching passages for `query` as a list of dicts with the
+        document's fields, doc_id, start_line, end_line, text and score.
+        `doc_filter(doc_id)` restricts the documents searched.
+        """
+        terms = Counter(tokenize(query))
+        with self._lock:
+            count = len(self._passages)
+            if not terms or not count:
+                return []
+            average_length = self._total_length / count
+            scores = {}
+            for term, query_count in terms.items():
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for passage_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._passages[passage_id]["length"] / average_length)
+                    scores[passage_id] = (
+                        scores.get(passage_id, 0.0)
+                        + query_count * idf * frequency * (self.k1 + 1) / (frequency + norm)
+                    )
+            results = []
+            per_document = Counter()
+            for passage_id, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+                passage = self._passages[passage_id]
+                doc_id = passage["doc_id"]
+                if doc_filter is not None and not doc_filter(doc_id):
+                    continue
+                if per_document[doc_id] >= max_per_document:
+                    continue
+                per_document[doc_id] += 1
+                results.append(dict(
+                    self._documents[doc_id]["fields"],
+                    doc_id=doc_id,
+                    start_line=passage["start_line"],
+                    end_line=passage["end_line"],
+                    text=passage["text"],
+                    score=round(score, 3),
+                ))
+                if len(results) >= limit:
+                    break
+            return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                "documents": len(self._documents),
+                "passages": len(self._passages),
+                "terms": len(self._postings),
+            }
@@ -0,0 +1,244 @@
+"""
+Resilience Module
+
+Deadlines, jittered exponential retries limited by a retry budget, and
+circuit breakers for calls to the Gemini API.
+"""
+import asyncio
+import random
+import threading
+import time
+
+
+class UpstreamUnavailable(Exception):
+    """Base class for failures raised by the resilience layer itself."""
+
+    retry_after = None
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """The request deadline passed before the upstream call could complete."""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """The circuit breaker for an upstream operation is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Upstream '{name}' is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """An absolute point in time by which a request must finish."""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a fraction of traffic.
+    Every call deposits `ratio` tokens (up to `max_tokens`); every retry
+    withdraws one, so a failing upstream is not hit with a retry storm.
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    @property
+    def tokens(self):
+        with self._lock:
+            return self._tokens
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and fails fast for
+    `reset_timeout` seconds, then lets a single probe call through
+    (half-open) to decide whether to close again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def allow(self):
+        """Raise CircuitOpenError if calls should not be attempted."""
+        with self._lock:
+            if self.state == self.OPEN:
+                waited = time.monotonic() - self._opened_at
+                if waited < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout - waited)
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"Circuit '{self.name}' opened after {self._failures} failures")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self._failures,
+                "rejected": self.rejected,
+            }
+
+
+class ResilientCaller:
+    """
+    Wraps upstream calls with a deadline, retries and a per-operation
+    circuit breaker. `is_retryable(exc)` decides which errors count as
+    upstream failures; anything else (e.g. a 4xx) is raised immediately and
+    does not trip the breaker.
+    """
+
+    def __init__(self, is_retryable, max_attempts=3, base_delay=0.5, max_delay=8.0,
+                 retry_budget=None, failure_threshold=5, reset_timeout=30):
+        self.is_retryable = is_retryable
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget or RetryBudget()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+
+    def breaker(self, name):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(
+                    name, self.failure_threshold, self.reset_timeout
+                )
+            return self._breakers[name]
+
+    def call(self, name, fn, deadline=None, retry=True):
+        """
+        Call `fn(timeout)` where timeout is the remaining deadline in seconds
+        (or None). Retries retryable errors with full-jitter exponential
+        backoff while the deadline and retry budget allow.
+        """
+        breaker = self.breaker(name)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = self._start_attempt(name, breaker, deadline)
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                backoff = self._backoff_after(name, breaker, e, attempt, deadline, retry)
+                if backoff is None:
+                    raise
+                time.sleep(backoff)
+                continue
+            breaker.record_success()
+            return result
+
+    async def call_async(self, name, fn, deadline=None, retry=True):
+        """Like call(), for a coroutine function `fn(timeout)`; backs off with asyncio.sleep."""
+        breaker = self.breaker(name)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = self._start_attempt(name, breaker, deadline)
+            try:
+                result = await fn(timeout)
+            except Exception as e:
+                backoff = self._backoff_after(name, breaker, e, attempt, deadline, retry)
+                if backoff is None:
+                    raise
+                await asyncio.sleep(backoff)
+                continue
+            breaker.record_success()
+            return result
+
+    def _start_attempt(self, name, breaker, deadline):
+        """Check the deadline and breaker; returns the timeout for this attempt."""
+        timeout = None
+        if deadline is not None:
+            timeout = deadline.remaining()
+            if timeout <= 0:
+                raise DeadlineExceeded(f"Deadline exceeded calling '{name}'")
+        breaker.allow()
+        return timeout
+
+    def _backoff_after(self, name, breaker, e, attempt, deadline, retry):
+        """Record a failed attempt. Returns the delay before retrying, or None to re-raise."""
+        if not self.is_retryable(e):
+            breaker.record_success()
+            return None
+        breaker.record_failure()
+        if not retry or attempt >= self.max_attempts:
+            return None
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if deadline is not None and backoff >= deadline.remaining():
+            return None
+        if not self.retry_budget.withdraw():
+            return None
+        with self._lock:
+            self.retries += 1
+        print(f"Retrying '{name}' after {type(e).__name__} (attempt {attempt + 1})")
+        return backoff
+
+    def stats(self):
+        with self._lock:
+            breakers = {name: b.stats() for name, b in self._breakers.items()}
+            retries = self.retries
+        return {
+            "retries": retries,
+            "retry_budget_tokens": round(self.retry_budget.tokens, 2),
+            "breakers": breakers,
+        }
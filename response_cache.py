@@ -0,0 +1,290 @@
+"""
+Response Cache Module
+
+In-memory LRU + TTL cache for grounded chat answers, with an optional
+on-disk persistence tier and stale-while-revalidate support.
+
+The knowledge-base revision is kept in a file (revision.json in the
+persistence folder by default), so worker processes sharing it see each
+other's bumps: every lookup checks the file's mtime and drops the in-memory
+entries when another process has moved the revision on. Disk entries are
+named after their revision, so entries of older revisions are swept, and
+the disk tier is bounded to `max_disk_entries` (oldest written first out).
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Disk entry file names: r<revision>_<key>.json (and <key>.json from before revisions were in the name)
+_DISK_ENTRY = re.compile(r"(?:r(\d+)_)?[0-9a-f]{64}\.json")
+
+
+class ResponseCache:
+    """
+    Caches chat answers keyed on the normalized question, system instruction,
+    model and knowledge-base revision.
+
+    Entries older than `ttl` are stale; stale entries younger than
+    `ttl + stale_ttl` are still returned (flagged as stale) so the caller can
+    serve them while refreshing in the background.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, stale_ttl=0, persist_dir=None, revision_path=None,
+                 max_disk_entries=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.persist_dir = persist_dir
+        self.revision_path = revision_path or (os.path.join(persist_dir, "revision.json") if persist_dir else None)
+        self.max_disk_entries = max_disk_entries or max_entries * 10
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._revision_mtime = None
+        self._puts_since_sweep = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revision = 0
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+        if self.revision_path:
+            self._sync_revision()
+        if self.persist_dir:
+            self._sweep_disk_async()
+
+    @staticmethod
+    def normalize_message(message):
+        """Lowercase, collapse whitespace and drop trailing punctuation."""
+        text = re.sub(r"\s+", " ", (message or "").strip().lower())
+        return text.rstrip(" ?!.")
+
+    def make_key(self, message, instruction, model, scope=""):
+        """Build the cache key for a question at the current revision."""
+        self._sync_revision()
+        raw = json.dumps([
+            self.normalize_message(message),
+            instruction or "",
+            model,
+            scope,
+            self.revision,
+        ])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key, record_stats=True, allow_expired=False):
+        """
+        Look up an entry. Returns (value, state) where state is 'hit',
+        'stale' or 'miss'. With `allow_expired`, entries past the stale window
+        are returned as 'expired' instead of being dropped (used as a fallback
+        while upstream is down).
+        """
+        now = time.time()
+        self._sync_revision()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.persist_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self._lock:
+                    self._store(key, entry)
+
+        state = "miss"
+        if entry is not None:
+            age = now - entry["stored_at"]
+            if age <= self.ttl:
+                state = "hit"
+            elif age <= self.ttl + self.stale_ttl:
+                state = "stale"
+            elif allow_expired:
+                state = "expired"
+            else:
+                self.invalidate(key)
+                entry = None
+
+        if not record_stats:
+            return (entry["value"] if entry else None), state
+        with self._lock:
+            if state == "hit":
+                self.hits += 1
+            elif state == "stale":
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+        return (entry["value"] if entry else None), state
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entry if full."""
+        entry = {"stored_at": time.time(), "value": value}
+        with self._lock:
+            self._store(key, entry)
+            self._puts_since_sweep += 1
+            sweep = self._puts_since_sweep >= max(1, self.max_disk_entries // 10)
+            if sweep:
+                self._puts_since_sweep = 0
+        if self.persist_dir:
+            self._write_disk(key, entry)
+            if sweep:
+                self._sweep_disk_async()
+
+    def invalidate(self, key):
+        """Remove a single entry from memory and disk."""
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.persist_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def bump_revision(self):
+        """Advance the knowledge-base revision so existing keys stop matching (in every process)."""
+        with self._lock:
+            # Start from the newest revision any process has written
+            if self.revision_path:
+                self.revision = max(self.revision, self._load_revision())
+            self.revision += 1
+            self._entries.clear()
+            revision = self.revision
+            if self.revision_path:
+                self._save_revision(revision)
+        if self.persist_dir:
+            self._sweep_disk_async()
+        return revision
+
+    def _sync_revision(self):
+        """Pick up a revision written by another process (checked by the file's mtime)."""
+        if not self.revision_path:
+            return
+        try:
+            mtime = os.stat(self.revision_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._revision_mtime:
+            return
+        revision = self._load_revision()
+        with self._lock:
+            self._revision_mtime = mtime
+            if revision > self.revision:
+                self.revision = revision
+                self._entries.clear()
+
+    def begin_refresh(self, key):
+        """Claim a background refresh for `key`; False if one is already running."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "revision": self.revision,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+                "persistent": bool(self.persist_dir),
+            }
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.persist_dir, f"r{self.revision}_{key}.json")
+
+    def _sweep_disk_async(self):
+        threading.Thread(target=self._sweep_disk, name="cache-sweep", daemon=True).start()
+
+    def _sweep_disk(self):
+        """Delete disk entries of older revisions, then the oldest ones beyond max_disk_entries."""
+        # Entries of a newer revision another process moved to are not old
+        self._sync_revision()
+        current = self.revision
+        entries = []
+        removed = 0
+        try:
+            names = os.listdir(self.persist_dir)
+        except OSError:
+            return
+        for name in names:
+            match = _DISK_ENTRY.fullmatch(name)
+            if not match:
+                continue
+            revision = int(match.group(1) or -1)
+            path = os.path.join(self.persist_dir, name)
+            try:
+                if revision < current:
+                    os.remove(path)
+                    removed += 1
+                else:
+                    entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_disk_entries)]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"Swept {removed} cache entries from {self.persist_dir}")
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error reading cache entry {key}: {e}")
+            return None
+
+    def _write_disk(self, key, entry):
+        try:
+            tmp_path = self._disk_path(key) + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._disk_path(key))
+        except Exception as e:
+            print(f"Error writing cache entry {key}: {e}")
+
+    def _load_revision(self):
+        try:
+            with open(self.revision_path, "r", encoding="utf-8") as f:
+                return int(json.load(f).get("revision", 0))
+        except Exception:
+            return 0
+
+    def _save_revision(self, revision):
+        try:
+            tmp_path = f"{self.revision_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"revision": revision}, f)
+            os.replace(tmp_path, self.revision_path)
+            self._revision_mtime = os.stat(self.revision_path).st_mtime_ns
+        except Exception as e:
+            print(f"Error saving cache revision: {e}")
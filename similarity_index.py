@@ -0,0 +1,229 @@
+"""
+Similarity Index Module
+
+Offline near-duplicate question matching for the response cache.
+Questions are turned into sparse TF-IDF vectors over word tokens and
+character trigrams and matched with cosine similarity through an inverted
+index, so a lookup only touches questions that share a feature.
+"""
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+from operator import itemgetter
+
+
+STOPWORDS = frozenset("""
+a an and are as at be by can could do does for from get how i if in is it
+its me my of on or please should so that the this to use using was what
+when where which who why will with would you your
+""".split())
+
+# Phrase rewrites applied before tokenizing so common paraphrases share terms
+PHRASES = [
+    (r"\b(turn|switch) on\b", "enable"),
+    (r"\b(turn|switch) off\b", "disable"),
+    (r"\bactivate\b", "enable"),
+    (r"\bdeactivate\b", "disable"),
+    (r"\braspberry\s*pi\b", "pi"),
+    (r"\brpi\b", "pi"),
+    (r"\bpower supply\b", "psu"),
+]
+
+
+class _ScopeIndex:
+    """Inverted index for a single instruction profile."""
+
+    def __init__(self):
+        self.entries = []          # id -> dict(question, value, numbers, features, norm)
+        self.by_question = {}      # normalized question -> id
+        self.postings = {}         # feature -> list of (id, weight)
+        self.df = Counter()
+
+
+class SimilarityIndex:
+    """
+    Maps previously answered questions to cache values and finds the closest
+    one for a new question. Indexes are kept per scope (e.g. per system
+    instruction) so answers are never shared across profiles.
+
+    Lookups use prefix filtering: only the rarest query features are used to
+    generate candidates, chosen so that a question sharing none of them
+    cannot reach the threshold. Candidates are then scored exactly.
+
+    Numeric tokens must match exactly: "Pi 4" and "Pi 5" are different
+    questions even if every other word is the same.
+    """
+
+    def __init__(self, threshold=0.8, max_entries_per_scope=100000,
+                 postings_budget=1000, max_candidates=32):
+        self.threshold = threshold
+        self.max_entries_per_scope = max_entries_per_scope
+        # Candidate generation walks at most `postings_budget` postings and
+        # only the `max_candidates` best prefix overlaps are scored in full.
+        # Questions made only of very common terms may then miss the cache
+        # (never match wrongly), which keeps lookups well under a
+        # millisecond at 100k questions.
+        self.postings_budget = postings_budget
+        self.max_candidates = max_candidates
+        self._scopes = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+
+    @staticmethod
+    def _tokens(question):
+        text = (question or "").lower()
+        for pattern, replacement in PHRASES:
+            text = re.sub(pattern, replacement, text)
+        words = re.findall(r"[a-z0-9]+", text)
+        return [w for w in words if w not in STOPWORDS]
+
+    @classmethod
+    def _features(cls, question):
+        """Return (feature counts, numeric tokens) for a question."""
+        features = Counter()
+        numbers = set()
+        for word in cls._tokens(question):
+            if word.isdigit():
+                numbers.add(word)
+            if len(word) > 3 and word.endswith("s"):
+                word = word[:-1]
+            features["w:" + word] += 1.0
+            # Character trigrams catch plurals, typos and run-together words
+            if len(word) >= 5:
+                padded = f" {word} "
+                for i in range(len(padded) - 2):
+                    features["c:" + padded[i:i + 3]] += 0.25
+        return features, frozenset(numbers)
+
+    @staticmethod
+    def _idf(df, total):
+        return math.log((total + 1) / (df + 1)) + 1.0
+
+    def add(self, scope, question, value):
+        """Index a question under `scope`, replacing any previous value."""
+        key = " ".join(self._tokens(question))
+        if not key:
+            return
+        features, numbers = self._features(question)
+        with self._lock:
+            index = self._scopes.setdefault(scope, _ScopeIndex())
+            existing = index.by_question.get(key)
+            if existing is not None:
+                index.entries[existing]["value"] = value
+                return
+            if len(index.entries) >= self.max_entries_per_scope:
+                # Full: start the scope afresh rather than track recency per entry
+                index = self._scopes[scope] = _ScopeIndex()
+
+            doc_id = len(index.entries)
+            for feature, weight in features.items():
+                index.df[feature] += 1
+                index.postings.setdefault(feature, []).append((doc_id, weight))
+            index.entries.append({
+                "question": question,
+                "value": value,
+                "numbers": numbers,
+                "features": features,
+                "norm": None,
+                "norm_total": 0,
+            })
+            index.by_question[key] = doc_id
+            self._norm(index, index.entries[doc_id], doc_id + 1)
+
+    def lookup(self, scope, question, threshold=None):
+        """
+        Find the most similar indexed question in `scope`.
+        Returns (value, matched_question, score) or None.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        features, numbers = self._features(question)
+        with self._lock:
+            self.lookups += 1
+            index = self._scopes.get(scope)
+            if index is None or not features:
+                return None
+            total = len(index.entries)
+            df = index.df
+            idf = self._idf
+
+            query_idf = {f: idf(df.get(f, 0), total) for f in features}
+            query = {f: w * query_idf[f] for f, w in features.items()}
+            query_norm = math.sqrt(sum(w * w for w in query.values())) or 1.0
+
+            # Rarest features first; stop once the remaining (common) features
+            # alone could not push a candidate over the threshold. Partial dot
+            # products over the prefix are accumulated from the postings.
+            ordered = sorted(query, key=lambda f: df.get(f, 0))
+            suffix_sq = sum(w * w for w in query.values())
+            partial = {}
+            prefix = set()
+            budget = self.postings_budget
+            for feature in ordered:
+                if math.sqrt(suffix_sq) / query_norm < threshold:
+                    break
+                postings = index.postings.get(feature, ())
+                budget -= len(postings)
+                if budget < 0:
+                    break
+                suffix_sq -= query[feature] ** 2
+                prefix.add(feature)
+                factor = query[feature] * query_idf[feature]
+                for doc_id, weight in postings:
+                    partial[doc_id] = partial.get(doc_id, 0.0) + factor * weight
+            suffix_bound = math.sqrt(max(suffix_sq, 0.0)) / query_norm
+            suffix = {f: query[f] * query_idf[f] for f in query if f not in prefix}
+            suffix_keys = suffix.keys()
+
+            if len(partial) > self.max_candidates:
+                candidates = heapq.nlargest(self.max_candidates, partial.items(), key=itemgetter(1))
+            else:
+                candidates = partial.items()
+
+            best = None
+            best_score = threshold
+            for doc_id, dot in candidates:
+                entry = index.entries[doc_id]
+                if entry["numbers"] != numbers:
+                    continue
+                doc_norm = self._norm(index, entry, total)
+                # Upper bound: prefix overlap plus a perfect match on the rest
+                if dot / (query_norm * doc_norm) + suffix_bound < best_score:
+                    continue
+                doc_features = entry["features"]
+                for feature in doc_features.keys() & suffix_keys:
+                    dot += suffix[feature] * doc_features[feature]
+                score = dot / (query_norm * doc_norm)
+                if score >= best_score:
+                    best, best_score = entry, score
+            if best is None:
+                return None
+            self.matches += 1
+            return best["value"], best["question"], min(best_score, 1.0)
+
+    def _norm(self, index, entry, total):
+        """Entry vector norm, recomputed once the scope has doubled in size."""
+        if entry["norm_total"] * 2 < total or entry["norm"] is None:
+            entry["norm"] = math.sqrt(sum(
+                (weight * self._idf(index.df[feature], total)) ** 2
+                for feature, weight in entry["features"].items()
+            )) or 1.0
+            entry["norm_total"] = total
+        return entry["norm"]
+
+    def clear(self):
+        """Drop every scope, e.g. after the knowledge base changes."""
+        with self._lock:
+            self._scopes.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "scopes": len(self._scopes),
+                "questions": sum(len(index.entries) for index in self._scopes.values()),
+                "lookups": self.lookups,
+                "matches": self.matches,
+            }
@@ -0,0 +1,111 @@
+"""
+Single Flight Module
+
+Coalesces concurrent identical calls so that only one runs and every
+caller waiting on the same key shares its result.
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self.task = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers that arrive while a call
+    for the same key is in flight block until it finishes and receive the
+    same result (or exception).
+
+    do_async() is the asyncio equivalent; async calls are tracked separately
+    and must all be made from the same event loop.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.max_waiters = 0
+
+    def do(self, key, fn):
+        """
+        Run `fn()` for `key`, or wait for the in-flight call with that key.
+        Returns (result, shared) where shared is True for coalesced callers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.followers += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    async def do_async(self, key, fn):
+        """
+        Await `fn()` for `key`, or the in-flight task with that key.
+        Returns (result, shared). A waiter being cancelled (e.g. the client
+        disconnected) does not cancel the shared upstream call.
+        """
+        with self._lock:
+            call = self._tasks.get(key)
+            shared = call is not None
+            if shared:
+                call.waiters += 1
+                self.followers += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+            else:
+                call = self._tasks[key] = _Call()
+                call.task = asyncio.ensure_future(fn())
+                self.leaders += 1
+                call.task.add_done_callback(lambda task: self._forget(key, call, task))
+        return await asyncio.shield(call.task), shared
+
+    def _forget(self, key, call, task):
+        with self._lock:
+            if self._tasks.get(key) is call:
+                del self._tasks[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away
+            task.exception()
+
+    def stats(self):
+        """Return leader/follower counts and the coalescing ratio."""
+        with self._lock:
+            requests = self.leaders + self.followers
+            return {
+                "in_flight": len(self._calls) + len(self._tasks),
+                "upstream_calls": self.leaders,
+                "coalesced_requests": self.followers,
+                "total_requests": requests,
+                "coalescing_ratio": self.followers / requests if requests else 0.0,
+                "max_waiters": self.max_waiters,
+            }
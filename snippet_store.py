@@ -0,0 +1,94 @@
+"""
+Snippet Store Module
+
+Content-addressed store for the text of retrieved chunks that answers
+cite. A snippet's id is a hash of its source title and text, so the same
+chunk cited by many answers is stored once, and an id always refers to
+the same content (responses for it can be cached indefinitely).
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class SnippetStore:
+    """Snippets on disk under `folder`, with a small in-memory LRU for reads."""
+
+    def __init__(self, folder, max_cached=2000, max_chars=20000):
+        self.folder = folder
+        self.max_cached = max_cached
+        self.max_chars = max_chars
+        self._cache = OrderedDict()
+        self._known = set()
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.duplicates = 0
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def snippet_id(text, title=None):
+        raw = json.dumps([title or "", text], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    @staticmethod
+    def is_valid_id(snippet_id):
+        return bool(_ID_PATTERN.match(snippet_id or ""))
+
+    def _path(self, snippet_id):
+        # Fan out over subfolders so no single folder grows too large
+        return os.path.join(self.folder, snippet_id[:2], f"{snippet_id}.json")
+
+    def put(self, text, title=None, uri=None):
+        """Store a snippet (if new) and return its id."""
+        text = text[:self.max_chars]
+        snippet_id = self.snippet_id(text, title)
+        with self._lock:
+            if snippet_id in self._known:
+                self.duplicates += 1
+                return snippet_id
+        path = self._path(snippet_id)
+        if os.path.exists(path):
+            with self._lock:
+                self._known.add(snippet_id)
+                self.duplicates += 1
+            return snippet_id
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a unique temporary name and rename, so readers never
+        # see a partial file and concurrent writers of the same id are harmless
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"id": snippet_id, "title": title, "uri": uri, "text": text}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._known.add(snippet_id)
+            self.writes += 1
+        return snippet_id
+
+    def get(self, snippet_id):
+        """The snippet {id, title, uri, text}, or None if unknown."""
+        if not self.is_valid_id(snippet_id):
+            return None
+        with self._lock:
+            snippet = self._cache.get(snippet_id)
+            if snippet is not None:
+                self._cache.move_to_end(snippet_id)
+                return snippet
+        try:
+            with open(self._path(snippet_id), "r", encoding="utf-8") as f:
+                snippet = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._cache[snippet_id] = snippet
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return snippet
+
+    def stats(self):
+        with self._lock:
+            return {"writes": self.writes, "duplicates": self.duplicates, "cached": len(self._cache)}
@@ -0,0 +1,49 @@
+"""
+Shared fixtures: the app imported with a fake Gemini client, every store
+resolved, and fresh caches, running in a temporary working directory.
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeModels:
+    def __init__(self):
+        self.calls = 0
+        self.error = None  # Raised by every call when set
+
+    def generate_content(self, model, contents, config):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return SimpleNamespace(text=f"Answer to {contents}", candidates=[], usage_metadata=None)
+
+    def generate_content_stream(self, model, contents, config):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        for word in f"Answer to {contents}".split(" "):
+            yield SimpleNamespace(text=word + " ", candidates=[], usage_metadata=None)
+
+
+@pytest.fixture
+def pichat(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import app
+    for folder in (app.UPLOAD_FOLDER, app.CHAT_HISTORY_FOLDER, app.FIXTURES_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+    models = FakeModels()
+    monkeypatch.setattr(app, "_client", SimpleNamespace(models=models))
+    monkeypatch.setattr(app, "_client_pid", os.getpid())
+    for key in app.KNOWLEDGE_BASES:
+        monkeypatch.setitem(app._stores[key], "store", SimpleNamespace(name=f"fileSearchStores/{key}"))
+    monkeypatch.setattr(app, "response_cache", app.ResponseCache(max_entries=100, ttl=3600, stale_ttl=0))
+    monkeypatch.setattr(app, "similarity_index", app.SimilarityIndex(threshold=2))
+    monkeypatch.setattr(app, "document_catalog", app.DocumentCatalog(str(tmp_path / "catalog.sqlite3")))
+    monkeypatch.setattr(app, "_file_snapshots", {})
+    app.fake_models = models
+    return app
@@ -0,0 +1,74 @@
+"""
+Admission control: queue timeouts and a full queue shed load, a released
+slot goes to a waiter, per-client rate limits, and 429 + Retry-After from
+the chat endpoint when its lane is full.
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, ConcurrencyLimiter
+
+
+def test_waiter_times_out_then_queue_full_sheds_at_once():
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+    assert limiter.acquire()
+    started = time.monotonic()
+    assert not limiter.acquire()
+    assert time.monotonic() - started >= 0.05
+
+    limiter.queue_timeout = 5
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    while limiter.waiting == 0:
+        time.sleep(0.005)
+    started = time.monotonic()
+    assert not limiter.acquire()  # The one queue place is taken
+    assert time.monotonic() - started < 1
+    limiter.release()
+    waiter.join(5)
+    assert limiter.active == 1
+
+
+def test_async_waiter_gets_a_slot_freed_by_a_thread():
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=2)
+    assert limiter.acquire()
+    threading.Timer(0.05, limiter.release).start()
+    assert asyncio.run(limiter.acquire_async())
+    assert limiter.active == 1
+
+
+def test_rate_limit_rejects_a_client_past_its_burst():
+    lane = AdmissionController(max_concurrent=10, rate_per_client=1, burst_per_client=2)
+    for _ in range(2):
+        lane.admit("10.0.0.1")()
+    with pytest.raises(AdmissionRejected) as e:
+        lane.admit("10.0.0.1")
+    assert e.value.reason == "Rate limit exceeded"
+    assert e.value.retry_after >= 1
+    # Other clients and fan-out slots are not affected
+    lane.admit("10.0.0.2")()
+    lane.admit_slot()()
+    assert lane.stats()["rejected_rate_limited"] == 1
+
+
+def test_release_is_idempotent():
+    lane = AdmissionController(max_concurrent=1, rate_per_client=0)
+    release = lane.admit("client")
+    release()
+    release()
+    assert lane.limiter.active == 0
+
+
+def test_chat_sheds_with_429_and_retry_after(pichat, monkeypatch):
+    limiter = pichat.chat_admission.limiter
+    monkeypatch.setattr(limiter, "active", limiter.max_concurrent)
+    monkeypatch.setattr(limiter, "queue_timeout", 0.01)
+    response = pichat.app.test_client().post("/api/chat", json={"message": "What is GPIO 4?"})
+    response.close()
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.get_json()["error"] == "Server is busy"
+    assert pichat.fake_models.calls == 0
@@ -0,0 +1,85 @@
+"""
+The native ASGI handlers drive the async Gemini client: chat answers and
+caches through client.aio, and /api/files lists documents through it.
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeAsyncModels:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_content(self, model, contents, config):
+        self.calls += 1
+        return SimpleNamespace(text=f"Answer to {contents}", candidates=[], usage_metadata=None)
+
+
+class FakeAsyncDocuments:
+    def __init__(self, docs):
+        self.docs = docs
+        self.lists = 0
+
+    async def list(self, parent, config=None):
+        self.lists += 1
+
+        async def pager():
+            for doc in self.docs:
+                yield doc
+        return pager()
+
+
+@pytest.fixture
+def asgi(pichat, monkeypatch):
+    import asgi_app
+    docs = [
+        SimpleNamespace(name=f"fileSearchStores/default/documents/{name}", display_name=name,
+                        custom_metadata=[], size_bytes=10, mime_type="text/plain", state="ACTIVE", create_time=None)
+        for name in ("b.txt", "a.txt")
+    ]
+    aio = SimpleNamespace(models=FakeAsyncModels(), file_search_stores=SimpleNamespace(documents=FakeAsyncDocuments(docs)))
+    # The sync client has no file_search_stores: the native handlers must not use it
+    monkeypatch.setattr(pichat, "_client", SimpleNamespace(models=pichat.fake_models, aio=aio))
+    monkeypatch.setattr(asgi_app.async_chat_lane, "rate_limiter", None)
+    asgi_app.fake_aio = aio
+    return asgi_app
+
+
+def _call(asgi_app, handler, body=None, query=b""):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"client": ("127.0.0.1", 1), "query_string": query, "headers": []}
+    request = asgi_app.Request(scope, json.dumps(body).encode() if body is not None else b"")
+    asyncio.run(handler(request, send))
+    status = messages[0]["status"]
+    return status, json.loads(b"".join(m.get("body", b"") for m in messages[1:]))
+
+
+def test_chat_answers_with_the_async_client_then_from_cache(asgi, pichat, capsys):
+    status, first = _call(asgi, asgi.chat, {"message": "What is GPIO 4?"})
+    assert status == 200
+    assert first["cache"] == "miss"
+    status, second = _call(asgi, asgi.chat, {"message": "What is GPIO 4?"})
+    assert second["cache"] == "hit"
+    assert asgi.fake_aio.models.calls == 1
+    assert pichat.fake_models.calls == 0
+    assert "RESPONSE" not in capsys.readouterr().out
+
+
+def test_list_files_lists_documents_with_the_async_client(asgi):
+    status, page = _call(asgi, asgi.list_files, query=b"sort=display_name")
+    assert status == 200
+    assert [file["display_name"] for file in page["files"]] == ["a.txt", "b.txt"]
+    assert asgi.fake_aio.file_search_stores.documents.lists == 1
+    # Reconciled now: the next page comes from the catalog
+    _call(asgi, asgi.list_files)
+    assert asgi.fake_aio.file_search_stores.documents.lists == 1
+    status, page = _call(asgi, asgi.list_files, query=b"refresh=1")
+    assert status == 200
+    assert asgi.fake_aio.file_search_stores.documents.lists == 2
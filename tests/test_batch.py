@@ -0,0 +1,54 @@
+"""
+/api/chat/batch: NDJSON results and summary, its own admission lane, and a
+chat lane slot per question.
+"""
+import json
+
+
+def _lines(response):
+    # Closing the response releases its admission slot
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+    return lines
+
+
+def test_batch_streams_results_then_summary(pichat):
+    response = pichat.app.test_client().post(
+        "/api/chat/batch", json={"questions": ["What is GPIO 4?", {"message": "How do I enable SSH?", "id": "ssh"}]}
+    )
+    assert response.status_code == 200
+    lines = _lines(response)
+    results = [line for line in lines if line["type"] == "result"]
+    assert sorted(line["index"] for line in results) == [0, 1]
+    assert all(line["status"] == "ok" for line in results)
+    assert {line["id"] for line in results} == {0, "ssh"}
+    assert lines[-1]["type"] == "summary"
+    assert lines[-1]["succeeded"] == 2
+
+
+def test_batch_does_not_hold_an_admin_slot(pichat, monkeypatch):
+    seen = []
+    answer_chat = pichat._answer_chat
+
+    def observe(*args, **kwargs):
+        seen.append((pichat.admin_lane.limiter.active, pichat.batch_lane.limiter.active,
+                     pichat.chat_admission.limiter.active))
+        return answer_chat(*args, **kwargs)
+
+    monkeypatch.setattr(pichat, "_answer_chat", observe)
+    response = pichat.app.test_client().post("/api/chat/batch", json={"questions": ["What is GPIO 4?"]})
+    assert _lines(response)[-1]["succeeded"] == 1
+    assert seen == [(0, 1, 1)]
+    assert pichat.chat_admission.limiter.active == 0
+
+
+def test_batch_questions_shed_by_a_full_chat_lane(pichat, monkeypatch):
+    limiter = pichat.chat_admission.limiter
+    monkeypatch.setattr(limiter, "active", limiter.max_concurrent)
+    monkeypatch.setattr(limiter, "queue_timeout", 0.01)
+    response = pichat.app.test_client().post("/api/chat/batch", json={"questions": ["What is GPIO 4?"]})
+    result, summary = _lines(response)
+    assert result["status"] == "error"
+    assert result["retry_after"] >= 1
+    assert summary["failed"] == 1
+    assert pichat.fake_models.calls == 0
@@ -0,0 +1,68 @@
+"""
+Conversation history under concurrency: parallel turns of one conversation
+and a summary written while turns are added must not lose messages.
+"""
+import threading
+
+
+def test_parallel_turns_keep_every_message(pichat, monkeypatch):
+    monkeypatch.setattr(pichat.chat_admission, "rate_limiter", None)
+    errors = []
+
+    def ask(i):
+        response = pichat.app.test_client().post(
+            "/api/chat", json={"message": f"Question {i}", "conversation_id": "conv_parallel"}
+        )
+        response.close()  # Releases the chat lane slot
+        if response.status_code != 200:
+            errors.append(response.get_json())
+
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    conversation = pichat.load_chat_history("conv_parallel")
+    assert len(conversation["messages"]) == 20
+    questions = {m["message"] for m in conversation["messages"] if m["role"] == "user"}
+    assert questions == {f"Question {i}" for i in range(10)}
+
+
+def test_summary_write_keeps_turns_added_meanwhile(pichat, monkeypatch):
+    for i in range(4):
+        pichat._append_chat_history("conv_summary", f"Question {i} " + "word " * 50, {"answer": "x " * 50})
+    monkeypatch.setattr(pichat, "CHAT_SUMMARY_TOKENS", 20)
+    monkeypatch.setattr(pichat, "CHAT_CONTEXT_TOKENS", 40)
+
+    def slow_summary(summary, turns, deadline=None):
+        # Another request finishes its turn while the summary is generated
+        pichat._append_chat_history("conv_summary", "Meanwhile", {"answer": "y"})
+        return "summary"
+
+    monkeypatch.setattr(pichat, "_summarize_turns", slow_summary)
+    context = pichat._conversation_context("conv_summary", "Next question")
+    assert context["summarized_turns"] > 0
+    conversation = pichat.load_chat_history("conv_summary")
+    assert len(conversation["messages"]) == 10
+    assert conversation["messages"][-2]["message"] == "Meanwhile"
+    assert conversation["summary"] == {"text": "summary", "turns": context["summarized_turns"]}
+
+
+def test_saved_history_never_reads_partial(pichat):
+    pichat._append_chat_history("conv_atomic", "Question", {"answer": "x " * 2000})
+    stop = threading.Event()
+    failures = []
+
+    def read():
+        while not stop.is_set():
+            if pichat.load_chat_history("conv_atomic") is None:
+                failures.append(True)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(30):
+        pichat._append_chat_history("conv_atomic", f"Question {i}", {"answer": "x " * 2000})
+    stop.set()
+    reader.join()
+    assert failures == []
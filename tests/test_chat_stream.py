@@ -0,0 +1,42 @@
+"""
+/api/chat/stream: delta events that add up to the answer, a final done
+event, cache hits as a single delta, and an error event on failure.
+"""
+import json
+
+
+def _events(response):
+    events = []
+    for frame in response.get_data(as_text=True).split("\n\n"):
+        if not frame.strip():
+            continue
+        lines = frame.split("\n")
+        events.append((lines[0][len("event: "):], json.loads(lines[1][len("data: "):])))
+    response.close()
+    return events
+
+
+def test_stream_sends_deltas_then_done(pichat):
+    client = pichat.app.test_client()
+    response = client.post("/api/chat/stream", json={"message": "What is GPIO 4?"})
+    assert response.mimetype == "text/event-stream"
+    events = _events(response)
+    deltas = [data["text"] for event, data in events if event == "delta"]
+    assert len(deltas) > 1
+    assert "".join(deltas).strip() == "Answer to What is GPIO 4?"
+    event, done = events[-1]
+    assert event == "done"
+    assert done["cache"] == "miss"
+    assert "html" in done
+
+    # Cached now: the whole answer arrives as one delta
+    events = _events(client.post("/api/chat/stream", json={"message": "What is GPIO 4?"}))
+    assert [event for event, _ in events] == ["delta", "done"]
+    assert events[-1][1]["cache"] == "hit"
+    assert pichat.fake_models.calls == 1
+
+
+def test_stream_reports_upstream_errors(pichat, monkeypatch):
+    pichat.fake_models.error = ValueError("model exploded")
+    events = _events(pichat.app.test_client().post("/api/chat/stream", json={"message": "What is GPIO 4?"}))
+    assert events == [("error", {"error": "model exploded"})]
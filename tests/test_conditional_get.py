@@ -0,0 +1,32 @@
+"""
+Conditional GETs of history and fixture listings: validators, 304s, and a
+file deleted while the folder is scanned.
+"""
+import os
+
+
+def test_history_listing_answers_304_until_it_changes(pichat):
+    client = pichat.app.test_client()
+    pichat._append_chat_history("conv_a", "Question", {"answer": "x"})
+    first = client.get("/api/chat/history")
+    first.close()
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    again = client.get("/api/chat/history", headers={"If-None-Match": etag})
+    again.close()
+    assert again.status_code == 304
+
+    pichat._append_chat_history("conv_b", "Another question", {"answer": "y"})
+    changed = client.get("/api/chat/history", headers={"If-None-Match": etag})
+    changed.close()
+    assert changed.status_code == 200
+
+
+def test_latest_mtime_path_skips_files_deleted_meanwhile(pichat, monkeypatch, tmp_path):
+    folder = tmp_path / "listing"
+    folder.mkdir()
+    (folder / "kept.json").write_text("{}")
+    listdir = os.listdir
+    monkeypatch.setattr(pichat.os, "listdir", lambda path: listdir(path) + ["deleted.json"])
+    assert pichat._latest_mtime_path(str(folder)) in (str(folder), str(folder / "kept.json"))
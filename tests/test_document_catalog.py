@@ -0,0 +1,70 @@
+"""
+DocumentCatalog: reconciling against a remote listing, the revision counter
+shared by every connection, stale marks, and a failed listing keeping the
+store's entries.
+"""
+from document_catalog import DocumentCatalog
+
+
+def _doc(name, state="ACTIVE"):
+    # Shaped like app._catalog_entry
+    return {"name": f"documents/{name}", "display_name": f"{name}.txt", "source_url": None, "size_bytes": 10,
+            "mime_type": "text/plain", "state": state, "create_time": None, "metadata": {}}
+
+
+def test_replace_store_reports_the_diff_and_keeps_hashes(tmp_path):
+    catalog = DocumentCatalog(str(tmp_path / "catalog.sqlite3"))
+    hashed = []
+
+    def content_hash(document):
+        hashed.append(document["name"])
+        return f"hash-{document['name']}"
+
+    assert catalog.replace_store("docs", [_doc("a"), _doc("b")], content_hash) == (2, 0, 0)
+    assert catalog.replace_store("docs", [_doc("a", state="FAILED"), _doc("c")], content_hash) == (1, 1, 1)
+    # Only new documents are hashed; a changed one keeps its hash
+    assert hashed == ["documents/a", "documents/b", "documents/c"]
+    assert catalog.get("documents/a")["content_hash"] == "hash-documents/a"
+    assert [doc["display_name"] for doc in catalog.documents("docs")] == ["a.txt", "c.txt"]
+    assert catalog.reconciled_at("docs") is not None
+    assert catalog.documents("other") == []
+
+
+def test_revision_advances_only_on_changes_and_is_shared(tmp_path):
+    path = str(tmp_path / "catalog.sqlite3")
+    worker_a = DocumentCatalog(path)
+    worker_b = DocumentCatalog(path)
+    start = worker_b.revision()
+    worker_a.replace_store("docs", [_doc("a")])
+    after_reconcile = worker_b.revision()
+    assert after_reconcile > start
+    worker_a.replace_store("docs", [_doc("a")])  # Nothing changed
+    assert worker_b.revision() == after_reconcile
+    worker_a.upsert(dict(_doc("b"), store="docs"))
+    worker_a.remove("documents/a")
+    assert worker_b.revision() == after_reconcile + 2
+    worker_a.clear_store("docs")
+    assert worker_b.revision() == after_reconcile + 3
+    assert worker_b.documents("docs") == []
+
+
+def test_mark_stale_forces_a_reconciliation(tmp_path):
+    catalog = DocumentCatalog(str(tmp_path / "catalog.sqlite3"))
+    catalog.replace_store("docs", [_doc("a")])
+    catalog.mark_stale("docs")
+    assert catalog.reconciled_at("docs") is None
+    assert len(catalog.documents("docs")) == 1
+
+
+def test_failed_listing_keeps_the_store_entries(pichat, monkeypatch):
+    store = pichat.DEFAULT_STORE
+    pichat.document_catalog.replace_store(store, [_doc("a")])
+    pichat.document_catalog.mark_stale(store)
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError("upstream down")
+
+    monkeypatch.setattr(pichat, "_list_documents", unavailable)
+    pichat._ensure_catalog([store])
+    assert [doc["name"] for doc in pichat.document_catalog.documents(store)] == ["documents/a"]
+    assert pichat.document_catalog.reconciled_at(store) is None
@@ -0,0 +1,68 @@
+"""
+HedgePolicy: no hedging without enough samples, a slow primary is hedged
+and the faster attempt wins, and time queued for a thread is not counted.
+"""
+import asyncio
+import threading
+import time
+
+from hedging import HedgePolicy
+
+
+def _policy(delay, **kwargs):
+    policy = HedgePolicy(enabled=True, percentile=50, max_hedge_ratio=1.0, min_samples=3, **kwargs)
+    for _ in range(3):
+        policy._record(delay)
+    return policy
+
+
+def test_no_hedge_without_enough_samples():
+    policy = HedgePolicy(enabled=True, min_samples=20, max_hedge_ratio=1.0)
+    assert policy.hedge_delay() is None
+    assert policy.call(lambda: "answer") == "answer"
+    assert policy.stats()["hedges"] == 0
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins():
+    policy = _policy(0.02)
+    attempts = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            attempts.append(1)
+            first = len(attempts) == 1
+        time.sleep(1.0 if first else 0.01)
+        return "slow" if first else "fast"
+
+    assert policy.call(fn) == "fast"
+    stats = policy.stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
+
+
+def test_queue_wait_does_not_trigger_a_hedge():
+    policy = _policy(0.1, max_workers=1)
+    release = threading.Event()
+    policy._executor.submit(release.wait, 5)  # Holds the only thread
+    threading.Timer(0.3, release.set).start()
+    # Queued for 0.3s, longer than the hedge delay, but runs in 0.01s
+    assert policy.call(lambda: time.sleep(0.01) or "answer") == "answer"
+    assert policy.stats()["hedges"] == 0
+
+
+def test_async_hedge_cancels_the_loser():
+    policy = _policy(0.02)
+    cancelled = []
+    attempts = []
+
+    async def fn():
+        attempts.append(1)
+        try:
+            await asyncio.sleep(1.0 if len(attempts) == 1 else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return len(attempts)
+
+    assert asyncio.run(policy.call_async(fn)) == 2
+    assert cancelled == [1]
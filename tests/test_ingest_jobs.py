@@ -0,0 +1,119 @@
+"""
+Ingest jobs: journal replay, the pending-job limit, resuming the jobs of a
+dead process, and no orphaned local copy when the queue is full.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from ingest_jobs import FAILED, PARTIAL, SUCCEEDED, UPLOADING, JobQueue, JobQueueFull
+
+
+def _wait_finished(jobs, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get(job_id)
+        if job["finished_at"] is not None:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_job_runs_and_replays_from_its_journal(tmp_path):
+    def run_file(job, file):
+        if file["filename"] == "bad.txt":
+            raise ValueError("bad file")
+        return f"documents/{file['filename']}"
+
+    jobs = JobQueue(run_file, str(tmp_path))
+    job = jobs.submit("upload", "docs", [
+        {"filename": "a.txt", "local_path": "a", "config": {}},
+        {"filename": "bad.txt", "local_path": "b", "config": {}},
+    ])
+    finished = _wait_finished(jobs, job["id"])
+    assert finished["status"] == PARTIAL
+    assert [f["status"] for f in finished["files"]] == [SUCCEEDED, FAILED]
+    assert finished["files"][1]["error"] == "bad file"
+
+    # Another process sees the same job by replaying the journal
+    replayed = JobQueue(run_file, str(tmp_path)).get(job["id"])
+    assert replayed["status"] == PARTIAL
+    assert replayed["files"][0]["document"] == "documents/a.txt"
+
+
+def test_submit_refuses_past_max_pending(tmp_path):
+    release = threading.Event()
+    jobs = JobQueue(lambda job, file: release.wait(10), str(tmp_path), workers=1, max_pending=1)
+    try:
+        jobs.submit("upload", "docs", [{"filename": "a.txt", "local_path": "a", "config": {}}])
+        with pytest.raises(JobQueueFull):
+            jobs.check_capacity()
+        with pytest.raises(JobQueueFull):
+            jobs.submit("upload", "docs", [{"filename": "b.txt", "local_path": "b", "config": {}}])
+    finally:
+        release.set()
+
+
+def test_jobs_of_a_dead_process_are_resumed(tmp_path):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    job = {
+        "id": "orphan", "kind": "upload", "store": "docs", "options": {}, "status": "queued",
+        "owner": dead.pid, "created_at": time.time(), "started_at": None, "finished_at": None,
+        "version": 0, "files": [
+            {"filename": name, "local_path": name, "config": {}, "status": "queued", "attempts": 0,
+             "error": None, "document": None, "started_at": None, "finished_at": None}
+            for name in ("done.txt", "cut.txt", "todo.txt")
+        ],
+    }
+    events = [
+        {"file": 0, "status": UPLOADING, "at": 1},
+        {"file": 0, "status": SUCCEEDED, "document": "documents/done", "at": 2},
+        {"file": 1, "status": UPLOADING, "at": 3},
+    ]
+    with open(tmp_path / "orphan.jsonl", "w") as f:
+        for record in [job] + events:
+            f.write(json.dumps(record) + "\n")
+        f.write('{"file": 1, "sta')  # Cut short by the crash
+
+    ran = []
+    jobs = JobQueue(lambda job, file: ran.append((file["filename"], file.get("replace"))) or "doc", str(tmp_path))
+    jobs.start()
+    finished = _wait_finished(jobs, "orphan")
+    assert jobs.resumed == 1
+    assert sorted(ran) == [("cut.txt", True), ("todo.txt", None)]
+    assert finished["status"] == SUCCEEDED
+    assert finished["files"][1]["attempts"] == 2
+
+
+def test_full_queue_leaves_no_local_copy(pichat, monkeypatch):
+    monkeypatch.setattr(pichat.ingest_jobs, "max_pending", 0)
+    client = pichat.app.test_client()
+    folder = pichat._upload_folder(pichat.DEFAULT_STORE)
+    response = client.post("/api/files/save", json={"filename": "new", "content": "text"})
+    response.close()  # Releases the admin lane slot
+    assert response.status_code == 503
+    assert not os.path.exists(os.path.join(folder, "new.txt"))
+
+    # The queue fills up between the capacity check and the submit
+    monkeypatch.setattr(pichat.ingest_jobs, "max_pending", 100)
+
+    def full(*args, **kwargs):
+        raise JobQueueFull(100)
+
+    monkeypatch.setattr(pichat.ingest_jobs, "submit", full)
+    existing = os.path.join(folder, "existing.txt")
+    with open(existing, "w") as f:
+        f.write("old")
+    for filename in ("new", "existing"):
+        response = client.post("/api/files/save", json={"filename": filename, "content": "text"})
+        response.close()
+        assert response.status_code == 503
+    assert not os.path.exists(os.path.join(folder, "new.txt"))
+    # A copy that was already there is not removed
+    assert os.path.exists(existing)
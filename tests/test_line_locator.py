@@ -0,0 +1,53 @@
+"""
+LineLocator: a chunk is placed on its line range even when rewrapped,
+unrelated text is not placed, and changed or unreadable files are handled.
+"""
+import os
+
+from line_locator import LineLocator
+
+
+def _write(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _lines(prefix, count):
+    return [f"{prefix} line {n} mentions word{n} and token{n * 7} alongside item{n * 13}" for n in range(1, count + 1)]
+
+
+def test_rewrapped_chunk_is_placed_on_its_lines(tmp_path):
+    path = tmp_path / "guide.txt"
+    lines = _lines("guide", 200)
+    _write(path, lines)
+    locator = LineLocator()
+    assert locator.add_file("guide", str(path), "guide.txt")
+    # Retrieved chunks lose the original line breaks
+    chunk = "  ".join(lines[49:60])
+    assert locator.locate("guide.txt", chunk) == ("guide", 50, 60)
+    assert locator.locate("other.txt", chunk) is None
+    assert locator.locate("guide.txt", "completely unrelated words about cameras and audio output") is None
+
+
+def test_changed_file_is_reindexed(tmp_path):
+    path = tmp_path / "guide.txt"
+    _write(path, _lines("old", 50))
+    locator = LineLocator()
+    locator.add_file("guide", str(path), "guide.txt")
+    new_lines = ["header"] * 10 + _lines("new", 50)
+    _write(path, new_lines)
+    os.utime(path, ns=(1, 1))  # A different signature even within one mtime tick
+    locator.add_file("guide", str(path), "guide.txt")
+    assert locator.locate("guide.txt", " ".join(new_lines[20:25])) == ("guide", 21, 25)
+    assert locator.stats()["files"] == 1
+
+
+def test_unreadable_files_are_dropped(tmp_path):
+    path = tmp_path / "guide.txt"
+    _write(path, _lines("guide", 20))
+    locator = LineLocator()
+    locator.add_file("guide", str(path), "guide.txt")
+    path.write_bytes(b"\xff\xfe binary")
+    assert not locator.add_file("guide", str(path), "guide.txt")
+    assert locator.stats()["files"] == 0
+    assert not locator.add_file("missing", str(tmp_path / "missing.txt"), "missing.txt")
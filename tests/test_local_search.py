@@ -0,0 +1,70 @@
+"""
+Local BM25 search: ranking with line ranges, incremental add/replace/remove,
+and the app's index following changes another worker made to the folders.
+"""
+import os
+
+from local_search import LocalSearchIndex, split_passages, tokenize
+
+GUIDE = """Enabling SSH
+
+Open raspi-config and choose Interface Options, then SSH.
+
+Enabling I2C
+
+Open raspi-config and choose Interface Options, then I2C.
+The I2C bus appears as /dev/i2c-1.
+"""
+
+
+def test_tokenize_drops_stopwords_and_plural_s():
+    assert tokenize("The pins of the boards") == ["pin", "board"]
+
+
+def test_passages_keep_whole_lines_and_line_numbers():
+    passages = split_passages(GUIDE, max_chars=60)
+    assert [(start, end) for start, end, _ in passages] == [(1, 3), (5, 8)]
+    assert passages[1][2].startswith("Enabling I2C")
+
+
+def test_search_ranks_passages_and_reports_their_lines():
+    index = LocalSearchIndex(passage_chars=60)
+    index.add_document("guide", GUIDE, title="guide.txt")
+    index.add_document("gpio", "GPIO 4 is a general purpose pin.\n", title="gpio.txt")
+    hits = index.search("how do I enable i2c")
+    assert hits[0]["title"] == "guide.txt"
+    assert (hits[0]["start_line"], hits[0]["end_line"]) == (5, 8)
+    assert index.search("gpio pin")[0]["doc_id"] == "gpio"
+    assert index.search("gpio pin", doc_filter=lambda doc_id: doc_id != "gpio") == []
+
+
+def test_documents_are_replaced_and_removed_incrementally():
+    index = LocalSearchIndex()
+    index.add_document("doc", "Camera module setup\n")
+    index.add_document("doc", "Audio output setup\n")
+    assert index.search("camera") == []
+    assert index.search("audio")[0]["doc_id"] == "doc"
+    assert index.remove_document("doc")
+    assert index.search("audio") == []
+    assert index.stats() == {"documents": 0, "passages": 0, "terms": 0}
+
+
+def test_app_index_follows_changes_made_by_another_worker(pichat, monkeypatch):
+    monkeypatch.setattr(pichat, "local_index", LocalSearchIndex())
+    monkeypatch.setattr(pichat, "line_locator", pichat.LineLocator())
+    monkeypatch.setattr(pichat, "_local_index_ready", False)
+    monkeypatch.setattr(pichat, "_local_index_revision", None)
+    monkeypatch.setattr(pichat, "_local_index_files", {})
+    folder = pichat._upload_folder(pichat.DEFAULT_STORE)
+    with open(f"{folder}/camera.txt", "w") as f:
+        f.write("Camera module setup\n")
+    assert pichat._local_search("camera")[0]["title"] == "camera.txt"
+
+    # Another worker saves a file and records it in the shared catalog
+    with open(f"{folder}/audio.txt", "w") as f:
+        f.write("Audio output setup\n")
+    os.remove(f"{folder}/camera.txt")
+    pichat.document_catalog.upsert({"name": "documents/audio", "store": pichat.DEFAULT_STORE,
+                                    "display_name": "audio.txt"})
+    assert pichat._local_search("audio")[0]["title"] == "audio.txt"
+    assert pichat._local_search("camera") == []
@@ -0,0 +1,27 @@
+"""
+Cache pre-warming against a fake Gemini client: a question that misses the
+cache is generated, cached and counted as warmed; asking it again is a hit.
+"""
+import time
+
+
+def test_prewarm_question_reports_generated_answers(pichat):
+    assert pichat._prewarm_question("How do I enable SSH?") is True
+    assert pichat.fake_models.calls == 1
+    # Now cached: nothing new is generated
+    assert pichat._prewarm_question("How do I enable SSH?") is False
+    assert pichat.fake_models.calls == 1
+
+
+def test_prewarm_pass_counts_warmed_questions(pichat):
+    questions = ["How do I enable I2C?", "What is GPIO 4?"]
+    pichat._prewarm_question(questions[1])
+    warmer = pichat.CacheWarmer(lambda: questions, pichat._prewarm_question, concurrency=1, rate=0, delay=0)
+    warmer.schedule("test", delay=0)
+    deadline = time.monotonic() + 10
+    while warmer.stats()["last_pass"] is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    last_pass = warmer.stats()["last_pass"]
+    assert last_pass["warmed"] == 1
+    assert last_pass["cached"] == 1
+    assert last_pass["failed"] == 0
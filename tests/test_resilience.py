@@ -0,0 +1,91 @@
+"""
+ResilientCaller: retries within the retry budget and deadline, no retries
+of non-retryable errors, and the circuit breaker's open and half-open states.
+"""
+import pytest
+
+import resilience
+from resilience import (CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded, ResilientCaller,
+                        RetryBudget)
+
+
+class Flaky:
+    def __init__(self, failures, error=ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, timeout):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("upstream down")
+        return "ok"
+
+
+def _caller(**kwargs):
+    kwargs.setdefault("base_delay", 0)
+    return ResilientCaller(lambda e: isinstance(e, ConnectionError), **kwargs)
+
+
+def test_retryable_errors_are_retried():
+    flaky = Flaky(2)
+    caller = _caller(max_attempts=3)
+    assert caller.call("op", flaky) == "ok"
+    assert flaky.calls == 3
+    assert caller.stats()["retries"] == 2
+
+
+def test_other_errors_are_raised_at_once_and_do_not_trip_the_breaker():
+    flaky = Flaky(1, error=ValueError)
+    caller = _caller(failure_threshold=1)
+    with pytest.raises(ValueError):
+        caller.call("op", flaky)
+    assert flaky.calls == 1
+    assert caller.breaker("op").state == CircuitBreaker.CLOSED
+
+
+def test_retry_budget_limits_retries():
+    caller = _caller(max_attempts=5, retry_budget=RetryBudget(ratio=0, max_tokens=1), failure_threshold=100)
+    flaky = Flaky(10)
+    with pytest.raises(ConnectionError):
+        caller.call("op", flaky)
+    # One retry from the budget, then no tokens are left
+    assert flaky.calls == 2
+    flaky = Flaky(10)
+    with pytest.raises(ConnectionError):
+        caller.call("op", flaky)
+    assert flaky.calls == 1
+
+
+def test_expired_deadline_is_not_attempted():
+    flaky = Flaky(0)
+    with pytest.raises(DeadlineExceeded):
+        _caller().call("op", flaky, Deadline(0))
+    assert flaky.calls == 0
+
+
+def test_breaker_opens_then_lets_one_probe_through(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("op", failure_threshold=2, reset_timeout=30)
+    breaker.allow()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.allow()
+    assert e.value.retry_after == pytest.approx(30)
+
+    now[0] += 31
+    breaker.allow()  # The probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()  # Only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] += 31
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.allow()
@@ -0,0 +1,99 @@
+"""
+ResponseCache: TTL and stale windows, LRU eviction, the disk tier, and
+revision bumps seen by every process sharing the persistence folder.
+"""
+import os
+
+import response_cache
+from response_cache import ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_entries_go_stale_then_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock.time)
+    cache = ResponseCache(ttl=10, stale_ttl=5)
+    key = cache.make_key("How do I enable SSH?", "instruction", "model")
+    cache.put(key, "answer")
+    assert cache.get(key) == ("answer", "hit")
+    clock.now += 12
+    assert cache.get(key) == ("answer", "stale")
+    clock.now += 5
+    assert cache.get(key, allow_expired=True) == ("answer", "expired")
+    assert cache.get(key) == (None, "miss")
+    assert cache.get(key, allow_expired=True) == (None, "miss")
+    stats = cache.stats()
+    assert (stats["hits"], stats["stale_hits"]) == (1, 1)
+
+
+def test_keys_ignore_case_whitespace_and_trailing_punctuation():
+    cache = ResponseCache()
+    assert cache.make_key("How do I  enable SSH?", "i", "m") == cache.make_key("how do i enable ssh", "i", "m")
+    assert cache.make_key("enable SSH", "i", "m") != cache.make_key("enable SSH", "other", "m")
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") == (None, "miss")
+    assert cache.get("a") == (1, "hit")
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    first = ResponseCache(persist_dir=str(tmp_path))
+    key = first.make_key("What is GPIO 4?", "", "model")
+    first.put(key, {"answer_text": "A pin"})
+    second = ResponseCache(persist_dir=str(tmp_path))
+    assert second.make_key("What is GPIO 4?", "", "model") == key
+    assert second.get(key) == ({"answer_text": "A pin"}, "hit")
+
+
+def test_revision_bump_invalidates_other_processes(tmp_path):
+    worker_a = ResponseCache(persist_dir=str(tmp_path))
+    worker_b = ResponseCache(persist_dir=str(tmp_path))
+    key = worker_b.make_key("What is GPIO 4?", "", "model")
+    worker_b.put(key, "old answer")
+    assert worker_b.get(key)[1] == "hit"
+
+    assert worker_a.bump_revision() == 1
+    # worker_b sees the new revision on its next lookup
+    assert worker_b.get(key) == (None, "miss")
+    assert worker_b.revision == 1
+    assert worker_b.make_key("What is GPIO 4?", "", "model") != key
+    # A bump starts from the newest revision any process wrote
+    assert worker_b.bump_revision() == 2
+
+
+def test_sweep_drops_old_revisions_and_bounds_the_disk_tier(tmp_path, monkeypatch):
+    # Sweep only when the test says so
+    monkeypatch.setattr(ResponseCache, "_sweep_disk_async", lambda self: None)
+    cache = ResponseCache(persist_dir=str(tmp_path), max_disk_entries=3)
+    cache.put("0" * 64, "old revision")
+    cache.bump_revision()
+    for i in range(5):
+        path_key = f"{i + 1:064x}"
+        cache.put(path_key, i)
+        os.utime(cache._disk_path(path_key), (i, i))  # Written in order
+    cache._sweep_disk()
+    names = sorted(name for name in os.listdir(tmp_path) if name.endswith(".json") and name != "revision.json")
+    assert names == [f"r1_{i + 1:064x}.json" for i in (2, 3, 4)]
+
+
+def test_sweep_keeps_entries_of_a_newer_revision(tmp_path, monkeypatch):
+    monkeypatch.setattr(ResponseCache, "_sweep_disk_async", lambda self: None)
+    behind = ResponseCache(persist_dir=str(tmp_path))
+    ahead = ResponseCache(persist_dir=str(tmp_path))
+    ahead.bump_revision()
+    ahead.put("1" * 64, "new answer")
+    behind._sweep_disk()
+    assert ahead.get("1" * 64) == ("new answer", "hit")
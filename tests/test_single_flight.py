@@ -0,0 +1,100 @@
+"""
+SingleFlight: concurrent identical calls share one run, errors reach every
+waiter, and a cancelled async waiter does not cancel the shared call.
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("q", fn)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("q", fn))) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    _wait_until(lambda: flight.stats()["coalesced_requests"] == 4)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert runs == [1]
+    assert sorted(results) == [("answer", False)] + [("answer", True)] * 4
+    # The key is free again once the call finished
+    assert flight.do("q", lambda: "again") == ("again", False)
+
+
+def test_errors_reach_every_waiter():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("upstream down")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("q", fail)
+        except ValueError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    _wait_until(lambda: flight.stats()["coalesced_requests"] == 1)
+    release.set()
+    leader.join()
+    follower.join()
+    assert errors == ["upstream down", "upstream down"]
+
+
+def test_async_waiter_cancellation_keeps_the_shared_call():
+    flight = SingleFlight()
+    runs = []
+
+    async def fn():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do_async("q", fn))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flight.do_async("q", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == ("answer", True)
+    assert runs == [1]
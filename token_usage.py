@@ -0,0 +1,130 @@
+"""
+Token Usage Module
+
+Per-request token accounting for Gemini calls: counts are taken from a
+response's usage_metadata, aggregated in memory per instruction profile and
+hour (and per conversation), and compared against token budgets.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# usage_metadata attribute -> field recorded per request
+USAGE_FIELDS = {
+    "prompt_token_count": "prompt_tokens",
+    "cached_content_token_count": "cached_tokens",
+    "tool_use_prompt_token_count": "tool_tokens",
+    "thoughts_token_count": "thinking_tokens",
+    "candidates_token_count": "output_tokens",
+    "total_token_count": "total_tokens",
+}
+
+
+class TokenBudgetExceeded(Exception):
+    """A profile has used up its hard token budget; `retry_after` is a hint in seconds."""
+
+    def __init__(self, profile, used, budget, retry_after):
+        super().__init__(f"Token budget exhausted for profile '{profile}' ({used} of {budget} tokens)")
+        self.profile = profile
+        self.used = used
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+def usage_from_metadata(usage_metadata):
+    """Token counts of one response as a dict, or None without usage metadata."""
+    if usage_metadata is None:
+        return None
+    usage = {field: getattr(usage_metadata, name, None) or 0 for name, field in USAGE_FIELDS.items()}
+    if not usage["total_tokens"]:
+        usage["total_tokens"] = (
+            usage["prompt_tokens"] + usage["tool_tokens"] + usage["thinking_tokens"] + usage["output_tokens"]
+        )
+    return usage
+
+
+def _empty_totals():
+    return dict({field: 0 for field in USAGE_FIELDS.values()}, requests=0)
+
+
+def _add(totals, usage):
+    totals["requests"] += 1
+    for field in USAGE_FIELDS.values():
+        totals[field] += usage.get(field) or 0
+
+
+class TokenLedger:
+    """
+    Token totals per profile and UTC hour for the last `hours` hours, and
+    per conversation for the `max_conversations` most recently active ones.
+    """
+
+    def __init__(self, hours=48, max_conversations=1000):
+        self.hours = hours
+        self.max_conversations = max_conversations
+        self._by_profile = {}               # profile -> {hour number: totals}
+        self._conversations = OrderedDict()  # conversation id -> totals
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hour(now=None):
+        return int((time.time() if now is None else now) // 3600)
+
+    def record(self, profile, usage, conversation_id=None):
+        if not usage:
+            return
+        hour = self._hour()
+        with self._lock:
+            hours = self._by_profile.setdefault(profile, {})
+            _add(hours.setdefault(hour, _empty_totals()), usage)
+            for old in [h for h in hours if h <= hour - self.hours]:
+                del hours[old]
+            if conversation_id:
+                totals = self._conversations.pop(conversation_id, None) or _empty_totals()
+                _add(totals, usage)
+                self._conversations[conversation_id] = totals
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+
+    def used(self, profile, window_hours):
+        """Total tokens a profile used in the current and previous window_hours - 1 hours."""
+        first = self._hour() - window_hours + 1
+        with self._lock:
+            hours = self._by_profile.get(profile, {})
+            return sum(totals["total_tokens"] for hour, totals in hours.items() if hour >= first)
+
+    def seconds_until_released(self, profile, window_hours):
+        """Seconds until the oldest hour with usage leaves the window."""
+        now = time.time()
+        first = self._hour(now) - window_hours + 1
+        with self._lock:
+            used_hours = [hour for hour, totals in self._by_profile.get(profile, {}).items()
+                          if hour >= first and totals["total_tokens"]]
+        oldest = min(used_hours) if used_hours else self._hour(now)
+        return max(1, int((oldest + window_hours) * 3600 - now) + 1)
+
+    def stats(self, top_conversations=20):
+        """Per profile totals and hourly breakdown, plus the most expensive conversations."""
+        with self._lock:
+            profiles = {
+                profile: {hour: dict(totals) for hour, totals in sorted(hours.items())}
+                for profile, hours in self._by_profile.items()
+            }
+            conversations = [dict(totals, conversation_id=cid) for cid, totals in self._conversations.items()]
+        result = {}
+        for profile, hours in sorted(profiles.items()):
+            total = _empty_totals()
+            for totals in hours.values():
+                total["requests"] += totals["requests"]
+                for field in USAGE_FIELDS.values():
+                    total[field] += totals[field]
+            result[profile] = {
+                "total": total,
+                "hours": {
+                    datetime.fromtimestamp(hour * 3600, timezone.utc).strftime("%Y-%m-%dT%H:00Z"): totals
+                    for hour, totals in hours.items()
+                },
+            }
+        conversations.sort(key=lambda totals: totals["total_tokens"], reverse=True)
+        return {"profiles": result, "conversations": conversations[:top_conversations]}